@@ -0,0 +1,31 @@
+"""Added Community listing cursor
+
+Revision ID: 8c3e51a0d2f4
+Revises: 2227925fa8ff
+Create Date: 2026-10-17 09:15:12.482113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c3e51a0d2f4'
+down_revision = '2227925fa8ff'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('communities', sa.Column('cursor_fullname', sa.String(length=16), nullable=True))
+    op.add_column('communities', sa.Column('cursor_etag', sa.String(), nullable=True))
+    op.add_column('communities', sa.Column('cursor_last_modified', sa.String(), nullable=True))
+    op.add_column('communities', sa.Column('cursor_moved', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('communities') as batch_op:
+        batch_op.drop_column('cursor_moved')
+        batch_op.drop_column('cursor_last_modified')
+        batch_op.drop_column('cursor_etag')
+        batch_op.drop_column('cursor_fullname')
@@ -0,0 +1,48 @@
+"""Added Post.reddit_id
+
+Revision ID: b6e19d4c7a52
+Revises: 8c3e51a0d2f4
+Create Date: 2026-10-17 10:30:41.907215
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e19d4c7a52'
+down_revision = '8c3e51a0d2f4'
+branch_labels = None
+depends_on = None
+
+REDDIT_ID_PATTERN = re.compile(r'(?:/comments/|redd\.it/)([a-z0-9]+)')
+
+
+def upgrade() -> None:
+    op.add_column('posts', sa.Column('reddit_id', sa.String(length=16), nullable=True))
+
+    # Backfill from the links, the oldest row wins when a post got saved twice (www. and old. links)
+    connection = op.get_bind()
+    posts = sa.table('posts', sa.column('id', sa.Integer), sa.column('reddit_link', sa.String),
+                     sa.column('reddit_id', sa.String))
+    seen = set()
+    backfill = []
+    for post_id, reddit_link in connection.execute(sa.select(posts.c.id, posts.c.reddit_link).order_by(posts.c.id)):
+        match = REDDIT_ID_PATTERN.search(reddit_link or '')
+        if not match or match.group(1) in seen:
+            continue
+        seen.add(match.group(1))
+        backfill.append({'post_id': post_id, 'new_reddit_id': f't3_{match.group(1)}'})
+    if backfill:
+        connection.execute(posts.update().where(posts.c.id == sa.bindparam('post_id'))
+                           .values(reddit_id=sa.bindparam('new_reddit_id')), backfill)
+
+    op.create_index(op.f('ix_posts_reddit_id'), 'posts', ['reddit_id'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_posts_reddit_id'), table_name='posts')
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('reddit_id')
@@ -0,0 +1,47 @@
+"""Added Community.next_scrape_at
+
+Revision ID: d1a7f03e95b8
+Revises: b6e19d4c7a52
+Create Date: 2026-10-17 11:45:03.118620
+
+"""
+from datetime import timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1a7f03e95b8'
+down_revision = 'b6e19d4c7a52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('communities', sa.Column('next_scrape_at', sa.DateTime(), nullable=False,
+                                           server_default='1970-01-01 00:00:00'))
+
+    # Backfill last_scrape + min_interval, in Python since date arithmetic differs per database
+    connection = op.get_bind()
+    communities = sa.table('communities', sa.column('id', sa.Integer), sa.column('last_scrape', sa.DateTime),
+                           sa.column('next_scrape_at', sa.DateTime))
+    stats = sa.table('community_stats', sa.column('community_id', sa.Integer), sa.column('min_interval', sa.Integer))
+    rows = connection.execute(
+        sa.select(communities.c.id, communities.c.last_scrape, stats.c.min_interval)
+        .select_from(communities.outerjoin(stats, stats.c.community_id == communities.c.id))
+        .where(communities.c.last_scrape.is_not(None))
+    )
+    backfill = [{'community_id': community_id, 'new_next_scrape_at': last_scrape + timedelta(minutes=min_interval or 0)}
+                for community_id, last_scrape, min_interval in rows]
+    if backfill:
+        connection.execute(communities.update().where(communities.c.id == sa.bindparam('community_id'))
+                           .values(next_scrape_at=sa.bindparam('new_next_scrape_at')), backfill)
+
+    op.create_index('ix_communities_enabled_next_scrape_at', 'communities', ['enabled', 'next_scrape_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_communities_enabled_next_scrape_at', table_name='communities')
+    with op.batch_alter_table('communities') as batch_op:
+        batch_op.drop_column('next_scrape_at')
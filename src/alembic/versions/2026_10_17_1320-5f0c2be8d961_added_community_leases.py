@@ -0,0 +1,27 @@
+"""Added Community leases
+
+Revision ID: 5f0c2be8d961
+Revises: d1a7f03e95b8
+Create Date: 2026-10-17 13:20:37.551904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f0c2be8d961'
+down_revision = 'd1a7f03e95b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('communities', sa.Column('claimed_by', sa.String(length=64), nullable=True))
+    op.add_column('communities', sa.Column('lease_until', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('communities') as batch_op:
+        batch_op.drop_column('lease_until')
+        batch_op.drop_column('claimed_by')
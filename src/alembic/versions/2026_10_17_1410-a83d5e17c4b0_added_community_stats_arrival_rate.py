@@ -0,0 +1,25 @@
+"""Added CommunityStats.arrival_rate
+
+Revision ID: a83d5e17c4b0
+Revises: 5f0c2be8d961
+Create Date: 2026-10-17 14:10:22.694318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a83d5e17c4b0'
+down_revision = '5f0c2be8d961'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('community_stats', sa.Column('arrival_rate', sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('community_stats') as batch_op:
+        batch_op.drop_column('arrival_rate')
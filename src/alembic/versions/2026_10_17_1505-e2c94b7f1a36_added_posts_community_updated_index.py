@@ -0,0 +1,24 @@
+"""Added posts (community_id, updated) index
+
+Revision ID: e2c94b7f1a36
+Revises: a83d5e17c4b0
+Create Date: 2026-10-17 15:05:49.230871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2c94b7f1a36'
+down_revision = 'a83d5e17c4b0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_posts_community_id_updated', 'posts', ['community_id', 'updated'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_community_id_updated', table_name='posts')
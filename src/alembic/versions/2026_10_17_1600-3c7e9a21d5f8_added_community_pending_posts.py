@@ -0,0 +1,25 @@
+"""Added Community.pending_posts
+
+Revision ID: 3c7e9a21d5f8
+Revises: e2c94b7f1a36
+Create Date: 2026-10-17 16:00:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c7e9a21d5f8'
+down_revision = 'e2c94b7f1a36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('communities', sa.Column('pending_posts', sa.JSON(none_as_null=True), nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('communities') as batch_op:
+        batch_op.drop_column('pending_posts')
@@ -0,0 +1,39 @@
+"""Added outbox
+
+Revision ID: 9b2f6d84e0a3
+Revises: 3c7e9a21d5f8
+Create Date: 2026-10-17 16:40:12.508731
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2f6d84e0a3'
+down_revision = '3c7e9a21d5f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('outbox',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('community_id', sa.Integer(), nullable=False),
+        sa.Column('reddit_id', sa.String(length=16), nullable=True),
+        sa.Column('post', sa.JSON(), nullable=False),
+        sa.Column('state', sa.String(length=16), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['community_id'], ['communities.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('reddit_id')
+    )
+    op.create_index('ix_outbox_community_id_state', 'outbox', ['community_id', 'state'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_outbox_community_id_state', table_name='outbox')
+    op.drop_table('outbox')
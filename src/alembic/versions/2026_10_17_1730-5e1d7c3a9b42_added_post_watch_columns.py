@@ -0,0 +1,34 @@
+"""Added post watch columns
+
+Revision ID: 5e1d7c3a9b42
+Revises: 9b2f6d84e0a3
+Create Date: 2026-10-17 17:30:41.193624
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e1d7c3a9b42'
+down_revision = '9b2f6d84e0a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('posts', sa.Column('lemmy_id', sa.Integer(), nullable=True))
+    op.add_column('posts', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.add_column('posts', sa.Column('check_stage', sa.Integer(), nullable=True))
+    op.add_column('posts', sa.Column('next_check_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_posts_next_check_at', 'posts', ['next_check_at'])
+    op.add_column('outbox', sa.Column('content_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('outbox', 'content_hash')
+    op.drop_index('ix_posts_next_check_at', table_name='posts')
+    op.drop_column('posts', 'next_check_at')
+    op.drop_column('posts', 'check_stage')
+    op.drop_column('posts', 'content_hash')
+    op.drop_column('posts', 'lemmy_id')
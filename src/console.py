@@ -7,10 +7,10 @@ from typing import Type
 
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, joinedload
 
 from lemmy.api import LemmyAPI
-from models.models import Community, CommunityStats
+from models.models import Community, CommunityStats, ListingCursor, SORT_HOT, SORT_NEW
 from reddit.reader import RedditReader
 from utils.syncer import Syncer
 
@@ -23,7 +23,7 @@ syncer: Syncer
 
 
 def log_stats(community: Type[Community]):
-	logging.info(f'Community {community.ident} is {"ENABLED" if community.enabled else "DISABLED"}, has {community.stats.subscribers} subscribers and {community.stats.posts_per_day} posts per day.')
+	logging.info(f'Community {community.ident} is {"ENABLED" if community.enabled else "DISABLED"}, follows {community.sorting}, has {community.stats.subscribers} subscribers and {community.stats.posts_per_day} posts per day.')
 
 
 def show_communities(as_markdown: bool = False):
@@ -97,6 +97,9 @@ if __name__ == '__main__':
 	enable_parser.add_argument("ident", help="The community ident.")
 	disable_parser = subparsers.add_parser('disable', help="Disable the community.")
 	disable_parser.add_argument("ident", help="The community ident.")
+	sorting_parser = subparsers.add_parser('sorting', help="Choose whether to clone the hot or the new posts.")
+	sorting_parser.add_argument("ident", help="The community ident.")
+	sorting_parser.add_argument("sorting", choices=[SORT_HOT, SORT_NEW], help="The listing to follow.")
 	status_parser = subparsers.add_parser('status', help="Check the status of the community.")
 	status_parser.add_argument("ident", help="The community ident.")
 	args = parser.parse_args()
@@ -109,7 +112,7 @@ if __name__ == '__main__':
 		add_community(args.ident)
 		sys.exit(0)
 
-	community = db.query(Community).filter(Community.ident.ilike(args.ident)).first()
+	community = db.query(Community).options(joinedload(Community.stats)).filter(Community.ident.ilike(args.ident)).first()
 	if community is None:
 		logging.error(f"Community '{args.ident}' not found.")
 		sys.exit(1)
@@ -127,5 +130,10 @@ if __name__ == '__main__':
 		else:
 			community.enabled = False
 			db.commit()
+	elif args.command == 'sorting':
+		community.sorting = args.sorting
+		# The cursor of one listing means nothing for the other
+		community.listing_cursor = ListingCursor()
+		db.commit()
 
 	log_stats(community)
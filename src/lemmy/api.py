@@ -1,43 +1,93 @@
-import time
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
-import jwt
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lemmy.auth import LemmyAuth
+from utils.rate_limit import RateLimitController, TokenBucket
+
+READ_RATE = 2  # GET requests per second
+WRITE_RATE = 0.5  # Other requests per second
+THROTTLED_WAIT = 10  # Seconds to back off after a 429 without Retry-After
 
 
 class LemmyAPI:
 	_API_VERSION_: str = 'v3'
 
-	def __init__(self, base_url: str, username: str = None, password: str = None):
+	def __init__(self, base_url: str, username: str = None, password: str = None, pool_size: int = 10,
+				timeout: Tuple[float, float] = (5, 60), retries: int = 3, read_rate: float = READ_RATE,
+				write_rate: float = WRITE_RATE):
 		self.base_url: str = base_url
 		self.__username: str = username
 		self.__password: str = password
-		self.__jwt: str = ''
+		self._auth: LemmyAuth = LemmyAuth(self.login)
+		self._timeout: Tuple[float, float] = timeout  # (connect, read) in seconds
+		self._session: requests.Session = self._create_session(pool_size, retries)
+		# Separate budgets, so a queue of posts doesn't hold up lookups and the other way around
+		self._read_limit = RateLimitController(TokenBucket(rate=read_rate), default_retry_after=THROTTLED_WAIT)
+		self._write_limit = RateLimitController(TokenBucket(rate=write_rate), default_retry_after=THROTTLED_WAIT)
 
-	def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None, auth_required: bool = True) -> Dict:
+	@staticmethod
+	def _create_session(pool_size: int, retries: int) -> requests.Session:
+		"""A session keeps connections alive, so posts and lookups don't each pay for a new TCP+TLS handshake.
+
+		Failed connects and stale pooled connections are retried transparently. Reads are only retried for
+		idempotent methods: a POST that reached Lemmy may have been processed already.
+		"""
+		retry = Retry(total=retries, connect=retries, read=retries, status=0, backoff_factor=0.5,
+					allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+		session = requests.Session()
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+		return session
+
+	def close(self):
+		self._auth.close()
+		self._session.close()
+
+	def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None, auth_required: bool = True, retry_auth: bool = True) -> Dict:
 		url = f'{self.base_url}/api/{self._API_VERSION_}{endpoint}'
 		headers = {'Content-Type': 'application/json'}
 		data = {} if not data else data
 
+		token = self._auth.token() if auth_required else self._auth.current
 		if auth_required:
-			self.update_auth()
 			# needed for some reason
-			headers['Authorization'] = f'Bearer {self.__jwt}'
-		if self.__jwt:
-			data['auth'] = self.__jwt
+			headers['Authorization'] = f'Bearer {token}'
+		if token:
+			data['auth'] = token
+
+		response = self._send(method, url, data, headers)
+
+		if auth_required and retry_auth and self.__is_auth_rejected(response):
+			# Token got revoked or rolled over early, a single retry with a fresh one shouldn't cost us the request
+			self._auth.invalidate()
+			return self._make_request(method, endpoint, data, auth_required=True, retry_auth=False)
 
-		if method == 'GET':
-			response = requests.request(method, url, params=data, headers=headers)
-		else:
-			response = requests.request(method, url, json=data, headers=headers)
 		response.raise_for_status()
 		return response.json()
 
-	def login(self):
+	def _send(self, method: str, url: str, data: Dict, headers: Dict, retry_throttled: bool = True) -> requests.Response:
+		"""Send a request as soon as its budget allows, waiting out (and retrying) a 429 once"""
+		limit = self._read_limit if method == 'GET' else self._write_limit
+		limit.wait()
+		if method == 'GET':
+			response = self._session.request(method, url, params=data, headers=headers, timeout=self._timeout)
+		else:
+			response = self._session.request(method, url, json=data, headers=headers, timeout=self._timeout)
+		limit.update(response)
+
+		if response.status_code == 429 and retry_throttled:
+			return self._send(method, url, data, headers, retry_throttled=False)
+		return response
+
+	def login(self) -> str:
 		response = self._make_request('POST', '/user/login', {'username_or_email': self.__username, 'password': self.__password}, auth_required=False)
 		if not response['jwt']:
 			raise RuntimeError("Could not login", response)
-		self.__jwt = response['jwt']
+		return response['jwt']
 
 	def create_comment(self, post_id: int, content: str, parent_id: int = None, form_id: str = None, language_id: str = None) -> Dict:
 		data = {'post_id': post_id, 'content': content}
@@ -58,11 +108,11 @@ class LemmyAPI:
 
 		return self._make_request('POST', '/community', data, auth_required=True)
 
-	def community_list(self, limit: int = 50, page: int = 0, sort: str = 'Old', _type: str = 'Local'):
+	def community_list(self, limit: int = 50, page: int = 1, sort: str = 'Old', type_: str = 'Local', show_nsfw: bool = True):
 		data = {}
-		self.__update_payload({'limit': limit, 'page': page, 'sort': sort, '_type': _type}, data)
+		self.__update_payload({'limit': limit, 'page': page, 'sort': sort, 'type_': type_, 'show_nsfw': show_nsfw}, data)
 
-		return self._make_request('POST', '/community/list', data, auth_required=False)
+		return self._make_request('GET', '/community/list', data, auth_required=False)
 
 	def community(self, id: int = None, name: str = None):
 		data = {}
@@ -77,7 +127,7 @@ class LemmyAPI:
 
 	def edit_post(self, post_id: int, body: str = None, language_id: int = None, name: str = None, nsfw: bool = None, url: str = None) -> Dict:
 		data = {'post_id': post_id}
-		self.__update_payload({body: body, language_id: language_id, name: name, nsfw: nsfw, url: url}, data)
+		self.__update_payload({'body': body, 'language_id': language_id, 'name': name, 'nsfw': nsfw, 'url': url}, data)
 
 		return self._make_request('PUT', '/post', data=data, auth_required=True)
 
@@ -96,20 +146,17 @@ class LemmyAPI:
 
 	def update_auth(self):
 		"""Updates the authentication token if empty or near expiring."""
-		if self.__jwt == '' or self.__is_token_near_expiry():
-			self.login()
+		self._auth.token()
 
 	@staticmethod
 	def community_uri(ident: str, hostname: str):
 		"""Creates a markdown-link relative link to a specific community."""
 		return f"[!{ident}@{hostname}](/c/{ident}@{hostname})"
 
-	def __is_token_near_expiry(self) -> bool:
-		if self.__jwt == '':
-			return True
-		decoded_token = jwt.decode(self.__jwt, algorithms=['HS256'], options={"verify_signature": False})
-		current_timestamp = int(time.time())
-		return decoded_token['iat'] - current_timestamp < -3600
+	@staticmethod
+	def __is_auth_rejected(response: requests.Response) -> bool:
+		# Lemmy 0.18 answers an invalid token with a 400 rather than a 401
+		return response.status_code == 401 or (response.status_code == 400 and 'not_logged_in' in response.text)
 
 	def __update_payload(self, optionals: dict, payload: dict) -> dict:
 		for key, value in optionals.items():
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import jwt
+
+TOKEN_LIFETIME = 3600  # Seconds a token is trusted when it doesn't carry an expiry of its own
+REFRESH_MARGIN = 300  # Seconds before expiry that a fresh token is fetched
+MIN_REFRESH_DELAY = 30  # Never refresh more often than this, even for short-lived tokens
+
+logger = logging.getLogger(__name__)
+
+
+class LemmyAuth:
+	"""Holds the JWT for a Lemmy account, and renews it in the background before it expires.
+
+	The token is decoded only once, when it's received, so checking it on every request is a simple comparison.
+	"""
+
+	def __init__(self, login: Callable[[], str], lifetime: float = TOKEN_LIFETIME, margin: float = REFRESH_MARGIN):
+		self._login: Callable[[], str] = login  # Fetches a fresh token
+		self._lifetime: float = lifetime
+		self._margin: float = margin
+		self._lock = threading.Lock()
+		self._token: str = ''
+		self._refresh_at: float = 0.0
+		self._timer: Optional[threading.Timer] = None
+
+	@property
+	def current(self) -> str:
+		"""The token as it is, without checking whether it's still valid"""
+		return self._token
+
+	def token(self) -> str:
+		"""A token that is valid for at least a little while longer"""
+		if time.time() < self._refresh_at:
+			return self._token
+		with self._lock:
+			# Another thread may have refreshed it while we were waiting
+			if time.time() >= self._refresh_at:
+				self._refresh()
+			return self._token
+
+	def refresh(self):
+		with self._lock:
+			self._refresh()
+
+	def invalidate(self):
+		"""Make sure the next call to token() fetches a new one"""
+		self._refresh_at = 0.0
+
+	def close(self):
+		if self._timer:
+			self._timer.cancel()
+
+	def _refresh(self):
+		self._token = self._login()
+		# A token that lives shorter than the margin is still used for a while, rather than logging in on every call
+		self._refresh_at = max(self._expiry(self._token) - self._margin, time.time() + MIN_REFRESH_DELAY)
+
+		if self._timer:
+			self._timer.cancel()
+		self._timer = threading.Timer(self._refresh_at - time.time(), self._background_refresh)
+		self._timer.daemon = True
+		self._timer.start()
+
+	def _background_refresh(self):
+		try:
+			self.refresh()
+		except Exception as e:
+			# The next request will try again
+			logger.warning(f"Couldn't refresh the Lemmy token in the background: {str(e)}")
+			self.invalidate()
+
+	def _expiry(self, token: str) -> float:
+		claims = jwt.decode(token, algorithms=['HS256'], options={"verify_signature": False})
+		if 'exp' in claims:
+			return float(claims['exp'])
+		return float(claims.get('iat', time.time())) + self._lifetime
@@ -3,7 +3,7 @@ import logging
 import os
 import signal
 import sys
-import time
+from datetime import datetime, timedelta
 
 from alembic import command
 from alembic.config import Config
@@ -12,20 +12,36 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from lemmy.api import LemmyAPI
+from reddit.async_reader import AsyncRedditReader, BackgroundRedditReader
 from reddit.reader import RedditReader
-from utils.stats import Stats
+from utils.leases import CommunityLeases
+from utils.outbox import Outbox
+from utils.pipeline import Pipeline
+from utils.rate_limit import TokenBucket
+from utils.reconciler import Reconciler, RECONCILE_INTERVAL
+from utils.scheduler import Job, Scheduler
+from utils.stats import Stats, STATS_CHECK_INTERVAL
+from utils.unit_of_work import PublishJournal, UnitOfWork
 from utils.syncer import Syncer
+from utils.watcher import Watcher, WATCH_INTERVAL
 
 syncer: Syncer
 load_dotenv()
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=os.getenv('LOGLEVEL', logging.INFO))
-keep_running = True
+logging.basicConfig(format="%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s", level=os.getenv('LOGLEVEL', logging.INFO))
+# Every kind of work gets a scheduler (and thread) of its own, so slow Lemmy reads for the stats never hold up scraping
+schedulers = {'requests': Scheduler(), 'stats': Scheduler(), 'scrape': Scheduler()}
 
 
 def handle_signal(signum, frame):		
-	global keep_running
 	logging.warning(f"Received signal {signum}. Stopping as soon as possible...")
-	keep_running = False
+	for scheduler in schedulers.values():
+		scheduler.stop()
+
+
+def handle_reload(signum, frame):
+	logging.info("Received SIGHUP, reloading schedule")
+	for scheduler in schedulers.values():
+		scheduler.wake()
 
 
 def initialize_database(db_url):
@@ -38,8 +54,17 @@ def initialize_database(db_url):
 	alembic_cfg.set_main_option("sqlalchemy.url", db_url)
 	command.upgrade(alembic_cfg, "head")
 
-	session = sessionmaker(bind=engine)
-	return session()
+	return sessionmaker(bind=engine)
+
+
+def create_reddit_reader() -> RedditReader:
+	"""The classic reader does one request at a time, the async one keeps several in flight within the same budget."""
+	listing_details = os.getenv('REDDIT_LISTING_DETAILS', '1') == '1'
+	if os.getenv('REDDIT_READER', 'sync') != 'async':
+		return RedditReader(listing_details=listing_details)
+
+	bucket = TokenBucket(rate=float(os.getenv('REDDIT_REQUESTS_PER_MINUTE', 20)) / 60)
+	return BackgroundRedditReader(AsyncRedditReader(bucket=bucket, max_in_flight=int(os.getenv('REDDIT_MAX_IN_FLIGHT', 8)), listing_details=listing_details))
 
 
 if __name__ == '__main__':
@@ -53,25 +78,120 @@ if __name__ == '__main__':
 
 	post_threshold_upvotes = int(os.getenv('THRESH_UPVOTES', 5))
 	post_threshold_ratio = float(os.getenv('THRESH_RATIO', 0.5))
-
-	db_session = initialize_database(database_url)
-	lemmy_api = LemmyAPI(base_url=os.getenv('LEMMY_BASE_URI'), username=os.getenv('LEMMY_USERNAME'), password=os.getenv('LEMMY_PASSWORD'))
-	reddit_scraper = RedditReader()
-	syncer = Syncer(db=db_session, reddit_reader=reddit_scraper, lemmy=lemmy_api, thresh_upvotes=post_threshold_upvotes, thresh_ratio=post_threshold_ratio, request_community=request_community)
-	stats = Stats(db=db_session, lemmy=lemmy_api)
+	scrape_batch_size = int(os.getenv('SCRAPE_BATCH_SIZE', 1))
+	scrape_max_posts = int(os.getenv('SCRAPE_MAX_POSTS', 10)) or None
+	scrape_time_budget = float(os.getenv('SCRAPE_TIME_BUDGET', 120))
+	scrape_time_budget = timedelta(seconds=scrape_time_budget) if scrape_time_budget else None
+
+	session_factory = initialize_database(database_url)
+	# A session per worker, sessions can't be shared between threads
+	db_session = session_factory()
+	requests_session = session_factory()
+	stats_session = session_factory()
+	lemmy_api = LemmyAPI(base_url=os.getenv('LEMMY_BASE_URI'), username=os.getenv('LEMMY_USERNAME'), password=os.getenv('LEMMY_PASSWORD'),
+						pool_size=int(os.getenv('LEMMY_POOL_SIZE', 10)), timeout=(5, float(os.getenv('LEMMY_TIMEOUT', 60))),
+						read_rate=float(os.getenv('LEMMY_READS_PER_SECOND', 2)), write_rate=float(os.getenv('LEMMY_WRITES_PER_SECOND', 0.5)))
+	reddit_scraper = create_reddit_reader()
+	# Only needed when several workers share the database, each of them with their own WORKER_ID
+	leases = CommunityLeases(os.getenv('WORKER_ID')) if os.getenv('WORKER_ID') else None
+	# Published posts are journaled, and committed together per community
+	journal_path = os.getenv('PUBLISH_JOURNAL', 'publish.journal')
+	if leases:
+		journal_path = f'{journal_path}.{leases.worker_id}'
+	recovered = PublishJournal.recover(db_session, journal_path)
+	if recovered:
+		logging.warning(f'Recovered {recovered} published posts from the journal')
+	# Posts that were fetched, but not published yet, are published from the outbox without visiting Reddit again
+	unpublished = Outbox(db_session).recover(exclusive=leases is None)
+	if unpublished:
+		logging.info(f'{unpublished} posts in the outbox still have to be published')
+	syncer = Syncer(db=db_session, reddit_reader=reddit_scraper, lemmy=lemmy_api, thresh_upvotes=post_threshold_upvotes, thresh_ratio=post_threshold_ratio, request_community=request_community, batch_size=scrape_batch_size, leases=leases, unit_of_work=UnitOfWork(db_session, PublishJournal(journal_path), shared=leases is not None), max_posts=scrape_max_posts, time_budget=scrape_time_budget)
+	requests_syncer = Syncer(db=requests_session, reddit_reader=reddit_scraper, lemmy=lemmy_api, thresh_upvotes=post_threshold_upvotes, thresh_ratio=post_threshold_ratio, request_community=request_community, leases=leases)
+	stats = Stats(db=stats_session, lemmy=lemmy_api, bulk=os.getenv('STATS_BULK_REFRESH', '1') == '1')
 
 	if request_community is None:
 		logging.warning('No request community is set - will not check for new requests.')
 
+	def check_new_subs():
+		requests_syncer.check_new_subs()
+		# A new community is due right away
+		schedulers['scrape'].schedule('scrape_new_posts', requests_syncer.next_scrape_due())
+		return requests_syncer.next_new_sub_check()
+
+	def update_community_stats():
+		stats.update_community_stats()
+		return datetime.utcnow() + timedelta(seconds=STATS_CHECK_INTERVAL)
+
+	outbox = Outbox(stats_session)
+
+	def purge_outbox():
+		outbox.purge()
+		return outbox.next_purge()
+
+	reconciler = Reconciler(stats_session, lemmy_api)
+
+	def reconcile_publishes():
+		# Publishes that timed out, did they make it to Lemmy or not?
+		reconciler.reconcile()
+		return datetime.utcnow() + RECONCILE_INTERVAL
+
+	# Reddit requests per run to check published posts for edits, 0 doesn't watch them at all
+	watcher = Watcher(stats_session, reddit_scraper, lemmy_api, max_requests=int(os.getenv('WATCH_MAX_REQUESTS', 1)))
+
+	def watch_posts():
+		watcher.check_due()
+		return datetime.utcnow() + WATCH_INTERVAL
+
+	pipeline = None
+	if os.getenv('SCRAPE_PIPELINE', '0') == '1':
+		# Listing, enrichment and publishing each get their own threads, so Reddit and Lemmy are kept busy at once
+		pipeline = Pipeline(session_factory=session_factory, db=db_session, reddit_reader=reddit_scraper, lemmy=lemmy_api,
+							thresh_upvotes=post_threshold_upvotes, thresh_ratio=post_threshold_ratio,
+							listing_workers=int(os.getenv('PIPELINE_LISTING_WORKERS', 2)),
+							enrich_workers=int(os.getenv('PIPELINE_ENRICH_WORKERS', 2)),
+							publish_workers=int(os.getenv('PIPELINE_PUBLISH_WORKERS', 2)),
+							on_done=lambda: schedulers['scrape'].schedule('scrape_new_posts', datetime.utcnow()), leases=leases,
+							journal_path=journal_path, max_posts=scrape_max_posts, time_budget=scrape_time_budget)
+
+	def scrape_new_posts():
+		if pipeline:
+			pipeline.submit_due()
+			return pipeline.next_due()
+		syncer.scrape_new_posts()
+		return syncer.next_scrape_due()
+
 	# Set up signal handlers
 	signal.signal(signal.SIGINT, handle_signal)
 	signal.signal(signal.SIGTERM, handle_signal)
+	signal.signal(signal.SIGHUP, handle_reload)
 
+	# Communities get their stats when they're created, this only catches up on ones that never did
+	stats.initialize_stats()
 	stats.recalculate_stats()
 
-	while keep_running:
-		if request_community:
-			syncer.check_new_subs()
-		stats.update_community_stats()
-		syncer.scrape_new_posts()
-		time.sleep(1)
+	if request_community:
+		schedulers['requests'].add(Job('check_new_subs', run=check_new_subs, load=requests_syncer.next_new_sub_check))
+	schedulers['stats'].add(Job('update_community_stats', run=update_community_stats, load=datetime.utcnow))
+	schedulers['stats'].add(Job('purge_outbox', run=purge_outbox, load=outbox.next_purge))
+	schedulers['stats'].add(Job('reconcile_publishes', run=reconcile_publishes, load=datetime.utcnow))
+	if watcher.max_requests:
+		schedulers['stats'].add(Job('watch_posts', run=watch_posts, load=datetime.utcnow))
+	schedulers['scrape'].add(Job('scrape_new_posts', run=scrape_new_posts, load=pipeline.next_due if pipeline else syncer.next_scrape_due))
+	if pipeline:
+		pipeline.start()
+	threads = [scheduler.start(name) for name, scheduler in schedulers.items() if scheduler.jobs]
+	for thread in threads:
+		# Waiting in slices keeps the main thread responsive to signals
+		while thread.is_alive():
+			thread.join(1)
+	if pipeline:
+		pipeline.stop()
+	if leases:
+		leases.release_all(db_session)
+	for session in [db_session, requests_session, stats_session]:
+		session.close()
+
+	for scheduler in schedulers.values():
+		for job in scheduler.jobs:
+			logging.info(f"{job.name}: {job.runs} runs, {job.mean_lateness.total_seconds():.3f}s late on average, "
+						 f"{job.max_lateness.total_seconds():.3f}s at most")
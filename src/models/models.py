@@ -1,8 +1,10 @@
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Optional
+import hashlib
+import re
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timedelta
+from typing import Optional, List
 
-from sqlalchemy import Column, DateTime, Integer, String, ForeignKey, Boolean
+from sqlalchemy import Column, DateTime, Integer, String, ForeignKey, Boolean, Index, Float, JSON, event
 from sqlalchemy.orm import relationship, Mapped, declarative_base
 
 Base = declarative_base()
@@ -10,6 +12,25 @@ Base = declarative_base()
 SORT_HOT = 'hot'
 SORT_NEW = 'new'
 
+EPOCH = datetime(1970, 1, 1)  # Never scraped, due right away
+
+OUTBOX_PENDING = 'pending'
+OUTBOX_PUBLISHING = 'publishing'
+OUTBOX_PUBLISHED = 'published'
+OUTBOX_FAILED = 'failed'
+OUTBOX_UNCERTAIN = 'uncertain'  # Timed out, see utils.reconciler
+
+# When the original of a published post is checked for edits, counting from when it was published, see utils.watcher
+CHECK_AFTER = (timedelta(hours=1), timedelta(days=1), timedelta(weeks=1), timedelta(days=30))
+
+REDDIT_ID_PATTERN = re.compile(r'(?:/comments/|redd\.it/)([a-z0-9]+)')
+
+
+def reddit_id_from_link(link: str) -> Optional[str]:
+	"""Extract the fullname (t3_ + base36 id) from a reddit post link, works for www., old. and short links alike"""
+	match = REDDIT_ID_PATTERN.search(link or '')
+	return f't3_{match.group(1)}' if match else None
+
 
 @dataclass
 class CommunityDTO:
@@ -20,10 +41,35 @@ class CommunityDTO:
 	nsfw: bool
 
 
+@dataclass
+class ListingCursor:
+	"""High-water mark of a subreddit listing, so later fetches only need to ask for what's new"""
+	fullname: Optional[str] = None  # Newest post (t3_...) that doesn't need to be seen again
+	etag: Optional[str] = None
+	last_modified: Optional[str] = None
+	moved: Optional[datetime] = None  # Last time the fullname changed
+
+
+@dataclass
+class PendingPosts:
+	"""Posts of a listing that still have to be cloned, when a community ran out of budget before getting to them"""
+	listed_at: datetime  # Becomes the last_scrape, once they're all done
+	posts: List['PostDTO'] = field(default_factory=list)
+
+	def to_json(self) -> dict:
+		return {'listed_at': self.listed_at.isoformat(), 'posts': [post.to_json() for post in self.posts]}
+
+	@classmethod
+	def from_json(cls, data: dict) -> 'PendingPosts':
+		return cls(listed_at=datetime.fromisoformat(data['listed_at']),
+				   posts=[PostDTO.from_json(post) for post in data['posts']])
+
+
 class Community(Base):
 	"""Represents a community/subreddit on both Lemmy and Reddit"""
 
 	__tablename__: str = 'communities'
+	__table_args__ = (Index('ix_communities_enabled_next_scrape_at', 'enabled', 'next_scrape_at'),)
 
 	id: int = Column(Integer, primary_key=True)
 	lemmy_id: int = Column(Integer, nullable=False)
@@ -33,12 +79,43 @@ class Community(Base):
 	created: datetime = Column(DateTime, nullable=True, default=datetime.utcnow())
 	enabled: bool = Column(Boolean, nullable=False, server_default='1')
 	sorting: str = Column(String(length=10), nullable=False, server_default='hot')
+	cursor_fullname: str = Column(String(length=16), nullable=True)
+	cursor_etag: str = Column(String, nullable=True)
+	cursor_last_modified: str = Column(String, nullable=True)
+	cursor_moved: datetime = Column(DateTime, nullable=True)
+	# last_scrape + min_interval, kept up to date by the events below so the due query can use an index
+	next_scrape_at: datetime = Column(DateTime, nullable=False, default=EPOCH, server_default=EPOCH.isoformat(' '))
+	# Worker that's currently scraping this community, see utils.leases
+	claimed_by: str = Column(String(length=64), nullable=True)
+	lease_until: datetime = Column(DateTime, nullable=True)
+	# Posts left over from the previous turn, see PendingPosts
+	pending_posts: dict = Column(JSON(none_as_null=True), nullable=True)
 	# Relationship to CommunityStats
 	stats: Mapped['CommunityStats'] = relationship('CommunityStats', uselist=False, backref='community', lazy='select')
 
 	def __str__(self) -> str:
 		return f"{self.ident} path:{self.path}"
 
+	@property
+	def listing_cursor(self) -> ListingCursor:
+		return ListingCursor(fullname=self.cursor_fullname, etag=self.cursor_etag,
+							last_modified=self.cursor_last_modified, moved=self.cursor_moved)
+
+	@listing_cursor.setter
+	def listing_cursor(self, cursor: ListingCursor):
+		self.cursor_fullname = cursor.fullname
+		self.cursor_etag = cursor.etag
+		self.cursor_last_modified = cursor.last_modified
+		self.cursor_moved = cursor.moved
+
+	@property
+	def pending(self) -> Optional[PendingPosts]:
+		return PendingPosts.from_json(self.pending_posts) if self.pending_posts else None
+
+	@pending.setter
+	def pending(self, pending: Optional[PendingPosts]):
+		self.pending_posts = pending.to_json() if pending else None
+
 
 class CommunityStats(Base):
 	"""Metrics for a specific community"""
@@ -50,6 +127,24 @@ class CommunityStats(Base):
 	posts_per_day: int = Column(Integer, nullable=False, default=0)
 	min_interval: int = Column(Integer, nullable=False, default=15)
 	last_update: datetime = Column(DateTime, nullable=False, default=datetime.fromtimestamp(0))
+	arrival_rate: float = Column(Float, nullable=True)  # EWMA of new Reddit posts per hour, None until observed
+
+
+def next_scrape_at(last_scrape: Optional[datetime], min_interval: Optional[int]) -> datetime:
+	if last_scrape is None:
+		return EPOCH
+	return last_scrape + timedelta(minutes=min_interval or 0)
+
+
+@event.listens_for(Community.last_scrape, 'set')
+def _last_scrape_set(community: Community, last_scrape: Optional[datetime], *args):
+	community.next_scrape_at = next_scrape_at(last_scrape, community.stats.min_interval if community.stats else None)
+
+
+@event.listens_for(CommunityStats.min_interval, 'set')
+def _min_interval_set(stats: CommunityStats, min_interval: Optional[int], *args):
+	if stats.community is not None:
+		stats.community.next_scrape_at = next_scrape_at(stats.community.last_scrape, min_interval)
 
 
 @dataclass
@@ -64,31 +159,96 @@ class PostDTO:
 	nsfw: bool = False
 	upvotes: int = 2
 	upvote_ratio: float = 1.0
+	subreddit: Optional[str] = None
+	fullname: Optional[str] = None  # t3_ + base36 id
+	complete: bool = False  # Body, NSFW flag and external link are known, no need to visit the detail page
 
 	def __str__(self) -> str:
 		return f"'{self.title}' at {self.reddit_link} updated: {self.updated}"
 
+	@property
+	def reddit_id(self) -> Optional[str]:
+		return self.fullname or reddit_id_from_link(self.reddit_link)
+
+	def content_hash(self) -> str:
+		"""Fingerprint of the content that's copied to Lemmy, to tell whether the original was edited"""
+		content = '\0'.join([self.title or '', self.body or '', self.external_link or '', str(bool(self.nsfw))])
+		return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+	def to_json(self) -> dict:
+		return {**asdict(self), 'created': self.created.isoformat(), 'updated': self.updated.isoformat()}
+
+	@classmethod
+	def from_json(cls, data: dict) -> 'PostDTO':
+		return cls(**{**data, 'created': datetime.fromisoformat(data['created']),
+					  'updated': datetime.fromisoformat(data['updated'])})
+
 
 class Post(Base):
 	__tablename__: str = 'posts'
+	__table_args__ = (Index('ix_posts_community_id_updated', 'community_id', 'updated'),
+					  Index('ix_posts_next_check_at', 'next_check_at'))
 
 	id: int = Column(Integer, primary_key=True)
 	reddit_link: str = Column(String, nullable=False)
+	reddit_id: str = Column(String(length=16), nullable=True, unique=True, index=True)
 	lemmy_link: str = Column(String, nullable=False)
 	updated: datetime = Column(DateTime, nullable=False)
 	nsfw: bool = Column(Boolean, nullable=False)
 	community_id: int = Column(Integer, ForeignKey('communities.id'), nullable=False)
+	lemmy_id: int = Column(Integer, nullable=True)  # Unknown for posts published before they were watched
+	content_hash: str = Column(String(length=64), nullable=True)  # PostDTO.content_hash of the original
+	check_stage: int = Column(Integer, nullable=True)  # Index into CHECK_AFTER
+	next_check_at: datetime = Column(DateTime, nullable=True)  # None when it's no longer watched
 
 	community: Mapped[Community] = relationship('Community')
 
 	def __str__(self) -> str:
 		return f"'#{self.id}: {self.title}' on {self.community.name}"
 
+	def watch(self, lemmy_id: int, content_hash: str):
+		"""Have the original checked for edits, on the schedule of CHECK_AFTER"""
+		self.lemmy_id = lemmy_id
+		self.content_hash = content_hash
+		self.check_stage = 0
+		self.next_check_at = self.updated + CHECK_AFTER[0]
+
+	def checked(self):
+		"""Move on to the next check, or stop watching after the last one"""
+		self.check_stage += 1
+		self.next_check_at = self.updated + CHECK_AFTER[self.check_stage] \
+			if self.check_stage < len(CHECK_AFTER) else None
+
 	@classmethod
 	def from_dto(cls, post: PostDTO, community: Community) -> 'Post':
 		return cls(
 			reddit_link=post.reddit_link,
+			reddit_id=post.reddit_id,
 			community=community,
 			updated=post.updated,
 			nsfw=post.nsfw
 		)
+
+
+class OutboxPost(Base):
+	"""A prepared post on its way to Lemmy, see utils.outbox"""
+
+	__tablename__: str = 'outbox'
+	__table_args__ = (Index('ix_outbox_community_id_state', 'community_id', 'state'),)
+
+	id: int = Column(Integer, primary_key=True)
+	community_id: int = Column(Integer, ForeignKey('communities.id'), nullable=False)
+	reddit_id: str = Column(String(length=16), nullable=True, unique=True)
+	post: dict = Column(JSON, nullable=False)  # The prepared PostDTO
+	state: str = Column(String(length=16), nullable=False, default=OUTBOX_PENDING)
+	attempts: int = Column(Integer, nullable=False, default=0)
+	next_attempt_at: datetime = Column(DateTime, nullable=True)  # None once it's given up on
+	last_error: str = Column(String, nullable=True)
+	content_hash: str = Column(String(length=64), nullable=True)  # Of the post as it was on Reddit, before preparing
+	created: datetime = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+	community: Mapped[Community] = relationship('Community')
+
+	@property
+	def dto(self) -> PostDTO:
+		return PostDTO.from_json(self.post)
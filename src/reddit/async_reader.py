@@ -0,0 +1,158 @@
+import asyncio
+import threading
+from typing import Dict, List, Optional, Union
+
+import aiohttp
+from requests import HTTPError, Response
+from requests.structures import CaseInsensitiveDict
+
+from models.models import PostDTO, SORT_HOT, CommunityDTO, ListingCursor
+from reddit import USER_AGENT
+from reddit.reader import RedditReader, MULTI_LISTING_LIMIT
+from utils.rate_limit import RateLimitController, TokenBucket
+
+REQUESTS_PER_MINUTE = 20  # Average allowance, shared by all requests in flight
+MAX_IN_FLIGHT = 8  # Maximum amount of simultaneous requests
+
+
+class AsyncRedditReader(RedditReader):
+	"""RedditReader with coroutines instead of blocking methods.
+
+	Keeps up to `max_in_flight` requests running at once, all drawing from the same rate limiter, so throughput is
+	bound by Reddit's allowance rather than by the latency of a single request.
+	"""
+
+	def __init__(self, bucket: TokenBucket = None, max_in_flight: int = MAX_IN_FLIGHT,
+				base_url: str = 'https://old.reddit.com', timeout: float = 30, listing_details: bool = False):
+		super().__init__(base_url=base_url, listing_details=listing_details,
+						rate_limit=RateLimitController(bucket or TokenBucket(rate=REQUESTS_PER_MINUTE / 60)))
+		self._max_in_flight: int = max_in_flight
+		self._timeout = aiohttp.ClientTimeout(total=timeout)
+		self._client: Optional[aiohttp.ClientSession] = None
+		self._in_flight: Optional[asyncio.Semaphore] = None
+
+	async def close(self):
+		if self._client is not None:
+			await self._client.close()
+			self._client = None
+
+	async def _fetch(self, method: str, url: str, client: aiohttp.ClientSession = None, **kwargs) -> Response:
+		"""Do a single throttled request, without any checks on the result. Uses the shared client by default."""
+		if self._client is None:
+			# Created lazily, since both need to be bound to the running event loop
+			self._client = aiohttp.ClientSession(headers={'User-Agent': USER_AGENT}, timeout=self._timeout)
+			self._in_flight = asyncio.Semaphore(self._max_in_flight)
+
+		async with self._in_flight:
+			await self.rate_limit.wait_async()
+			async with (client or self._client).request(method, url, **kwargs) as aio_response:
+				response = self._to_response(aio_response, await aio_response.read())
+		self.rate_limit.update(response)
+		return response
+
+	async def _request(self, method: str, url: str, data: dict = None, allow_recurse=True, allow_retry=True,
+					**kwargs) -> Response:
+		response = await self._fetch(method, url, data=data, **kwargs)
+		if response.status_code == 429 and allow_retry:
+			# The rate limiter makes this one wait for as long as Reddit asked
+			return await self._request(method, url, data, allow_recurse=allow_recurse, allow_retry=False, **kwargs)
+		if 'reddit.com/over18' in response.url:
+			if not allow_recurse:
+				raise RecursionError('Reddit is trying to throw us into an infinite loop :(')
+			response = await self._request('POST', response.url, {'over18': 'yes'}, allow_recurse=False)
+
+		response.raise_for_status()
+		return response
+
+	async def get_subreddit_topics_json(self, subreddit: str, mode: str = SORT_HOT, since=None,
+										cursor: ListingCursor = None) -> List[PostDTO]:
+		"""Get topics from a subreddit through JSON, incrementally when a cursor is given"""
+		response = await self._request('GET', self._listing_url(subreddit, mode), **self._cursor_arguments(mode, cursor))
+		return self._read_listing(response, cursor)
+
+	async def get_multi_subreddit_topics_json(self, subreddits: List[str], mode: str = SORT_HOT) -> Dict[str, List[PostDTO]]:
+		"""Get topics from several subreddits with a single combined listing, grouped by (lowercase) subreddit"""
+		listing = (await self._request('GET', self._listing_url('+'.join(subreddits), mode),
+									params={'limit': MULTI_LISTING_LIMIT})).json()
+		return self._group_by_subreddit(self._parse_listing(listing), subreddits)
+
+	async def get_posts_by_id(self, fullnames: List[str]) -> Dict[str, Optional[PostDTO]]:
+		"""Get the current state of up to MULTI_LISTING_LIMIT posts with a single request, by fullname"""
+		listing = (await self._request('GET', f"{self.base_url}/by_id/{','.join(fullnames)}.json",
+									params={'limit': MULTI_LISTING_LIMIT})).json()
+		return self._parse_by_id(listing)
+
+	async def get_post_details(self, post: PostDTO) -> PostDTO:
+		"""Enrich a PostDTO with all available extra data"""
+		old_url = post.reddit_link.replace('://www', '://old')
+		return self._parse_post_details(post, await self._request('GET', old_url))
+
+	async def get_posts_details(self, posts: List[PostDTO]) -> List[Union[PostDTO, Exception]]:
+		"""Enrich a list of PostDTOs concurrently, returning the exception instead of the post for the failed ones"""
+		return await asyncio.gather(*[self.get_post_details(post) for post in posts], return_exceptions=True)
+
+	async def get_subreddit_info(self, ident: str) -> Optional[CommunityDTO]:
+		try:
+			response = await self._request('GET', f"{self.base_url}/r/{ident}/")
+		except HTTPError as e:
+			self.logger.error(f"Something went wrong trying to get subreddit info: {str(e)}")
+			return None
+
+		if '/subreddits/search' in response.url:
+			self.logger.error(f'Subreddit could not be found')
+			return None
+
+		return self._parse_subreddit_info(ident, response.text, await self.is_sub_nsfw(ident))
+
+	async def is_sub_nsfw(self, ident: str) -> bool:
+		self.logger.debug(f"Running NSFW check on {ident}")
+		# Without cookies: once the over18 prompt was accepted, the shared client isn't asked anymore
+		async with aiohttp.ClientSession(headers={'User-Agent': USER_AGENT}, timeout=self._timeout,
+										cookie_jar=aiohttp.DummyCookieJar()) as client:
+			nsfw_response = await self._fetch('GET', f"{self.base_url}/r/{ident}/", client=client)
+
+		return 'over18' in nsfw_response.url
+
+	@staticmethod
+	def _to_response(aio_response: aiohttp.ClientResponse, content: bytes) -> Response:
+		"""Wrap the result in a requests Response, so callers can treat (and catch) both readers the same way"""
+		response = Response()
+		response.status_code = aio_response.status
+		response.reason = aio_response.reason
+		response.url = str(aio_response.url)
+		response.headers = CaseInsensitiveDict(aio_response.headers)
+		response.encoding = aio_response.charset or 'utf-8'
+		response._content = content
+		return response
+
+
+class BackgroundRedditReader(RedditReader):
+	"""Blocking RedditReader that runs all of its requests through an AsyncRedditReader on a background event loop.
+
+	It can be shared between threads: every caller ends up on the same loop, connection pool and rate limiter.
+	"""
+
+	def __init__(self, reader: AsyncRedditReader = None):
+		self._reader: AsyncRedditReader = reader or AsyncRedditReader()
+		super().__init__(base_url=self._reader.base_url, listing_details=self._reader.listing_details,
+						rate_limit=self._reader.rate_limit)
+		self._loop = asyncio.new_event_loop()
+		self._thread = threading.Thread(target=self._loop.run_forever, name='reddit-reader', daemon=True)
+		self._thread.start()
+
+	def _run(self, coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+	def _request(self, *args, **kwargs) -> Response:
+		return self._run(self._reader._request(*args, **kwargs))
+
+	def get_posts_details(self, posts: List[PostDTO]) -> List[Union[PostDTO, Exception]]:
+		return self._run(self._reader.get_posts_details(posts))
+
+	def is_sub_nsfw(self, ident: str) -> bool:
+		return self._run(self._reader.is_sub_nsfw(ident))
+
+	def close(self):
+		self._run(self._reader.close())
+		self._loop.call_soon_threadsafe(self._loop.stop)
+		self._thread.join()
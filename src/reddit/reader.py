@@ -1,40 +1,45 @@
+import html
 import logging
 import re
-import time
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Union
 
 import feedparser
 import requests
 from bs4 import BeautifulSoup, Tag
 from markdownify import markdownify
-from requests import HTTPError
+from requests import HTTPError, Response
 
-from models.models import PostDTO, SORT_HOT, SORT_NEW, CommunityDTO
+from models.models import PostDTO, SORT_HOT, SORT_NEW, CommunityDTO, ListingCursor
 from reddit import USER_AGENT
 from utils.exceptions import HttpNotFoundException
+from utils.rate_limit import RateLimitController, TokenBucket
 
-_DELAY_TIME = 3  # This many seconds between requests
+_DELAY_TIME = 3  # This many seconds between requests, until Reddit tells us otherwise
+MULTI_LISTING_LIMIT = 100  # Maximum amount of posts Reddit returns for a single (combined) listing
 
 
 class RedditReader:
 	_SUBREDDIT_REGEX = re.compile(r'(.*reddit\.com/|^/?)r/([^/]+).*')
 	_STRIP_EMPTY_REGEX = re.compile(r'\n{3,}')
-	_next_request_after: int  # Updated on requests to reddit to prevent throttling
+	rate_limit: RateLimitController  # Paces requests to reddit to prevent throttling
 
-	def __init__(self):
+	def __init__(self, base_url: str = 'https://old.reddit.com', listing_details: bool = False,
+				rate_limit: RateLimitController = None):
+		self.base_url: str = base_url
+		self.listing_details: bool = listing_details  # Take body, NSFW flag and url from the listing JSON
+		self.rate_limit = rate_limit or RateLimitController(TokenBucket(rate=1 / _DELAY_TIME))
 		self.session = requests.Session()
 		self.session.headers.update({'User-Agent': USER_AGENT})
-		self._next_request_after = 0
 		self.logger: logging.Logger = logging.getLogger(__name__)
 
-	def _request(self, *args, allow_recurse=True, **kwargs):
-		now = time.time()
-		if now < self._next_request_after:
-			self.logger.debug('Delaying next request')
-			time.sleep(self._next_request_after - now)
-		self._next_request_after = int(time.time()) + _DELAY_TIME
+	def _request(self, *args, allow_recurse=True, allow_retry=True, **kwargs):
+		self.rate_limit.wait()
 		response = self.session.request(*args, **kwargs)
+		self.rate_limit.update(response)
+		if response.status_code == 429 and allow_retry:
+			# The rate limiter makes this one wait for as long as Reddit asked
+			return self._request(*args, allow_recurse=allow_recurse, allow_retry=False, **kwargs)
 		if 'reddit.com/over18' in response.url:
 			if not allow_recurse:
 				raise RecursionError('Reddit is trying to throw us into an infinite loop :(')
@@ -62,37 +67,180 @@ class RedditReader:
 									author=author, upvote_ratio=1.0))
 		return posts
 
-	def get_subreddit_topics_json(self, subreddit: str, mode: str = SORT_HOT, since: datetime = None) -> List[PostDTO]:
-		"""Get topics from a subreddit through JSON"""
-		if mode == SORT_NEW:
-			feed_url = f"https://old.reddit.com/r/{subreddit}/new/.json?sort=new"
-		else:
-			feed_url = f"https://old.reddit.com/r/{subreddit}/.json"
+	def get_subreddit_topics_json(self, subreddit: str, mode: str = SORT_HOT, since: datetime = None,
+								cursor: ListingCursor = None) -> List[PostDTO]:
+		"""Get topics from a subreddit through JSON.
 
-		posts = []
-		response = self._request('GET', feed_url).json();
-		for entry in response.get('data', {}).get('children', {}):
-			data = entry.get('data', [])
-			posts.append(PostDTO(
-				reddit_link='https://old.reddit.com' + data.get('permalink'),
-				title=data.get('title'),
-				created=datetime.fromtimestamp(data.get('created_utc')),
-				updated=datetime.fromtimestamp(data.get('created_utc')),
-				author='/u/' + data.get('author'),
-				external_link=data.get('url', None),
-				nsfw=data.get('over_18', None),
-				upvotes=data.get('ups', 1),
-				upvote_ratio=data.get('upvote_ratio', 0.5)
-			))
-		return posts
+		With a cursor, only what changed since the previous fetch is requested, and the cursor's validators are
+		updated from the response. An unchanged listing returns no posts at all.
+		"""
+		response = self._request('GET', self._listing_url(subreddit, mode), **self._cursor_arguments(mode, cursor))
+		return self._read_listing(response, cursor)
+
+	def get_multi_subreddit_topics_json(self, subreddits: List[str], mode: str = SORT_HOT) -> Dict[str, List[PostDTO]]:
+		"""Get topics from several subreddits with a single combined listing, grouped by (lowercase) subreddit"""
+		listing = self._request('GET', self._listing_url('+'.join(subreddits), mode),
+								params={'limit': MULTI_LISTING_LIMIT}).json()
+		return self._group_by_subreddit(self._parse_listing(listing), subreddits)
+
+	def get_posts_by_id(self, fullnames: List[str]) -> Dict[str, Optional[PostDTO]]:
+		"""Get the current state of up to MULTI_LISTING_LIMIT posts with a single request, by fullname.
+
+		Posts that were removed or deleted map to None, posts Reddit doesn't return at all are left out.
+		"""
+		listing = self._request('GET', f"{self.base_url}/by_id/{','.join(fullnames)}.json",
+								params={'limit': MULTI_LISTING_LIMIT}).json()
+		return self._parse_by_id(listing)
 
 	def get_post_details(self, post: PostDTO) -> PostDTO:
 		"""Enrich a PostDTO with all available extra data"""
 		old_url = post.reddit_link.replace('://www', '://old')
-		response = self._request('GET', old_url)
+		return self._parse_post_details(post, self._request('GET', old_url))
+
+	def get_posts_details(self, posts: List[PostDTO]) -> List[Union[PostDTO, Exception]]:
+		"""Enrich a list of PostDTOs, returning the exception instead of the post for the ones that failed.
+
+		Stops at the first failure that isn't a 404, since the next requests will most likely fail as well.
+		"""
+		results = []
+		for post in posts:
+			try:
+				results.append(self.get_post_details(post))
+			except HttpNotFoundException as e:
+				results.append(e)
+			except Exception as e:
+				results.append(e)
+				break
+		return results
+
+	def get_subreddit_info(self, ident: str) -> Optional[CommunityDTO]:
+		sub_url = f"{self.base_url}/r/{ident}/"
+		try:
+			response = self._request('GET', sub_url)
+		except HTTPError as e:
+			self.logger.error(f"Something went wrong trying to get subreddit info: {str(e)}")
+			return None
+
+		if '/subreddits/search' in response.url:
+			self.logger.error(f'Subreddit could not be found')
+			return None
+
+		return self._parse_subreddit_info(ident, response.text, self.is_sub_nsfw(ident))
+
+	@classmethod
+	def get_subreddit_ident(cls, link: str) -> str:
+		"""Extract the subreddit string from a path post"""
+		match = cls._SUBREDDIT_REGEX.search(link)
+		if match:
+			return match.group(2)
+		else:
+			raise ValueError(f"No subreddit found in {link}")
+
+	def _listing_url(self, subreddit: str, mode: str) -> str:
+		if mode == SORT_NEW:
+			return f"{self.base_url}/r/{subreddit}/new/.json?sort=new"
+		return f"{self.base_url}/r/{subreddit}/.json"
+
+	@staticmethod
+	def _cursor_arguments(mode: str, cursor: Optional[ListingCursor]) -> dict:
+		"""Request arguments for a conditional (and for /new, incremental) listing request"""
+		if cursor is None:
+			return {}
+
+		headers = {}
+		if cursor.etag:
+			headers['If-None-Match'] = cursor.etag
+		if cursor.last_modified:
+			headers['If-Modified-Since'] = cursor.last_modified
+
+		# Only /new is ordered chronologically, so that's the only listing where `before` makes sense
+		params = {}
+		if mode == SORT_NEW and cursor.fullname:
+			params = {'before': cursor.fullname, 'limit': MULTI_LISTING_LIMIT}
+
+		return {'headers': headers, 'params': params}
+
+	def _read_listing(self, response: Response, cursor: Optional[ListingCursor]) -> List[PostDTO]:
+		if cursor is not None:
+			if response.status_code == 304:
+				self.logger.debug('Listing has not been modified')
+				return []
+			cursor.etag = response.headers.get('ETag')
+			cursor.last_modified = response.headers.get('Last-Modified')
 
+		return self._parse_listing(response.json())
+
+	@staticmethod
+	def _group_by_subreddit(posts: List[PostDTO], subreddits: List[str]) -> Dict[str, List[PostDTO]]:
+		grouped = {subreddit.lower(): [] for subreddit in subreddits}
+		for post in posts:
+			grouped.setdefault(post.subreddit.lower(), []).append(post)
+		return grouped
+
+	def _parse_listing(self, listing: dict) -> List[PostDTO]:
+		"""Turn a JSON listing into PostDTOs"""
+		return [self._parse_listing_entry(entry.get('data', []), self.listing_details)
+				for entry in listing.get('data', {}).get('children', {})]
+
+	def _parse_by_id(self, listing: dict) -> Dict[str, Optional[PostDTO]]:
+		"""Turn a /by_id listing into complete PostDTOs by fullname, None for the posts that are gone"""
+		posts = {}
+		for entry in listing.get('data', {}).get('children', {}):
+			data = entry.get('data', {})
+			posts[data.get('name')] = None if self._is_removed(data) else self._parse_listing_entry(data, True)
+		return posts
+
+	@staticmethod
+	def _is_removed(data: dict) -> bool:
+		"""Removed by the moderators (or admins), or deleted by its author. A deleted account leaves the post alone."""
+		return bool(data.get('removed_by_category')) or data.get('selftext') in ('[removed]', '[deleted]')
+
+	def _parse_listing_entry(self, data: dict, details: bool) -> PostDTO:
+		post = PostDTO(
+			reddit_link='https://old.reddit.com' + data.get('permalink'),
+			title=data.get('title'),
+			created=datetime.fromtimestamp(data.get('created_utc')),
+			updated=datetime.fromtimestamp(data.get('created_utc')),
+			author='/u/' + data.get('author'),
+			external_link=data.get('url', None),
+			nsfw=data.get('over_18', None),
+			upvotes=data.get('ups', 1),
+			upvote_ratio=data.get('upvote_ratio', 0.5),
+			subreddit=data.get('subreddit'),
+			fullname=data.get('name')
+		)
+		if details:
+			self._parse_listing_details(post, data)
+		return post
+
+	def _parse_listing_details(self, post: PostDTO, data: dict) -> PostDTO:
+		"""Fill a PostDTO with the listing data the detail page would otherwise provide.
+
+		The post is only marked complete when every field is present, otherwise the detail page is still needed.
+		"""
+		if 'over_18' not in data or 'is_self' not in data:
+			return post
+
+		if data['is_self'] and data.get('selftext'):
+			if not data.get('selftext_html'):
+				return post
+			soup = BeautifulSoup(html.unescape(data['selftext_html']), "html.parser")
+			post.body = self._html_node_to_markdown(soup.select_one('.md') or soup)
+		else:
+			post.body = None
+
+		url = data.get('url')
+		post.external_link = None if data['is_self'] or not url or url.startswith('/r/') else url
+		post.nsfw = bool(data['over_18'])
+		post.complete = True
+
+		return post
+
+	def _parse_post_details(self, post: PostDTO, response: Response) -> PostDTO:
+		"""Fill a PostDTO with the data from its (old reddit) detail page"""
 		if response.status_code == 404:
-			raise HttpNotFoundException(f"Couldn't find post on {old_url}", response=response, request=response.request)
+			raise HttpNotFoundException(f"Couldn't find post on {response.url}", response=response,
+										request=response.request)
 		if response.status_code != 200:
 			raise HTTPError(f"Couldn't retrieve post detail page: {response.status_code}")
 
@@ -109,19 +257,10 @@ class RedditReader:
 
 		return post
 
-	def get_subreddit_info(self, ident: str) -> Optional[CommunityDTO]:
-		sub_url = f"https://old.reddit.com/r/{ident}/"
-		try:
-			response = self._request('GET', sub_url)
-		except HTTPError as e:
-			self.logger.error(f"Something went wrong trying to get subreddit info: {str(e)}")
-			return None
-
-		if '/subreddits/search' in response.url:
-			self.logger.error(f'Subreddit could not be found')
-			return None
-
-		soup = BeautifulSoup(response.text, "html.parser")
+	@staticmethod
+	def _parse_subreddit_info(ident: str, html: str, nsfw: bool) -> CommunityDTO:
+		"""Extract the community details from the front page of a subreddit"""
+		soup = BeautifulSoup(html, "html.parser")
 
 		icon_elm = soup.select_one('img#header-img[src]')
 		if icon_elm:
@@ -133,19 +272,9 @@ class RedditReader:
 
 		title = soup.select_one('head>title').text
 		description = soup.select_one('head>meta[name="description"][content]')['content']
-		nsfw = self.is_sub_nsfw(ident)
 
 		return CommunityDTO(ident=ident, title=title, description=description, icon=icon, nsfw=nsfw)
 
-	@classmethod
-	def get_subreddit_ident(cls, link: str) -> str:
-		"""Extract the subreddit string from a path post"""
-		match = cls._SUBREDDIT_REGEX.search(link)
-		if match:
-			return match.group(2)
-		else:
-			raise ValueError(f"No subreddit found in {link}")
-
 	def _html_node_to_markdown(self, source: Tag) -> Optional[str]:
 		"""Convert the contents of a BeautifulSoup Tag into markdown"""
 		# Make all links absolute
@@ -7,3 +7,7 @@ class SubredditRequestException(Exception):
 
 class HttpNotFoundException(HTTPError):
     """More specific that HttpError"""
+
+
+class PublishTimeoutException(HTTPError):
+    """Lemmy's gateway gave up on a new post, which may or may not have been created after all"""
@@ -0,0 +1,88 @@
+import logging
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import or_, update
+from sqlalchemy.orm import Session as DbSession, selectinload
+from sqlalchemy.sql.elements import ColumnElement
+
+from models.models import Community
+
+LEASE_DURATION = timedelta(minutes=30)  # Longer than a scrape could ever take, a dead worker's leases expire after this
+
+logger = logging.getLogger(__name__)
+
+
+class CommunityLeases:
+    """Lets several workers split the communities between them, by claiming due ones for a while.
+
+    On Postgres, due communities are locked with FOR UPDATE SKIP LOCKED while claiming, so concurrent workers each
+    get different ones. Elsewhere (SQLite), every claim is a conditional UPDATE that only succeeds when nobody else
+    holds a lease, which is just as safe, only a bit chattier.
+    """
+
+    def __init__(self, worker_id: str, duration: timedelta = LEASE_DURATION):
+        self.worker_id: str = worker_id
+        self.duration: timedelta = duration
+
+    @staticmethod
+    def available(now: datetime) -> ColumnElement:
+        """Condition for communities nobody holds a (live) lease on"""
+        return or_(Community.lease_until.is_(None), Community.lease_until < now)
+
+    def claim_due(self, db: DbSession, limit: int) -> List[Community]:
+        """Claim up to `limit` due communities, most overdue first"""
+        now = datetime.utcnow()
+        due = db.query(Community.id) \
+            .filter(Community.enabled.is_(True), Community.next_scrape_at <= now, self.available(now)) \
+            .order_by(Community.next_scrape_at) \
+            .limit(limit)
+
+        if db.get_bind().dialect.name == 'postgresql':
+            claimed = [row[0] for row in due.with_for_update(skip_locked=True).all()]
+            if claimed:
+                db.execute(update(Community).where(Community.id.in_(claimed))
+                           .values(claimed_by=self.worker_id, lease_until=now + self.duration))
+        else:
+            claimed = []
+            for community_id in [row[0] for row in due.all()]:
+                result = db.execute(
+                    update(Community)
+                    .where(Community.id == community_id, self.available(now))
+                    .values(claimed_by=self.worker_id, lease_until=now + self.duration)
+                )
+                if result.rowcount == 1:
+                    claimed.append(community_id)
+        db.commit()
+
+        if not claimed:
+            return []
+        return db.query(Community).options(selectinload(Community.stats)) \
+            .filter(Community.id.in_(claimed)).order_by(Community.next_scrape_at).all()
+
+    def renew(self, db: DbSession, community_id: int) -> bool:
+        """Extend a lease, returns False when it's no longer ours (and the community shouldn't be touched)"""
+        now = datetime.utcnow()
+        result = db.execute(
+            update(Community)
+            .where(Community.id == community_id, Community.claimed_by == self.worker_id, Community.lease_until >= now)
+            .values(lease_until=now + self.duration)
+        )
+        db.commit()
+        if result.rowcount != 1:
+            logger.warning(f"Lost the lease on community #{community_id}")
+        return result.rowcount == 1
+
+    def release(self, db: DbSession, community_id: int):
+        db.execute(
+            update(Community)
+            .where(Community.id == community_id, Community.claimed_by == self.worker_id)
+            .values(claimed_by=None, lease_until=None)
+        )
+        db.commit()
+
+    def release_all(self, db: DbSession):
+        """Hand back everything this worker holds, when shutting down"""
+        db.execute(update(Community).where(Community.claimed_by == self.worker_id)
+                   .values(claimed_by=None, lease_until=None))
+        db.commit()
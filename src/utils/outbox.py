@@ -0,0 +1,144 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session as DbSession
+
+from models.models import Community, OutboxPost, Post, PostDTO, OUTBOX_PENDING, OUTBOX_PUBLISHING, \
+    OUTBOX_PUBLISHED, OUTBOX_FAILED, OUTBOX_UNCERTAIN
+
+MAX_ATTEMPTS = 6  # Give up on a post after this many failed publishes
+RETRY_DELAY = timedelta(minutes=5)  # Doubled after every failed attempt
+RETENTION = timedelta(days=1)  # Published entries are kept this long
+PURGE_INTERVAL = timedelta(hours=1)
+SETTLE_DELAY = timedelta(minutes=2)  # Give Lemmy time to finish a post that timed out, before looking for it
+ABANDONED_AFTER = timedelta(minutes=30)  # Longer than a publish could ever take, the worker that started it is gone
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """Prepared posts waiting to be published to Lemmy, so a post never has to be fetched from Reddit twice.
+
+    Entries go from pending to publishing to published. A failed publish is retried with an exponential backoff, on
+    the community's next turn, until MAX_ATTEMPTS is reached. A publish that timed out is uncertain, until the
+    reconciler finds out whether it made it. So is one that's still publishing after ABANDONED_AFTER. Apart from
+    `recover` and `purge`, committing is up to the caller.
+    """
+
+    def __init__(self, db: DbSession):
+        self._db: DbSession = db
+        self.purged_at: Optional[datetime] = None
+
+    def add(self, community: Community, posts: List[PostDTO], content_hashes: Dict[str, str] = None):
+        """Queue prepared posts, skipping the ones that are queued already.
+
+        The content hashes of the originals, by reddit_id, are passed on to the watcher once a post is published.
+        """
+        reddit_ids = [post.reddit_id for post in posts if post.reddit_id]
+        queued = {row[0] for row in self._db.query(OutboxPost.reddit_id).filter(OutboxPost.reddit_id.in_(reddit_ids))}
+        now = datetime.utcnow()
+        for post in posts:
+            if post.reddit_id in queued:
+                continue
+            self._db.add(OutboxPost(community=community, reddit_id=post.reddit_id, post=post.to_json(),
+                                    state=OUTBOX_PENDING, attempts=0, next_attempt_at=now,
+                                    content_hash=(content_hashes or {}).get(post.reddit_id)))
+        self._db.flush()
+
+    def due(self, community_id: int) -> List[OutboxPost]:
+        """Entries of a community to publish now, oldest first"""
+        return self._db.query(OutboxPost) \
+            .filter(OutboxPost.community_id == community_id,
+                    OutboxPost.state.in_([OUTBOX_PENDING, OUTBOX_FAILED]),
+                    OutboxPost.next_attempt_at <= datetime.utcnow()) \
+            .order_by(OutboxPost.id).all()
+
+    def waiting(self, community_id: int) -> int:
+        """Amount of entries of a community that haven't had their first try yet"""
+        return self._db.query(func.count(OutboxPost.id)) \
+            .filter(OutboxPost.community_id == community_id, OutboxPost.state == OUTBOX_PENDING).scalar()
+
+    @staticmethod
+    def start(entry: OutboxPost):
+        entry.state = OUTBOX_PUBLISHING
+        entry.attempts += 1
+        entry.next_attempt_at = datetime.utcnow() + ABANDONED_AFTER
+
+    @staticmethod
+    def published(entry: OutboxPost):
+        entry.state = OUTBOX_PUBLISHED
+        entry.next_attempt_at = None
+
+    @staticmethod
+    def failed(entry: OutboxPost, error: str):
+        entry.state = OUTBOX_FAILED
+        entry.last_error = error
+        if entry.attempts >= MAX_ATTEMPTS:
+            logger.error(f"Giving up on {entry.reddit_id} after {entry.attempts} attempts: {error}")
+            entry.next_attempt_at = None
+        else:
+            entry.next_attempt_at = datetime.utcnow() + RETRY_DELAY * 2 ** (entry.attempts - 1)
+
+    @staticmethod
+    def uncertain(entry: OutboxPost):
+        """Lemmy timed out, next_attempt_at is when to go and look for it"""
+        entry.state = OUTBOX_UNCERTAIN
+        entry.next_attempt_at = datetime.utcnow() + SETTLE_DELAY
+
+    def settled(self) -> List[OutboxPost]:
+        """Uncertain entries that Lemmy has had time enough to finish, and publishes that were abandoned"""
+        return self._db.query(OutboxPost) \
+            .filter(OutboxPost.state.in_([OUTBOX_UNCERTAIN, OUTBOX_PUBLISHING]),
+                    OutboxPost.next_attempt_at <= datetime.utcnow()) \
+            .order_by(OutboxPost.id).all()
+
+    @staticmethod
+    def attempted_at(entry: OutboxPost) -> datetime:
+        """When a settled entry was published, give or take"""
+        return entry.next_attempt_at - (ABANDONED_AFTER if entry.state == OUTBOX_PUBLISHING else SETTLE_DELAY)
+
+    @staticmethod
+    def requeue(entry: OutboxPost):
+        """It didn't make it after all, try again"""
+        if entry.attempts >= MAX_ATTEMPTS:
+            Outbox.failed(entry, 'Timed out')
+            return
+        entry.state = OUTBOX_PENDING
+        entry.next_attempt_at = datetime.utcnow()
+
+    def recover(self, exclusive: bool = True) -> int:
+        """Sort out the entries a crash left behind, returns how many need publishing (again).
+
+        Entries that made it into the posts table (through the publish journal) are published. The ones that were
+        being published, but didn't, are pending again. Unless other workers share the outbox: those entries may be
+        theirs, or ours from a publish that made it to Lemmy but not into the journal. They're left to the reconciler.
+        """
+        unfinished = self._db.query(OutboxPost).filter(OutboxPost.state != OUTBOX_PUBLISHED).all()
+        reddit_ids = [entry.reddit_id for entry in unfinished if entry.reddit_id]
+        posted = {row[0] for row in self._db.query(Post.reddit_id).filter(Post.reddit_id.in_(reddit_ids))}
+        for entry in unfinished:
+            if entry.reddit_id in posted:
+                self.published(entry)
+            elif entry.state == OUTBOX_PUBLISHING and exclusive:
+                entry.state = OUTBOX_PENDING
+                entry.next_attempt_at = datetime.utcnow()
+        self._db.commit()
+        return len([entry for entry in unfinished if entry.state != OUTBOX_PUBLISHED])
+
+    def purge(self) -> int:
+        """Delete the entries that were published a while ago. The ones that were given up on stay, for inspection."""
+        result = self._db.query(OutboxPost) \
+            .filter(OutboxPost.state == OUTBOX_PUBLISHED, OutboxPost.created < datetime.utcnow() - RETENTION) \
+            .delete(synchronize_session=False)
+        self._db.commit()
+        self.purged_at = datetime.utcnow()
+        return result
+
+    def next_purge(self) -> datetime:
+        """When purge is due again, right away if it hasn't run yet."""
+        if self.purged_at is None:
+            return datetime.utcnow()
+        return self.purged_at + PURGE_INTERVAL
+
@@ -0,0 +1,198 @@
+import logging
+import queue
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Set
+
+from requests import HTTPError
+from sqlalchemy import func
+from sqlalchemy.orm import Session as DbSession, sessionmaker, joinedload
+
+from lemmy.api import LemmyAPI
+from models.models import Community, PostDTO
+from reddit.reader import RedditReader
+from utils.leases import CommunityLeases
+from utils.syncer import Syncer
+from utils.unit_of_work import PublishJournal, UnitOfWork
+
+LISTING_WORKERS = 2
+ENRICH_WORKERS = 2
+PUBLISH_WORKERS = 2
+QUEUE_SIZE = 4  # Communities waiting in front of each stage, a full queue holds up the stage before it
+POLL_INTERVAL = 0.5  # Seconds between checks on whether to stop, while waiting for work
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ScrapeTask:
+    """A community on its way through the pipeline. Only plain data, every stage has its own database session."""
+    community_id: int
+    ident: str
+    sorting: str
+    batch: List[PostDTO] = field(default_factory=list)  # Pending posts to handle this turn
+    posts: List[PostDTO] = field(default_factory=list)  # The ones that made it through enrichment
+    complete: bool = True  # All posts of the batch made it through enrichment
+
+
+class Pipeline:
+    """Scrapes communities in three stages, each with its own worker pool: listing, enrichment and publishing.
+
+    Bounded queues between the stages provide backpressure, so a slow Lemmy holds up Reddit fetching only once its
+    queue is full, and the other way round. A community stays in flight (and won't be submitted again) until it's
+    published, or dropped because of an error.
+    """
+
+    def __init__(self, session_factory: sessionmaker, db: DbSession, reddit_reader: RedditReader, lemmy: LemmyAPI,
+                 thresh_upvotes: int, thresh_ratio: float, listing_workers: int = LISTING_WORKERS,
+                 enrich_workers: int = ENRICH_WORKERS, publish_workers: int = PUBLISH_WORKERS,
+                 queue_size: int = QUEUE_SIZE, on_done: Callable[[], None] = None, leases: CommunityLeases = None,
+                 journal_path: str = None, max_posts: int = None, time_budget: timedelta = None):
+        self._session_factory: sessionmaker = session_factory
+        self._db: DbSession = db  # Only used from the thread that submits
+        self._reddit_reader: RedditReader = reddit_reader
+        self._lemmy: LemmyAPI = lemmy
+        self._syncer_args = {'thresh_upvotes': thresh_upvotes, 'thresh_ratio': thresh_ratio, 'max_posts': max_posts,
+                             'time_budget': time_budget}
+        self._on_done: Optional[Callable[[], None]] = on_done
+        self._leases: Optional[CommunityLeases] = leases
+        self._journal_path: Optional[str] = journal_path  # Every publishing thread gets a journal of its own
+        self._listing: queue.Queue[ScrapeTask] = queue.Queue(maxsize=queue_size)
+        self._enrich: queue.Queue[ScrapeTask] = queue.Queue(maxsize=queue_size)
+        self._publish: queue.Queue[ScrapeTask] = queue.Queue(maxsize=queue_size)
+        self._in_flight: Set[int] = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        for name, count, source, target in [('listing', listing_workers, self._listing, self._list),
+                                            ('enrich', enrich_workers, self._enrich, self._enrich_posts),
+                                            ('publish', publish_workers, self._publish, self._publish_posts)]:
+            for i in range(count):
+                self._threads.append(threading.Thread(target=self._work, args=(source, target), name=f'{name}-{i}',
+                                                      daemon=True))
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop after the tasks that are being worked on, anything still queued is picked up again next time"""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+
+    @property
+    def in_flight(self) -> Set[int]:
+        with self._lock:
+            return set(self._in_flight)
+
+    def submit_due(self) -> int:
+        """Queue as many due communities as the listing stage has room for, returns the amount queued"""
+        room = self._listing.maxsize - self._listing.qsize()
+        if room <= 0:
+            return 0
+
+        if self._leases:
+            # Our own leases keep the ones in flight out as well
+            communities = self._leases.claim_due(self._db, room)
+        else:
+            query = self._db.query(Community) \
+                .filter(Community.enabled.is_(True), Community.next_scrape_at <= datetime.utcnow())
+            in_flight = self.in_flight
+            if in_flight:
+                query = query.filter(Community.id.not_in(in_flight))
+            communities = query.order_by(Community.next_scrape_at).limit(room).all()
+
+        for community in communities:
+            with self._lock:
+                self._in_flight.add(community.id)
+            self._listing.put(ScrapeTask(community_id=community.id, ident=community.ident, sorting=community.sorting))
+        return len(communities)
+
+    def next_due(self) -> Optional[datetime]:
+        """When the next community that isn't in flight is due"""
+        query = self._db.query(func.min(Community.next_scrape_at)).filter(Community.enabled.is_(True))
+        in_flight = self.in_flight
+        if in_flight:
+            query = query.filter(Community.id.not_in(in_flight))
+        if self._leases:
+            query = query.filter(self._leases.available(datetime.utcnow()))
+        return query.scalar()
+
+    def _work(self, source: queue.Queue, target: Callable[[Syncer, DbSession, ScrapeTask], None]):
+        """Worker loop, with a Syncer (and database session) of its own"""
+        db = self._session_factory()
+        journal = None
+        if self._journal_path:
+            journal = PublishJournal(f'{self._journal_path}.{threading.current_thread().name}')
+        syncer = Syncer(db=db, reddit_reader=self._reddit_reader, lemmy=self._lemmy,
+                        unit_of_work=UnitOfWork(db, journal, shared=self._leases is not None), **self._syncer_args)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    task = source.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                try:
+                    target(syncer, db, task)
+                except Exception as e:
+                    logger.exception(f"Error handling {task.ident} in {threading.current_thread().name}: {str(e)}")
+                    db.rollback()
+                    self._done(db, task)
+        finally:
+            db.close()
+
+    def _put(self, db: DbSession, destination: queue.Queue, task: ScrapeTask):
+        """Wait for room in the next stage, giving up when stopping"""
+        while not self._stopping.is_set():
+            try:
+                destination.put(task, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+        self._done(db, task)
+
+    def _list(self, syncer: Syncer, db: DbSession, task: ScrapeTask):
+        community = db.get(Community, task.community_id)
+        if community.pending is None:
+            logger.info(f'Scraping subreddit: {community.ident}')
+            cursor = syncer.prepare_cursor(community)
+            try:
+                listed = self._reddit_reader.get_subreddit_topics_json(community.ident, mode=community.sorting,
+                                                                       cursor=cursor)
+            except HTTPError as e:
+                syncer.handle_listing_error(community, e)
+                self._done(db, task)
+                return
+            syncer.queue_posts(community, listed, cursor)
+            syncer.commit()
+        else:
+            logger.info(f'Resuming {community.ident}, {len(community.pending.posts)} posts pending')
+
+        task.batch = syncer.pending_batch(community)
+        db.rollback()  # Don't keep a transaction open while waiting for the next stage
+        self._put(db, self._enrich, task)
+
+    def _enrich_posts(self, syncer: Syncer, db: DbSession, task: ScrapeTask):
+        task.posts, task.complete = syncer.enrich_posts(task.batch, syncer.deadline())
+        self._put(db, self._publish, task)
+
+    def _publish_posts(self, syncer: Syncer, db: DbSession, task: ScrapeTask):
+        if self._leases and not self._leases.renew(db, task.community_id):
+            # Another worker took over, it'll publish these itself
+            self._done(db, task)
+            return
+        community = db.get(Community, task.community_id, options=[joinedload(Community.stats)])
+        syncer.stage_posts(community, task.posts)
+        syncer.publish_outbox(community, syncer.deadline())
+        syncer.settle_pending(community, task.batch, task.posts, task.complete)
+        self._done(db, task)
+
+    def _done(self, db: DbSession, task: ScrapeTask):
+        if self._leases:
+            self._leases.release(db, task.community_id)
+        with self._lock:
+            self._in_flight.discard(task.community_id)
+        if self._on_done is not None:
+            self._on_done()
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from requests import Response
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket, shared by everything that draws from the same remote allowance"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self._lock = threading.Lock()
+        self._rate: float = rate  # Tokens added per second
+        self._capacity: float = capacity
+        self._tokens: float = capacity
+        self._updated: float = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill()
+            self._rate = rate
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take tokens from the bucket, returns the amount of seconds the caller has to wait before using them"""
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+    def acquire(self, tokens: float = 1.0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, tokens: float = 1.0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+
+@dataclass
+class RateLimitBudget:
+    remaining: Optional[float]  # Requests left in the current window, None when unknown
+    reset_in: Optional[float]  # Seconds until the window resets, None when unknown
+    rate: float  # Requests per second the limiter currently allows
+    paused_for: float  # Seconds until requests are allowed again after a 429 or an exhausted window
+
+
+def retry_after(response: Response, default: float) -> float:
+    """Seconds to wait according to the Retry-After header, which is either a delay or an HTTP date"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class RateLimitController:
+    """Paces requests through a TokenBucket, adjusting its rate to the X-Ratelimit-* headers of every response.
+
+    The remaining allowance is spread evenly over the rest of the window, keeping `reserve` requests in hand. A 429
+    or an exhausted window pauses all requests until the server says they're welcome again.
+    """
+
+    def __init__(self, bucket: TokenBucket, reserve: float = 2, default_retry_after: float = 60):
+        self.bucket: TokenBucket = bucket
+        self._reserve: float = reserve
+        self._default_retry_after: float = default_retry_after
+        self._lock = threading.Lock()
+        self._remaining: Optional[float] = None
+        self._reset_at: Optional[float] = None
+        self._paused_until: float = 0.0
+
+    def delay(self) -> float:
+        """Reserve a request, returns the amount of seconds to wait before doing it"""
+        with self._lock:
+            paused_for = max(self._paused_until - time.monotonic(), 0.0)
+        return paused_for + self.bucket.reserve()
+
+    def wait(self):
+        delay = self.delay()
+        if delay > 0:
+            logger.debug(f'Delaying next request by {delay:.1f}s')
+            time.sleep(delay)
+
+    async def wait_async(self):
+        delay = self.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def update(self, response: Response):
+        """Adjust the pacing to what the server reported"""
+        now = time.monotonic()
+        with self._lock:
+            remaining = self._header(response, 'X-Ratelimit-Remaining')
+            reset = self._header(response, 'X-Ratelimit-Reset')
+            if remaining is not None and reset is not None:
+                self._remaining = remaining
+                self._reset_at = now + reset
+                if remaining <= self._reserve:
+                    self._paused_until = max(self._paused_until, now + reset)
+                elif reset > 0:
+                    self.bucket.set_rate((remaining - self._reserve) / reset)
+
+            if response.status_code == 429:
+                wait = retry_after(response, reset if reset is not None else self._default_retry_after)
+                logger.warning(f'Rate limited, pausing requests for {wait:.0f}s')
+                self._paused_until = max(self._paused_until, now + wait)
+
+    def budget(self) -> RateLimitBudget:
+        now = time.monotonic()
+        with self._lock:
+            reset_in = max(self._reset_at - now, 0.0) if self._reset_at is not None else None
+            remaining = self._remaining if reset_in else None  # Unknown once the window has passed
+            return RateLimitBudget(remaining=remaining, reset_in=reset_in, rate=self.bucket.rate,
+                                   paused_for=max(self._paused_until - now, 0.0))
+
+    @staticmethod
+    def _header(response: Response, name: str) -> Optional[float]:
+        try:
+            return float(response.headers[name])
+        except (KeyError, TypeError, ValueError):
+            return None
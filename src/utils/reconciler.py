@@ -0,0 +1,131 @@
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session as DbSession
+
+from lemmy.api import LemmyAPI
+from models.models import Community, OutboxPost, Post
+from utils.outbox import Outbox
+
+PAGE_SIZE = 50
+MAX_PAGES = 20  # Per community and sweep, posts older than that are left alone
+MARGIN = timedelta(minutes=1)  # Clock differences between us and Lemmy
+RECONCILE_INTERVAL = timedelta(minutes=5)
+# What older versions stored as lemmy_link after a time-out
+PLACEHOLDER_PREFIX = 'https://some.post.in/'
+
+logger = logging.getLogger(__name__)
+
+
+class Reconciler:
+    """Finds out what became of the publishes that timed out at Lemmy's gateway.
+
+    Lemmy often finishes creating a post after its gateway gave up. Retrying blindly would create a duplicate, so
+    uncertain publishes are looked up instead, with one sweep through the newest posts of each community. The same
+    goes for publishes that a worker started, but never finished. A post is
+    recognised by the Reddit link in its body, or by its URL and title. When it's there, it's saved like any other;
+    when it isn't, it's queued to publish again. Posts that older versions saved with a placeholder link are fixed
+    the same way, or deleted when they never made it. There won't be any new ones of those, so they're only looked
+    for once.
+    """
+
+    def __init__(self, db: DbSession, lemmy: LemmyAPI):
+        self._db: DbSession = db
+        self._lemmy: LemmyAPI = lemmy
+        self._outbox: Outbox = Outbox(db)
+        self._placeholders_checked: bool = False
+
+    def reconcile(self) -> int:
+        """Sweep every community with uncertain publishes, returns how many were settled"""
+        uncertain: Dict[int, List[OutboxPost]] = defaultdict(list)
+        for entry in self._outbox.settled():
+            uncertain[entry.community_id].append(entry)
+        placeholders: Dict[int, List[Post]] = defaultdict(list)
+        if not self._placeholders_checked:
+            for post in self._db.query(Post).filter(Post.lemmy_link.startswith(PLACEHOLDER_PREFIX)).all():
+                placeholders[post.community_id].append(post)
+            self._placeholders_checked = True
+
+        settled = 0
+        for community_id in set(uncertain) | set(placeholders):
+            community = self._db.get(Community, community_id)
+            try:
+                settled += self.reconcile_community(community, uncertain[community_id], placeholders[community_id])
+            except Exception as e:
+                logger.error(f"Couldn't reconcile {community.ident}: {str(e)}")
+                self._db.rollback()
+        return settled
+
+    def reconcile_community(self, community: Community, entries: List[OutboxPost], placeholders: List[Post]) -> int:
+        since = min([Outbox.attempted_at(entry) for entry in entries] +
+                    [post.updated for post in placeholders]) - MARGIN
+        lemmy_posts, complete = self.sweep(community, since)
+
+        settled = 0
+        for entry in entries:
+            post = entry.dto
+            found = self.find(lemmy_posts, post.reddit_link, post.external_link, post.title)
+            if found:
+                logger.info(f"{post.reddit_link} made it to Lemmy after all, as {found['ap_id']}")
+                db_post = Post(reddit_link=post.reddit_link, reddit_id=post.reddit_id, lemmy_link=found['ap_id'],
+                               community=community, updated=datetime.utcnow(), nsfw=post.nsfw)
+                db_post.watch(found['id'], entry.content_hash)
+                self._db.add(db_post)
+                self._outbox.published(entry)
+            elif complete:
+                logger.info(f"{post.reddit_link} didn't make it to Lemmy, publishing it again")
+                self._outbox.requeue(entry)
+            else:
+                continue
+            settled += 1
+
+        for placeholder in placeholders:
+            found = self.find(lemmy_posts, placeholder.reddit_link)
+            if found:
+                logger.info(f"Fixing the link of {placeholder.reddit_link}: {found['ap_id']}")
+                placeholder.lemmy_link = found['ap_id']
+            elif complete:
+                logger.warning(f"{placeholder.reddit_link} never made it to Lemmy, forgetting about it")
+                self._db.delete(placeholder)
+            else:
+                continue
+            settled += 1
+
+        self._db.commit()
+        return settled
+
+    def sweep(self, community: Community, since: datetime) -> Tuple[List[dict], bool]:
+        """The posts of a community on Lemmy, newest first, back to `since`. Also returns whether it got that far."""
+        posts = []
+        for page in range(1, MAX_PAGES + 1):
+            # Anonymous listings leave out NSFW posts, which would then look like they never made it
+            views = self._lemmy.get_posts(community_id=community.lemmy_id, sort='New', limit=PAGE_SIZE, page=page,
+                                          auth_required=True)['posts']
+            posts.extend(view['post'] for view in views)
+            if len(views) < PAGE_SIZE or (views and self.published(views[-1]['post']) < since):
+                return posts, True
+        logger.warning(f"Gave up sweeping {community.ident} after {MAX_PAGES} pages")
+        return posts, False
+
+    @staticmethod
+    def find(lemmy_posts: List[dict], reddit_link: str, url: str = None, title: str = None) -> Optional[dict]:
+        # The archive notice at the top of the body links to the original, see Syncer.prepare_post
+        old_reddit_link = reddit_link.replace('https://www.', 'https://old.')
+        for lemmy_post in lemmy_posts:
+            if old_reddit_link in (lemmy_post.get('body') or ''):
+                return lemmy_post
+        if title is not None:
+            for lemmy_post in lemmy_posts:
+                if lemmy_post.get('name') == title and lemmy_post.get('url') == url:
+                    return lemmy_post
+        return None
+
+    @staticmethod
+    def published(lemmy_post: dict) -> datetime:
+        """Lemmy's timestamps are UTC, with or without a zone"""
+        published = datetime.fromisoformat(lemmy_post['published'].replace('Z', '+00:00'))
+        if published.tzinfo is not None:
+            published = published.astimezone(timezone.utc).replace(tzinfo=None)
+        return published
@@ -0,0 +1,164 @@
+import heapq
+import itertools
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAX_IDLE = timedelta(minutes=5)  # Reload due times at least this often, so changes made elsewhere get picked up
+MIN_DELAY = timedelta(seconds=1)  # Don't run the same job again sooner than this, whatever it says it's due
+RETRY_DELAY = timedelta(minutes=1)  # Wait before running a failed job again
+
+
+@dataclass
+class Job:
+    """Something to do at a certain moment.
+
+    `run` does the work and returns when it wants to run next (None to stop). `load` reads the next due time from the
+    database, and is used at startup and whenever the scheduler gets woken up.
+    """
+    name: str
+    run: Callable[[], Optional[datetime]]
+    load: Callable[[], Optional[datetime]]
+    runs: int = 0
+    lateness: timedelta = timedelta(0)  # Of the latest run
+    max_lateness: timedelta = timedelta(0)
+    total_lateness: timedelta = field(default=timedelta(0), repr=False)
+
+    @property
+    def mean_lateness(self) -> timedelta:
+        return self.total_lateness / self.runs if self.runs else timedelta(0)
+
+
+class Scheduler:
+    """Keeps a heap of (due, job) entries and sleeps until the first one is due.
+
+    Rescheduling a job leaves its old entry in the heap; it gets skipped once it surfaces. Times are naive UTC, like
+    the rest of the database.
+    """
+
+    def __init__(self, max_idle: timedelta = MAX_IDLE, min_delay: timedelta = MIN_DELAY):
+        self._max_idle: timedelta = max_idle
+        self._min_delay: timedelta = min_delay
+        self._jobs: Dict[str, Job] = {}
+        self._heap: List[Tuple[datetime, int, str]] = []
+        self._due: Dict[str, Tuple[datetime, int]] = {}  # Current entry of each job
+        self._counter = itertools.count()
+        self._wakeup = threading.Condition()
+        self._reload: bool = False
+        self._reloaded_at: datetime = datetime.utcnow()
+        self._running: bool = False
+
+    def add(self, job: Job):
+        self._jobs[job.name] = job
+        self.schedule(job.name, job.load())
+
+    def schedule(self, name: str, due: Optional[datetime]):
+        """(Re)schedule a job, None unschedules it until its next reload"""
+        with self._wakeup:
+            if due is None:
+                self._due.pop(name, None)
+            else:
+                entry = (due, next(self._counter))
+                self._due[name] = entry
+                heapq.heappush(self._heap, (*entry, name))
+            self._wakeup.notify()
+
+    def next_due(self) -> Optional[Tuple[datetime, str]]:
+        with self._wakeup:
+            self._discard_stale()
+            return (self._heap[0][0], self._heap[0][2]) if self._heap else None
+
+    def wake(self, reload: bool = True):
+        """Stop sleeping, optionally reloading all due times from the database first. Safe to call from signal handlers."""
+        with self._wakeup:
+            self._reload = self._reload or reload
+            self._wakeup.notify()
+
+    @property
+    def jobs(self) -> List[Job]:
+        return list(self._jobs.values())
+
+    def stop(self):
+        with self._wakeup:
+            self._running = False
+            self._wakeup.notify()
+
+    def start(self, name: str) -> threading.Thread:
+        """Run in a thread of its own, so these jobs never wait for the ones of another scheduler"""
+        self._running = True  # Before starting, so stopping right away can't be missed
+        thread = threading.Thread(target=self._loop, name=name)
+        thread.start()
+        return thread
+
+    def run(self):
+        self._running = True
+        self._loop()
+
+    def _loop(self):
+        while self._running:
+            job = self._wait_for_job()
+            if job is not None:
+                self._run_job(job)
+
+    def _wait_for_job(self) -> Optional[Job]:
+        """Sleep until the next job is due, returns None when woken up (or due for a reload) without one"""
+        with self._wakeup:
+            self._discard_stale()
+            now = datetime.utcnow()
+            # However busy the jobs keep it, the due times are reloaded every max_idle
+            reload_at = self._reloaded_at + self._max_idle
+            if self._heap and self._heap[0][0] <= now < reload_at:
+                due, _, name = heapq.heappop(self._heap)
+                del self._due[name]
+                job = self._jobs[name]
+                self._record_lateness(job, now - due)
+                return job
+
+            if not self._reload and now < reload_at:
+                timeout = reload_at - now
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                logger.debug(f"Sleeping for {timeout.total_seconds():.1f}s")
+                self._wakeup.wait(max(timeout.total_seconds(), 0))
+            reload = self._reload or datetime.utcnow() >= reload_at
+            self._reload = False
+
+        if reload:
+            self._reload_jobs()
+        return None
+
+    def _run_job(self, job: Job):
+        started = datetime.utcnow()
+        try:
+            due = job.run()
+        except Exception as e:
+            logger.exception(f"Job {job.name} failed: {str(e)}")
+            due = started + RETRY_DELAY
+        if due is not None:
+            due = max(due, started + self._min_delay)
+        self.schedule(job.name, due)
+
+    def _reload_jobs(self):
+        logger.debug("Reloading due times")
+        self._reloaded_at = datetime.utcnow()
+        for job in self._jobs.values():
+            try:
+                self.schedule(job.name, job.load())
+            except Exception as e:
+                logger.error(f"Couldn't reload {job.name}: {str(e)}")
+
+    def _discard_stale(self):
+        while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][:2]:
+            heapq.heappop(self._heap)
+
+    @staticmethod
+    def _record_lateness(job: Job, lateness: timedelta):
+        job.runs += 1
+        job.lateness = lateness
+        job.total_lateness += lateness
+        job.max_lateness = max(job.max_lateness, lateness)
+        logger.debug(f"Running {job.name}, {lateness.total_seconds():.3f}s late")
@@ -1,19 +1,21 @@
 import logging
-import time
 from datetime import datetime, timedelta
 from operator import or_
-from typing import List
+from typing import Dict, List, Tuple
 
 from requests import HTTPError
-from sqlalchemy import asc, func, and_
-from sqlalchemy.orm import Session as DbSession
+from sqlalchemy import asc, func, and_, case, select, update, bindparam
+from sqlalchemy.orm import Session as DbSession, contains_eager
+from sqlalchemy.sql.elements import Case
 
 from lemmy.api import LemmyAPI
-from models.models import Community, CommunityStats, Post
+from models.models import Community, CommunityStats, Post, next_scrape_at
 
 # Amount of minutes between CommunityStats updates
 COMMUNITY_UPDATE_INTERVAL = 60 * 4
 DISABLED_COMMUNITY_UPDATE_INTERVAL = 60 * 24 * 2
+# Seconds between checks for CommunityStats that are due for an update
+STATS_CHECK_INTERVAL = 60
 
 # Minimum amount of minutes between checks
 INTERVAL_DESERTED = 60 * 24 * 365
@@ -22,109 +24,190 @@ INTERVAL_LOW = 240
 INTERVAL_MEDIUM = 120
 INTERVAL_HIGH = 60
 INTERVAL_HIGHEST = 30
+INTERVAL_DAILY = 60 * 24
+
+# Interval prediction from observed arrivals
+ARRIVAL_WEIGHT = 0.25  # Weight of the latest observation in the arrival rate EWMA
+TARGET_ITEMS_PER_FETCH = 10  # New posts a listing fetch should yield on average, well within a single listing page
+MIN_OBSERVATION = timedelta(minutes=5)  # Shorter gaps between fetches say more about noise than about velocity
 
 
 # Amount of Communities to update per time
 BATCH_SIZE = 10
+# Maximum amount of communities Lemmy returns per page of the community list
+COMMUNITY_LIST_PAGE_SIZE = 50
 
 logger = logging.getLogger(__name__)
 
 
 class Stats:
-    def __init__(self, db: DbSession, lemmy: LemmyAPI):
+    def __init__(self, db: DbSession, lemmy: LemmyAPI, bulk: bool = False):
         self._db: DbSession = db
         self._lemmy: LemmyAPI = lemmy
+        self.bulk: bool = bulk  # Refresh everything through the community list, rather than one by one
 
     def update_community_stats(self):
         """Update a bunch of communities"""
-        self.initialize_stats()
-
         # Get 10 CommunityStats that have not been updated recently
         batch: List[CommunityStats] = self.get_update_batch(BATCH_SIZE)
         if not batch:
             logger.debug("No communities due for a stats update")
             return
 
-        for community_stats in batch:
-            logger.info(f"Updating stats for {community_stats.community.ident}...")
-            try:
-                data = self._lemmy.community(name=community_stats.community.ident)
-            except HTTPError as e:
-                logger.warn(f"Error fetching {community_stats.community.ident} stats: {str(e.response)}")
-                if e.response.status_code == 404:
-                    logger.info('Community could not be found, try updating again tomorrow.')
-                    community_stats.last_update = datetime.utcnow() + timedelta(days=1)
-                    self._db.commit()
-                continue
-            community_stats.subscribers = data['community_view']['counts']['subscribers']
-
-            # While we're here, update any unknown Community.created
-            if not community_stats.community.created:
-                community_stats.community.created = datetime.fromisoformat(
-                    data['community_view']['community']['published'])
-                self._db.add(community_stats.community)
-
-            interval_before = community_stats.min_interval
-            community_stats.posts_per_day = self.get_posts_per_day(community_stats.community_id)
-            community_stats.last_update = datetime.utcnow()
-            community_stats.min_interval = self.decide_interval(
-                community_stats.subscribers, community_stats.posts_per_day
-            )
+        if self.bulk:
+            self.bulk_update_community_stats(batch)
+            return
 
-            if community_stats.min_interval != interval_before:
-                logger.info(f"Updated {community_stats.community.ident} interval to {community_stats.min_interval} (was {interval_before})")
+        posts_per_day = self.get_posts_per_day_batch([community_stats.community_id for community_stats in batch])
+        for community_stats in batch:
+            self.update_single_community_stats(community_stats, posts_per_day.get(community_stats.community_id, 0))
+        self._db.commit()
 
-            self._db.add(community_stats)
-            self._db.commit()
-            time.sleep(0.5)  # TODO - move delay to Lemmy client. 0.5s for get, 2s for POST
+    def bulk_update_community_stats(self, due: List[CommunityStats]):
+        """Update all communities at once with the counts from the (local) community list.
+
+        Only the due communities that are missing from the list are looked up one by one.
+        """
+        logger.info("Updating stats for all communities through the community list...")
+        views = self.get_community_views()
+
+        posts_per_day = self.get_posts_per_day_batch()
+        missing = []
+        every_stats = self._db.query(CommunityStats).join(Community) \
+            .options(contains_eager(CommunityStats.community)).all()
+        for community_stats in every_stats:
+            view = views.get(community_stats.community.ident.lower())
+            if view:
+                self.apply_community_view(community_stats, view, posts_per_day.get(community_stats.community_id, 0))
+            elif community_stats in due:
+                missing.append(community_stats)
+
+        for community_stats in missing:
+            self.update_single_community_stats(community_stats, posts_per_day.get(community_stats.community_id, 0))
+        self._db.commit()
+        logger.info(f"Updated stats for {len(views) + len(missing)} communities.")
 
-    def recalculate_stats(self, page_size=100):
-        logger.info(f"Recalculating CommunityStats intervals...")
-        page_number = 1
-        yesterday_utc = datetime.utcnow() - timedelta(days=1)
+    def get_community_views(self) -> Dict[str, dict]:
+        """Walk through all pages of local communities, returns their community views by (lowercase) name"""
+        views = {}
+        page = 1
         while True:
-            community_stats = self._db.query(CommunityStats)\
-                .join(Community, CommunityStats.community_id == Community.id)\
-                .filter(Community.created <= yesterday_utc)\
-                .limit(page_size)\
-                .offset((page_number - 1) * page_size)\
-                .all()
+            communities = self._lemmy.community_list(limit=COMMUNITY_LIST_PAGE_SIZE, page=page)['communities']
+            for view in communities:
+                views[view['community']['name'].lower()] = view
+            if len(communities) < COMMUNITY_LIST_PAGE_SIZE:
+                return views
+            page += 1
+
+    def update_single_community_stats(self, community_stats: CommunityStats, posts_per_day: int):
+        """Update CommunityStats with a lookup of its own, leaves committing to the caller"""
+        logger.info(f"Updating stats for {community_stats.community.ident}...")
+        try:
+            data = self._lemmy.community(name=community_stats.community.ident)
+        except HTTPError as e:
+            logger.warn(f"Error fetching {community_stats.community.ident} stats: {str(e.response)}")
+            if e.response.status_code == 404:
+                logger.info('Community could not be found, try updating again tomorrow.')
+                community_stats.last_update = datetime.utcnow() + timedelta(days=1)
+            return
+
+        self.apply_community_view(community_stats, data['community_view'], posts_per_day)
+
+    def apply_community_view(self, community_stats: CommunityStats, view: dict, posts_per_day: int):
+        """Update CommunityStats with a Lemmy community view"""
+        community_stats.subscribers = view['counts']['subscribers']
+
+        # While we're here, update any unknown Community.created
+        if not community_stats.community.created:
+            community_stats.community.created = datetime.fromisoformat(view['community']['published'])
+            self._db.add(community_stats.community)
 
-            if not community_stats:
-                break
+        interval_before = community_stats.min_interval
+        community_stats.posts_per_day = posts_per_day
+        community_stats.last_update = datetime.utcnow()
+        community_stats.min_interval = self.choose_interval(community_stats)
 
-            for cs in community_stats:
-                interval_before = cs.min_interval
-                cs.min_interval = self.decide_interval(cs.subscribers, cs.posts_per_day)
-                if cs.min_interval != interval_before:
-                    logger.info(f"Updated {cs.community.ident} interval to {cs.min_interval} (was {interval_before})")
+        if community_stats.min_interval != interval_before:
+            logger.info(f"Updated {community_stats.community.ident} interval to {community_stats.min_interval} (was {interval_before})")
 
-            page_number += 1
+        self._db.add(community_stats)
+
+    def recalculate_stats(self) -> int:
+        """Apply decide_interval to every CommunityStats at once, returns the amount of intervals that changed.
+
+        Communities with an arrival rate are left alone, their interval follows the observations.
+        """
+        logger.info(f"Recalculating CommunityStats intervals...")
+        yesterday_utc = datetime.utcnow() - timedelta(days=1)
+        interval = self.decide_interval_sql()
+        outdated = and_(
+            CommunityStats.arrival_rate.is_(None),
+            CommunityStats.community_id.in_(select(Community.id).where(Community.created <= yesterday_utc)),
+            CommunityStats.min_interval != interval
+        )
 
-        logger.info("Finished recalculating CommunityStats intervals.")
+        # Bulk updates skip the attribute events, so next_scrape_at has to follow by hand
+        changed = self._db.execute(
+            select(Community.id, Community.last_scrape, interval)
+            .join(CommunityStats, CommunityStats.community_id == Community.id)
+            .where(outdated, Community.last_scrape.is_not(None))
+        ).all()
+        result = self._db.execute(
+            update(CommunityStats).where(outdated).values(min_interval=interval),
+            execution_options={'synchronize_session': False}
+        )
+        if changed:
+            communities = Community.__table__
+            self._db.execute(
+                update(communities).where(communities.c.id == bindparam('community_id'))
+                .values(next_scrape_at=bindparam('new_next_scrape_at')),
+                [{'community_id': community_id, 'new_next_scrape_at': next_scrape_at(last_scrape, min_interval)}
+                 for community_id, last_scrape, min_interval in changed]
+            )
         self._db.commit()
+        self._db.expire_all()
+
+        logger.info(f"Finished recalculating CommunityStats intervals, {result.rowcount} changed.")
+        return result.rowcount
 
     def initialize_stats(self):
-        """Ensure that each Community has a CommunityStats counterpart"""
+        """Ensure that each Community has a CommunityStats counterpart.
+
+        New communities get theirs right away (see `new_community_stats`), so this only runs once at startup, to
+        catch up on communities added by older versions or by hand.
+        """
         statless_communities = self._db.query(Community) \
             .outerjoin(CommunityStats).filter(CommunityStats.community_id == None).all()
 
         for community in statless_communities:
             logger.debug(f"LOL, {community.ident} doesn't have any stats. Let's all point and laugh!")
-            stats = CommunityStats(community=community, subscribers=0, posts_per_day=0, min_interval=INTERVAL_MEDIUM,
-                                   last_update=datetime.fromtimestamp(0))
-            self._db.add(stats)
+            community.stats = self.new_community_stats()
         self._db.commit()
 
+    @staticmethod
+    def new_community_stats() -> CommunityStats:
+        """Stats for a community that hasn't been looked at yet, due for an update right away"""
+        return CommunityStats(subscribers=0, posts_per_day=0, min_interval=INTERVAL_MEDIUM,
+                              last_update=datetime.fromtimestamp(0))
+
     def get_posts_per_day(self, community_id: int) -> int:
         """Retrieve amount of posts for community in the last 24 hours"""
+        return self.get_posts_per_day_batch([community_id]).get(community_id, 0)
+
+    def get_posts_per_day_batch(self, community_ids: List[int] = None) -> Dict[int, int]:
+        """Amount of posts in the last 24 hours per community id, for the given communities or all of them.
+
+        Communities without any posts are left out.
+        """
         yesterday_utc = datetime.utcnow() - timedelta(hours=24)
 
-        post_count = self._db.query(func.count(Post.id)) \
-            .filter(Post.community_id == community_id, Post.updated >= yesterday_utc) \
-            .scalar()
+        query = self._db.query(Post.community_id, func.count(Post.id)) \
+            .filter(Post.updated >= yesterday_utc) \
+            .group_by(Post.community_id)
+        if community_ids is not None:
+            query = query.filter(Post.community_id.in_(community_ids))
 
-        return post_count
+        return {community_id: post_count for community_id, post_count in query.all()}
 
     def get_update_batch(self, limit: int) -> List[CommunityStats]:
         """Get a batch of CommunityStats that are due for an update, or with an unknown Community creation"""
@@ -134,6 +217,7 @@ class Stats:
         query = (
             self._db.query(CommunityStats)
             .join(Community, CommunityStats.community_id == Community.id)
+            .options(contains_eager(CommunityStats.community))
             .filter(
                 or_(
                     Community.created.is_(None),
@@ -157,6 +241,61 @@ class Stats:
 
         return query
 
+    @classmethod
+    def choose_interval(cls, community_stats: CommunityStats) -> int:
+        """Predict from the observed arrivals when there are any, fall back to the subscriber/posts buckets"""
+        if community_stats.arrival_rate is not None:
+            return cls.predict_interval(community_stats.subscribers, community_stats.arrival_rate)
+        return cls.decide_interval(community_stats.subscribers, community_stats.posts_per_day)
+
+    @staticmethod
+    def record_arrivals(community_stats: CommunityStats, new_items: int, elapsed: timedelta) -> bool:
+        """Fold the amount of new posts a listing fetch yielded into the arrival rate, returns whether it did"""
+        if elapsed < MIN_OBSERVATION:
+            return False
+        observed = new_items / (elapsed.total_seconds() / 3600)
+        if community_stats.arrival_rate is None:
+            community_stats.arrival_rate = observed
+        else:
+            community_stats.arrival_rate = ARRIVAL_WEIGHT * observed + (1 - ARRIVAL_WEIGHT) * community_stats.arrival_rate
+        return True
+
+    @staticmethod
+    def interval_limits(subscribers: int) -> Tuple[int, int]:
+        """Shortest and longest interval a community gets, depending on how many people would see its posts"""
+        if subscribers < 2:
+            return INTERVAL_DESERTED, INTERVAL_DESERTED
+        if subscribers < 5:
+            return INTERVAL_BI_DAILY, INTERVAL_DAILY
+        if subscribers < 10:
+            return INTERVAL_LOW, INTERVAL_DAILY
+        if subscribers < 25:
+            return INTERVAL_MEDIUM, INTERVAL_DAILY
+        if subscribers < 50:
+            return INTERVAL_HIGH, INTERVAL_BI_DAILY
+        return INTERVAL_HIGHEST, INTERVAL_BI_DAILY
+
+    @classmethod
+    def predict_interval(cls, subscribers: int, arrival_rate: float) -> int:
+        """The interval that yields about TARGET_ITEMS_PER_FETCH new posts per fetch, within the subscriber limits"""
+        floor, ceiling = cls.interval_limits(subscribers)
+        if arrival_rate <= 0:
+            return ceiling
+        return int(min(max(TARGET_ITEMS_PER_FETCH / arrival_rate * 60, floor), ceiling))
+
+    @staticmethod
+    def decide_interval_sql() -> Case:
+        """decide_interval as an SQL expression, which has to stay in line with the Python version"""
+        subscribers, posts_per_day = CommunityStats.subscribers, CommunityStats.posts_per_day
+        return case(
+            (subscribers < 2, INTERVAL_DESERTED),
+            (or_(subscribers < 5, posts_per_day < 5), INTERVAL_BI_DAILY),
+            (and_(subscribers >= 50, posts_per_day >= 25), INTERVAL_HIGHEST),
+            (and_(subscribers >= 25, posts_per_day >= 15), INTERVAL_HIGH),
+            (and_(subscribers >= 10, posts_per_day >= 10), INTERVAL_MEDIUM),
+            else_=INTERVAL_LOW
+        )
+
     @staticmethod
     def decide_interval(subscribers: int, posts_per_day: int) -> int:
         """Decide what the next update should be, based on subscriber count and posts per day"""
@@ -1,23 +1,34 @@
 import logging
 import re
 import time
-from datetime import datetime
+from collections import defaultdict
+from dataclasses import replace
+from datetime import datetime, timedelta
 from operator import attrgetter
-from typing import Type, List, Optional
+from typing import Type, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
-from requests import HTTPError
-from sqlalchemy import or_, func, String
-from sqlalchemy.orm import Session as DbSession
+from requests import HTTPError, RequestException, Timeout, ConnectionError as RequestsConnectionError
+from sqlalchemy import func
+from sqlalchemy.orm import Session as DbSession, joinedload
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError
 
 from lemmy.api import LemmyAPI
-from models.models import Community, PostDTO, Post, CommunityDTO, SORT_HOT, CommunityStats
-from reddit.reader import RedditReader
+from models.models import Community, PostDTO, Post, CommunityDTO, SORT_HOT, SORT_NEW, ListingCursor, \
+    PendingPosts, OutboxPost
+from reddit.reader import RedditReader, MULTI_LISTING_LIMIT
 from utils import format_duration
-from utils.exceptions import SubredditRequestException, HttpNotFoundException
+from utils.exceptions import SubredditRequestException, HttpNotFoundException, PublishTimeoutException
+from utils.leases import CommunityLeases
+from utils.outbox import Outbox
+from utils.stats import Stats
+from utils.unit_of_work import UnitOfWork
 
 NEW_SUB_CHECK_INTERVAL: int = 180  # Seconds between checking for new messages
 PER_SUB_CHECK_INTERVAL: int = 600  # Minimal wait time before checking a subreddit for new posts
+CURSOR_GRACE = timedelta(hours=12)  # Posts younger than this may still reach the upvote threshold
+CURSOR_MAX_AGE = timedelta(days=1)  # Drop the listing cursor when it hasn't moved for this long
+ENRICH_CHUNK = 8  # Posts to fetch the details of at once, between looks at the time budget
 
 # This is a filter Lemmy uses - which unfortunately also blocks titles like 'uh oh', so a workaround is required.
 VALID_TITLE = re.compile(r".*\S{3,}.*")
@@ -27,7 +38,9 @@ class Syncer:
     new_sub_check: int = None  # Last timestamp request checker ran
 
     def __init__(self, db: DbSession, reddit_reader: RedditReader, lemmy: LemmyAPI, thresh_upvotes: int,
-                 thresh_ratio: float, request_community: str = None):
+                 thresh_ratio: float, request_community: str = None, batch_size: int = 1,
+                 leases: CommunityLeases = None, unit_of_work: UnitOfWork = None, max_posts: int = None,
+                 time_budget: timedelta = None):
         self._db: DbSession = db
         self._reddit_reader: RedditReader = reddit_reader
         self._lemmy: LemmyAPI = lemmy
@@ -36,74 +49,330 @@ class Syncer:
         self.lemmy_hostname: str = urlparse(lemmy.base_url).hostname
         self.thresh_votes: int = thresh_upvotes
         self.thresh_ratio: float = thresh_ratio
+        self.batch_size: int = batch_size  # Amount of communities to combine into a single listing request
+        self.leases: Optional[CommunityLeases] = leases  # When several workers share the database
+        self._unit_of_work: UnitOfWork = unit_of_work or UnitOfWork(db)
+        self.outbox: Outbox = Outbox(db)
+        # Per community and turn, whatever is left waits for the next turn so one busy sub can't hold up the rest
+        self.max_posts: Optional[int] = max_posts
+        self.time_budget: Optional[timedelta] = time_budget
 
     def next_scrape_community(self) -> Optional[Type[Community]]:
         """Get the next community that is due for scraping."""
-        # Funky method to get the next scrape datetime for a community
-        threshold = func.datetime(Community.last_scrape,
-                                  '+' + func.cast(CommunityStats.min_interval, String) + ' minutes')
-        query = self._db.query(Community).join(CommunityStats, Community.id == CommunityStats.community_id) \
-            .filter(
-            or_(
-                Community.last_scrape.is_(None),
-                threshold < func.datetime('now')
-            ),
-            Community.enabled.is_(True)
-        ) \
-            .order_by(threshold)
-        return query.first()
+        communities = self.next_scrape_communities(limit=1)
+        return communities[0] if communities else None
+
+    def next_scrape_due(self) -> Optional[datetime]:
+        """When the next community is due for scraping, None when there's nothing to scrape at all."""
+        query = self._db.query(func.min(Community.next_scrape_at)).filter(Community.enabled.is_(True))
+        if self.leases:
+            query = query.filter(self.leases.available(datetime.utcnow()))
+        return query.scalar()
+
+    def next_new_sub_check(self) -> datetime:
+        """When check_new_subs will look for new requests again."""
+        if self.new_sub_check is None:
+            return datetime.utcnow()
+        return datetime.utcfromtimestamp(self.new_sub_check + NEW_SUB_CHECK_INTERVAL)
+
+    def next_scrape_communities(self, limit: int) -> List[Type[Community]]:
+        """Get the communities that are due for scraping, most overdue first."""
+        if self.leases:
+            return self.leases.claim_due(self._db, limit)
+        return self._db.query(Community) \
+            .options(joinedload(Community.stats)) \
+            .filter(Community.enabled.is_(True), Community.next_scrape_at <= datetime.utcnow()) \
+            .order_by(Community.next_scrape_at) \
+            .limit(limit).all()
 
     def scrape_new_posts(self):
+        if self.batch_size > 1:
+            self.scrape_new_posts_batched()
+            return
+
         community = self.next_scrape_community()
 
         if community:
-            last_time = format_duration(community.last_scrape) if community.last_scrape else "FOREVER"
-            self._logger.info(f'Scraping subreddit: {community.ident}. '
-                              f'Last time {last_time} ago, interval {community.stats.min_interval} minutes')
             try:
-                # posts = self._reddit_reader.get_subreddit_topics(community.ident, mode=community.sorting)
-                posts = self._reddit_reader.get_subreddit_topics_json(community.ident, mode=community.sorting)
-            except HTTPError as e:
-                self._logger.error(f"Error trying to retrieve topics: {str(e)}")
-                if 'banned' in e.response.text:
-                    self._logger.error('Subreddit is banned!')
-                    community.last_scrape = datetime.utcnow()
-                    self._db.add(community)
-                    self._db.commit()
-                if 'private' in e.response.text:
-                    self._logger.error('Subreddit is private!')
-                    community.last_scrape = datetime.utcnow()
-                    self._db.add(community)
-                    self._db.commit()
-                return
-            except BaseException as e:
-                self._logger.error(f"Error trying to retrieve topics: {str(e)}")
-                return
-
-            posts = self.filter_post_threshold(posts, min_ups=self.thresh_votes, min_ratio=self.thresh_ratio)
-            posts = self.filter_posted(posts)
-
-            # Handle oldest entries first.
-            posts = sorted(posts, key=attrgetter('updated'))
-
-            for post in posts:
-                self._logger.info(post)
-                try:
-                    post = self._reddit_reader.get_post_details(post)
-                except HttpNotFoundException as e:
-                    self._logger.error(str(e) + ", skipping.")
+                self.scrape_community(community)
+            finally:
+                self.release(community)
+        else:
+            self._logger.debug('No community due for update')
+
+    def release(self, community: Community):
+        """Hand back the lease on a community, if we're sharing"""
+        if self.leases:
+            self.leases.release(self._db, community.id)
+
+    def scrape_community(self, community: Community):
+        if community.pending is not None:
+            self._logger.info(f'Resuming {community.ident}, {len(community.pending.posts)} posts pending')
+            self.drain_pending(community)
+            return
+
+        last_time = format_duration(community.last_scrape) if community.last_scrape else "FOREVER"
+        self._logger.info(f'Scraping subreddit: {community.ident}. '
+                          f'Last time {last_time} ago, interval {community.stats.min_interval} minutes')
+        cursor = self.prepare_cursor(community)
+        try:
+            # posts = self._reddit_reader.get_subreddit_topics(community.ident, mode=community.sorting)
+            posts = self._reddit_reader.get_subreddit_topics_json(community.ident, mode=community.sorting,
+                                                                  cursor=cursor)
+        except HTTPError as e:
+            self.handle_listing_error(community, e)
+            return
+        except BaseException as e:
+            self._logger.error(f"Error trying to retrieve topics: {str(e)}")
+            return
+
+        self.process_posts(community, posts, cursor)
+
+    def scrape_new_posts_batched(self):
+        """Scrape up to `batch_size` due communities at once, through combined listings (/r/a+b+c)"""
+        communities = self.next_scrape_communities(limit=self.batch_size)
+        if not communities:
+            self._logger.debug('No community due for update')
+            return
+
+        try:
+            by_sorting = defaultdict(list)
+            for community in communities:
+                if community.pending is not None:
+                    # Finish the previous listing first
+                    self.drain_pending(community)
                     continue
+                by_sorting[community.sorting].append(community)
+
+            for sorting, group in by_sorting.items():
+                self._logger.info(f"Scraping {len(group)} subreddits at once: {', '.join(c.ident for c in group)}")
+                try:
+                    posts_per_sub = self._reddit_reader.get_multi_subreddit_topics_json([c.ident for c in group],
+                                                                                        mode=sorting)
                 except BaseException as e:
-                    self._logger.error(f"Error trying to retrieve post details, try again in a bit; {str(e)}")
-                    return
-                self.clone_to_lemmy(post, community)
+                    # A single banned or private subreddit can spoil the whole bunch, so try them one by one
+                    self._logger.error(f"Error trying to retrieve combined topics, falling back to single: {str(e)}")
+                    for community in group:
+                        self.scrape_community(community)
+                    continue
+
+                listed = [post for posts in posts_per_sub.values() for post in posts]
+                for community in group:
+                    if not self.listing_covers(community, listed, sorting):
+                        # The busier subs took all the room in the combined listing, this one needs its own
+                        self.scrape_community(community)
+                        continue
+                    self.process_posts(community, posts_per_sub.get(community.ident.lower(), []))
+        finally:
+            for community in communities:
+                self.release(community)
+
+    @staticmethod
+    def listing_covers(community: Community, listed: List[PostDTO], sorting: str) -> bool:
+        """Whether a combined listing holds all new posts of a community, with or without any posts of it.
+
+        A combined listing holds MULTI_LISTING_LIMIT posts in total, when it's full the quieter subs may have been
+        (partly) left out. A full listing of new posts still covers a community when it reaches back to before its last
+        scrape. On hot, an old popular post can outrank a fresh one, so a full listing covers nothing.
+        """
+        if len(listed) < MULTI_LISTING_LIMIT:
+            return True
+        return sorting == SORT_NEW and community.last_scrape is not None \
+            and min(post.created for post in listed) < community.last_scrape
+
+    def process_posts(self, community: Community, posts: List[PostDTO], cursor: ListingCursor = None):
+        """Queue the freshly listed posts of a community that should be cloned, and clone as many as the budget allows"""
+        self.queue_posts(community, posts, cursor)
+        self.drain_pending(community)
+
+    def queue_posts(self, community: Community, listed: List[PostDTO], cursor: ListingCursor = None):
+        """Remember the posts of a listing that should be cloned, and move the cursor past them.
+
+        They're pending until cloned, so the listing itself is done with.
+        """
+        posts, passed = self.select_posts(listed)
+        if cursor is not None:
+            community.listing_cursor = self.advance_cursor(cursor, listed, passed)
+        now = datetime.utcnow()
+        if community.last_scrape and community.stats:
+            self.observe_arrivals(community, listed, now - community.last_scrape)
+        community.pending = PendingPosts(listed_at=now, posts=posts)
+        self._db.add(community)
+
+    def drain_pending(self, community: Community):
+        """Fetch the details of the pending posts of a community and publish them, as far as the budget goes"""
+        deadline = self.deadline()
+        batch = self.pending_batch(community)
+        enriched, complete = self.enrich_posts(batch, deadline)
+        self.stage_posts(community, enriched)
+        self.publish_outbox(community, deadline)
+        self.settle_pending(community, batch, enriched, complete)
+
+    def pending_batch(self, community: Community) -> List[PostDTO]:
+        """The pending posts to handle this turn. The ones published (or staged) in the meantime are left out."""
+        posts = self.filter_posted(community.pending.posts)
+        return posts[:self.max_posts] if self.max_posts else posts
+
+    def deadline(self) -> Optional[datetime]:
+        return datetime.utcnow() + self.time_budget if self.time_budget is not None else None
+
+    def stage_posts(self, community: Community, posts: List[PostDTO]):
+        """Prepare enriched posts, and put them in the outbox. From here on, they never need Reddit again."""
+        # Preparing changes the posts, the watcher compares the originals
+        content_hashes = {post.reddit_id: post.content_hash() for post in posts}
+        self.outbox.add(community, [self.prepare_post(post, community) for post in posts], content_hashes)
+        self.commit()
+
+    def publish_outbox(self, community: Community, deadline: datetime = None) -> int:
+        """Publish the due outbox entries of a community until the deadline, returns how many were tried. At least
+        one always is, to make progress."""
+        entries = self.outbox.due(community.id)
+        for tried, entry in enumerate(entries):
+            if tried and deadline is not None and datetime.utcnow() >= deadline:
+                self._logger.info(f'Out of time for {community.ident}, {len(entries) - tried} posts have to wait')
+                return tried
+            post = entry.dto
+            self._logger.info(post)
+            self.outbox.start(entry)
+            if self._unit_of_work.shared:
+                # Should we crash halfway, the other workers must see it's publishing, or they'd publish it again
+                self.commit()
+            try:
+                error = self.clone_to_lemmy(post, community, entry.content_hash)
+            except PublishTimeoutException:
+                self.outbox.uncertain(entry)
+                continue
+            if error is None:
+                self.outbox.published(entry)
+            else:
+                self.outbox.failed(entry, error)
+        return len(entries)
+
+    def settle_pending(self, community: Community, batch: List[PostDTO], enriched: List[PostDTO], complete: bool):
+        """Drop the staged posts from the pending ones, and finish the scrape once there's nothing left to do.
+
+        Everything in the batch up to the last enriched post is handled, posts that turned out to be gone included.
+        Failed publishes don't hold up the scrape, they're retried on a later turn.
+        """
+        if complete:
+            done = len(batch)
+        elif enriched:
+            done = [post.reddit_link for post in batch].index(enriched[-1].reddit_link) + 1
+        else:
+            done = 0
+        handled = {post.reddit_link for post in batch[:done]}
+
+        pending = community.pending
+        remaining = [post for post in self.filter_posted(pending.posts) if post.reddit_link not in handled]
+        if not remaining and not self.outbox.waiting(community.id):
+            community.pending = None
+            self.finish_scrape(community, pending.listed_at)
+            return
 
-            self._logger.info(f'Done.')
+        community.pending = replace(pending, posts=remaining)
+        # To the back of the queue, so the other due communities get their turn first
+        community.next_scrape_at = datetime.utcnow()
+        self._db.add(community)
+        self.commit()
+
+    def commit(self):
+        """Commit everything gathered so far, published posts included"""
+        self._unit_of_work.commit()
+
+    def select_posts(self, posts: List[PostDTO]) -> Tuple[List[PostDTO], Set[str]]:
+        """Returns the listed posts that should be cloned, oldest first, and the fullnames of all that passed the
+        threshold (whether cloned before or not)"""
+        posts = self.filter_post_threshold(posts, min_ups=self.thresh_votes, min_ratio=self.thresh_ratio)
+        passed = {post.fullname for post in posts}
+        posts = self.filter_posted(posts)
+
+        # Handle oldest entries first.
+        return sorted(posts, key=attrgetter('updated')), passed
+
+    def enrich_posts(self, posts: List[PostDTO], deadline: datetime = None) -> Tuple[List[PostDTO], bool]:
+        """Fetch the details of the posts that need them, until the deadline.
+
+        Returns the posts up to the first failure (or the deadline), and whether all of them made it. Posts that are
+        gone are skipped. The first ENRICH_CHUNK posts are always done, to make progress.
+        """
+        # Details are fetched a chunk at once, so a concurrent reader can keep several requests in flight.
+        # Posts that are already complete from the listing don't need their detail page at all.
+        chunk_size = ENRICH_CHUNK if deadline is not None else max(len(posts), 1)
+        enriched = []
+        for start in range(0, len(posts), chunk_size):
+            if start and datetime.utcnow() >= deadline:
+                self._logger.info(f'Out of time, {len(posts) - start} posts have to wait for their details')
+                return enriched, False
+            chunk = posts[start:start + chunk_size]
+            incomplete = [post for post in chunk if not post.complete]
+            details = iter(self._reddit_reader.get_posts_details(incomplete) if incomplete else [])
+            for post in chunk:
+                if not post.complete:
+                    post = next(details)
+                if isinstance(post, HttpNotFoundException):
+                    self._logger.error(str(post) + ", skipping.")
+                    continue
+                if isinstance(post, BaseException):
+                    self._logger.error(f"Error trying to retrieve post details, try again in a bit; {str(post)}")
+                    return enriched, False
+                enriched.append(post)
+        return enriched, True
+
+    def finish_scrape(self, community: Community, scraped_at: datetime):
+        """All posts of the listing from `scraped_at` are done"""
+        self._logger.info(f'Done with {community.ident}.')
+        community.last_scrape = scraped_at
+        self._db.add(community)
+        self.commit()
+
+    def observe_arrivals(self, community: Community, listed: List[PostDTO], elapsed: timedelta):
+        """Count the posts that showed up on Reddit since the previous fetch, and adjust the interval to it"""
+        # Listing timestamps are local, see RedditReader._parse_listing
+        window_start = datetime.now() - elapsed
+        new_items = len([post for post in listed if post.created > window_start])
+        if Stats.record_arrivals(community.stats, new_items, elapsed):
+            community.stats.min_interval = Stats.choose_interval(community.stats)
+            self._logger.debug(f"{community.ident}: {new_items} new posts in {format_duration(community.last_scrape)}, "
+                               f"{community.stats.arrival_rate:.2f}/hour, interval {community.stats.min_interval}")
+
+    @staticmethod
+    def prepare_cursor(community: Community) -> ListingCursor:
+        cursor = community.listing_cursor
+        # When the anchor post gets deleted, `before` keeps returning nothing, so start over once in a while.
+        if cursor.fullname and (cursor.moved is None or cursor.moved < datetime.utcnow() - CURSOR_MAX_AGE):
+            cursor.fullname = None
+        return cursor
+
+    @staticmethod
+    def advance_cursor(cursor: ListingCursor, listed: List[PostDTO], passed: Set[str]) -> ListingCursor:
+        """Move the cursor to the newest listed post that never has to be seen again.
+
+        Recent posts that didn't pass the upvote threshold yet might still do so, so the cursor stays behind the
+        oldest of those.
+        """
+        # Listing timestamps are local, see RedditReader._parse_listing
+        grace_start = datetime.now() - CURSOR_GRACE
+        pending = [post.created for post in listed if post.fullname not in passed and post.created > grace_start]
+        candidates = [post for post in listed if post.fullname and (not pending or post.created < min(pending))]
+        if candidates:
+            newest = max(candidates, key=attrgetter('created'))
+            if newest.fullname != cursor.fullname:
+                cursor.fullname = newest.fullname
+                cursor.moved = datetime.utcnow()
+        return cursor
+
+    def handle_listing_error(self, community: Community, e: HTTPError):
+        self._logger.error(f"Error trying to retrieve topics: {str(e)}")
+        if 'banned' in e.response.text:
+            self._logger.error('Subreddit is banned!')
+            community.last_scrape = datetime.utcnow()
+            self._db.add(community)
+            self._db.commit()
+        if 'private' in e.response.text:
+            self._logger.error('Subreddit is private!')
             community.last_scrape = datetime.utcnow()
             self._db.add(community)
             self._db.commit()
-        else:
-            self._logger.debug('No community due for update')
 
     def filter_post_threshold(self, posts: List[PostDTO], min_ups: int = 2, min_ratio: float = 0.51) -> List[PostDTO]:
         """Filter through posts, removing everything where upvotes ratio is below stated thresholds"""
@@ -119,36 +388,26 @@ class Syncer:
         return filtered_posts
 
     def filter_posted(self, posts: List[PostDTO]) -> List[PostDTO]:
-        """Filter out any posts that have already been synced to Lemmy (and compensate for both www/old reddit links)"""
-        reddit_links = set()
-        existing_links = set()
-
-        # Duplicating all urls to contain both www. and old. 🤦
-        for post in posts:
-            reddit_links.add(post.reddit_link)
-            if post.reddit_link.startswith("https://old.reddit"):
-                reddit_links.add(post.reddit_link.replace("old.reddit", "www.reddit", 1))
-            elif post.reddit_link.startswith("https://www.reddit"):
-                reddit_links.add(post.reddit_link.replace("www.reddit", "old.reddit", 1))
-
-        existing_links_raw = self._db.query(Post.reddit_link).filter(Post.reddit_link.in_(reddit_links)).all()
-        for existing_link in existing_links_raw:
-            existing_links.add(existing_link[0])
-            if existing_link[0].startswith('https://old.reddit'):
-                existing_links.add(existing_link[0].replace("old.reddit", "www.reddit", 1))
-            elif existing_link[0].startswith('https://www.reddit'):
-                existing_links.add(existing_link[0].replace("www.reddit", "old.reddit", 1))
+        """Filter out any posts that have already been synced to Lemmy, or are in the outbox on their way there"""
+        reddit_ids = {post.reddit_id for post in posts if post.reddit_id}
+        existing_ids = {row[0] for row in self._db.query(Post.reddit_id).filter(Post.reddit_id.in_(reddit_ids)).all()}
+        existing_ids |= {row[0] for row in
+                         self._db.query(OutboxPost.reddit_id).filter(OutboxPost.reddit_id.in_(reddit_ids)).all()}
 
         filtered_posts = []
         for post in posts:
-            if post.reddit_link not in existing_links:
+            if post.reddit_id not in existing_ids:
                 filtered_posts.append(post)
             else:
                 self._logger.debug(f"Post already in database: {post.title}")
         return filtered_posts
 
-    def clone_to_lemmy(self, post: PostDTO, community: Community):
-        post = self.prepare_post(post, community)
+    def clone_to_lemmy(self, post: PostDTO, community: Community, content_hash: str = None) -> Optional[str]:
+        """Publish a prepared post, returns what went wrong when it didn't make it to Lemmy.
+
+        Raises PublishTimeoutException when it's unknown whether it did. The content hash of the original is what the
+        watcher compares with later on, without one its first check only takes note of it.
+        """
         try:
             lemmy_post = self._lemmy.create_post(
                 community_id=community.lemmy_id,
@@ -161,9 +420,8 @@ class Syncer:
             if e.response.status_code == 504 and ('time-out' in str(e.response.text).lower()):
                 # ron_burgundy_-_I_dont_believe_you.gif
                 self._logger.warning(f'Timeout when trying to post {post.reddit_link}: {str(e)}\nSuuuure...')
-                # TODO: check if post was actually placed through a search.
-                #  If not, return, so it gets picked up next time
-                lemmy_post = {'post_view': {'post': {'ap_id': f'https://some.post.in/{community.ident}'}}}  # hack
+                # Often the post got created anyway, the reconciler will go and look for it
+                raise PublishTimeoutException(str(e), response=e.response) from e
             else:
                 try:
                     message = f'{str(e)}: {e.response.content}'
@@ -172,23 +430,40 @@ class Syncer:
                 self._logger.error(
                     f"HTTPError trying to post {post.reddit_link}: {message}"
                 )
-                return
+                return message
+
+        except (Timeout, RequestsConnectionError) as e:
+            if not self.request_was_sent(e):
+                self._logger.error(f"Couldn't connect to Lemmy to post {post.reddit_link}: {str(e)}")
+                return str(e)
+            # No answer, but Lemmy may well have created it, same as a gateway time-out
+            self._logger.warning(f'No response when trying to post {post.reddit_link}: {str(e)}')
+            raise PublishTimeoutException(str(e)) from e
 
         except Exception as e:
             self._logger.error(
                 f"Something went horribly wrong when posting {post.reddit_link}: {str(e)}"
             )
-            return
+            return str(e)
 
         # Save post
         try:
-            db_post = Post(reddit_link=post.reddit_link, lemmy_link=lemmy_post['post_view']['post']['ap_id'],
+            db_post = Post(reddit_link=post.reddit_link, reddit_id=post.reddit_id, lemmy_link=lemmy_post['post_view']['post']['ap_id'],
                            community=community, updated=datetime.utcnow(), nsfw=post.nsfw)
-            self._db.add(db_post)
-            self._db.commit()
+            db_post.watch(lemmy_post['post_view']['post']['id'], content_hash)
+            self._unit_of_work.add_post(db_post)
         except Exception as e:
             print(f"Couldn't save {post.reddit_link} to local database. MUST REMOVE FROM LEMMY OR ELSE. {str(e)}")
 
+    @staticmethod
+    def request_was_sent(e: RequestException) -> bool:
+        """Whether a request that got no response may have reached Lemmy. Only failing to connect rules that out."""
+        reason = e.args[0] if e.args else None
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        # Also covers NewConnectionError
+        return not isinstance(reason, ConnectTimeoutError)
+
     def check_new_subs(self):
         if self.new_sub_check is not None and (self.new_sub_check + NEW_SUB_CHECK_INTERVAL) > time.time():
             self._logger.debug('Not time yet for subreddit request check')
@@ -259,7 +534,8 @@ class Syncer:
             ident=community.ident,
             nsfw=community.nsfw,
             enabled=True,
-            sorting=SORT_HOT
+            sorting=SORT_HOT,
+            stats=Stats.new_community_stats()
         )
         self._db.add(db_community)
         self._db.commit()
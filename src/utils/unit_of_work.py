@@ -0,0 +1,150 @@
+import glob
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy.orm import Session as DbSession
+
+from models.models import OutboxPost, Post
+from utils.outbox import Outbox
+
+MAX_PENDING = 25  # Published posts to gather before committing anyway
+MAX_AGE = timedelta(seconds=30)  # Don't keep published posts uncommitted for longer than this
+
+logger = logging.getLogger(__name__)
+
+
+class PublishJournal:
+    """Append-only file with the posts that were published to Lemmy, but aren't committed to the database yet.
+
+    Every entry is fsync'ed before moving on, which is a lot cheaper than a database commit. After a crash, the entries
+    that never made it into the database are replayed at startup, so a published post is never forgotten (and never
+    posted twice).
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self._lock = threading.Lock()
+
+    def append(self, post: Post):
+        entry = {'reddit_link': post.reddit_link, 'reddit_id': post.reddit_id, 'lemmy_link': post.lemmy_link,
+                 'community_id': post.community_id if post.community_id else post.community.id,
+                 'updated': post.updated.isoformat(), 'nsfw': post.nsfw, 'lemmy_id': post.lemmy_id,
+                 'content_hash': post.content_hash}
+        with self._lock, open(self.path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def entries(self) -> List[dict]:
+        if not os.path.exists(self.path):
+            return []
+        with self._lock, open(self.path) as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                open(self.path, 'w').close()
+
+    def restore(self, db: DbSession) -> int:
+        """Add the journaled posts that aren't in the database to the session, without committing. Returns how many.
+
+        Their outbox entries are marked published, so they're never published again.
+        """
+        restored = 0
+        entries = self.entries()
+        for entry in entries:
+            saved = Post.reddit_id == entry['reddit_id'] if entry['reddit_id'] else \
+                Post.reddit_link == entry['reddit_link']
+            if db.query(Post.id).filter(saved).first():
+                continue
+            logger.warning(f"Recovering {entry['reddit_link']} from the publish journal")
+            post = Post(reddit_link=entry['reddit_link'], reddit_id=entry['reddit_id'],
+                        lemmy_link=entry['lemmy_link'], community_id=entry['community_id'],
+                        updated=datetime.fromisoformat(entry['updated']), nsfw=entry['nsfw'])
+            # Journals written before posts were watched don't have a Lemmy id
+            if entry.get('lemmy_id') is not None:
+                post.watch(entry['lemmy_id'], entry.get('content_hash'))
+            db.add(post)
+            restored += 1
+        reddit_ids = [entry['reddit_id'] for entry in entries if entry['reddit_id']]
+        for outbox_entry in db.query(OutboxPost).filter(OutboxPost.reddit_id.in_(reddit_ids)):
+            Outbox.published(outbox_entry)
+        return restored
+
+    @classmethod
+    def recover(cls, db: DbSession, path: str) -> int:
+        """Save the journaled posts that aren't in the database yet, from `path` and the per-thread journals next to it"""
+        recovered = 0
+        for journal_path in [path] + sorted(glob.glob(glob.escape(path) + '.*')):
+            journal = cls(journal_path)
+            recovered += journal.restore(db)
+            db.commit()
+            journal.clear()
+        return recovered
+
+
+class UnitOfWork:
+    """Gathers published posts and community updates, and commits them together.
+
+    A commit happens when the caller is done with a community, or once MAX_PENDING posts or MAX_AGE have piled up.
+    Without a journal, every post is committed right away, since that's the only durable record. When a commit fails,
+    the journal is replayed into the session, and only cleared once those posts made it into the database after all.
+
+    The journal is local to the host. When other workers share the database, they'd publish the posts of a worker that
+    crashed once its leases expire, so `shared` has every publish committed before it's started (see Syncer).
+    """
+
+    def __init__(self, db: DbSession, journal: PublishJournal = None, max_pending: int = MAX_PENDING,
+                 max_age: timedelta = MAX_AGE, shared: bool = False):
+        self._db: DbSession = db
+        self.shared: bool = shared
+        self._journal: Optional[PublishJournal] = journal
+        self._max_pending: int = max_pending if journal else 1
+        self._max_age: timedelta = max_age
+        self._pending: int = 0
+        self._since: Optional[datetime] = None
+        self._rolled_back: bool = False  # The journaled posts still have to be put back into the session
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def add_post(self, post: Post):
+        if self._journal:
+            self._journal.append(post)
+        self._db.add(post)
+        self._pending += 1
+        self._since = self._since or datetime.utcnow()
+        if self._pending >= self._max_pending or datetime.utcnow() - self._since >= self._max_age:
+            self.commit()
+
+    def commit(self):
+        if self._rolled_back:
+            self._restore()
+        try:
+            self._db.commit()
+        except Exception:
+            self._db.rollback()
+            if self._journal:
+                self._rolled_back = True
+                try:
+                    self._restore()
+                except Exception as e:
+                    logger.error(f"Couldn't restore the published posts from the journal, retrying at the next commit: "
+                                 f"{str(e)}")
+            raise
+        if self._journal and self._pending:
+            self._journal.clear()
+        self._pending = 0
+        self._since = None
+
+    def _restore(self):
+        """The rollback took the published posts with it, put them back to be committed with the next batch"""
+        self._pending = self._journal.restore(self._db)
+        self._since = self._since or datetime.utcnow()
+        self._rolled_back = False
@@ -0,0 +1,98 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from requests import HTTPError
+from sqlalchemy.orm import Session as DbSession
+
+from lemmy.api import LemmyAPI
+from models.models import Post, PostDTO
+from reddit.reader import RedditReader, MULTI_LISTING_LIMIT
+from utils.syncer import Syncer
+
+WATCH_INTERVAL = timedelta(minutes=5)
+MAX_REQUESTS = 1  # Per run, each of them checks up to MULTI_LISTING_LIMIT posts
+RESERVE = 30  # Requests left in Reddit's window below which watching waits, they're for scraping
+REMOVE_REASON = 'Removed or deleted on Reddit'
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher:
+    """Keeps published posts in line with their originals on Reddit.
+
+    Every post is checked a few times, on the schedule of CHECK_AFTER. The ones that are due are fetched in batches
+    from /by_id, so a single request covers up to MULTI_LISTING_LIMIT posts. A post is only edited on Lemmy when the
+    content hash of its original changed, and removed when the original was. Watching only uses Reddit requests that
+    scraping can spare: it waits while the limiter is paused or the window runs low, and is capped per run.
+    """
+
+    def __init__(self, db: DbSession, reddit_reader: RedditReader, lemmy: LemmyAPI, max_requests: int = MAX_REQUESTS):
+        self._db: DbSession = db
+        self._reddit_reader: RedditReader = reddit_reader
+        self._lemmy: LemmyAPI = lemmy
+        self.max_requests: int = max_requests
+
+    def check_due(self) -> int:
+        """Check the posts that are due, returns how many were checked"""
+        checked = 0
+        for _ in range(self.max_requests):
+            if not self.has_headroom():
+                logger.debug('Not enough Reddit requests to spare for watching')
+                break
+            posts = self.due(MULTI_LISTING_LIMIT)
+            if not posts:
+                break
+            try:
+                originals = self._reddit_reader.get_posts_by_id([post.reddit_id for post in posts])
+            except HTTPError as e:
+                logger.error(f"Couldn't fetch the originals of {len(posts)} posts: {str(e)}")
+                break
+            for post in posts:
+                self.check(post, originals)
+            self._db.commit()
+            checked += len(posts)
+        return checked
+
+    def has_headroom(self) -> bool:
+        budget = self._reddit_reader.rate_limit.budget()
+        return not budget.paused_for and (budget.remaining is None or budget.remaining >= RESERVE)
+
+    def due(self, limit: int) -> List[Post]:
+        """Watched posts whose next check is due, the most overdue first"""
+        return self._db.query(Post) \
+            .filter(Post.next_check_at <= datetime.utcnow(), Post.reddit_id.isnot(None), Post.lemmy_id.isnot(None)) \
+            .order_by(Post.next_check_at).limit(limit).all()
+
+    def check(self, post: Post, originals: Dict[str, Optional[PostDTO]]):
+        """Bring a post in line with its original, and move it on to its next check"""
+        if post.reddit_id not in originals:
+            # Reddit returns nothing at all for some posts, better to leave those alone
+            logger.debug(f"Reddit didn't return {post.reddit_link}")
+            post.checked()
+            return
+
+        original = originals[post.reddit_id]
+        try:
+            if original is None:
+                logger.info(f"{post.reddit_link} is gone from Reddit, removing {post.lemmy_link}")
+                self._lemmy.remove_post(post_id=post.lemmy_id, removed=True, reason=REMOVE_REASON)
+                post.next_check_at = None
+                return
+            if not original.complete:
+                # Without a body to compare, it would look edited
+                post.checked()
+                return
+
+            content_hash = original.content_hash()
+            if post.content_hash is not None and content_hash != post.content_hash:
+                logger.info(f"{post.reddit_link} was edited, updating {post.lemmy_link}")
+                prepared = Syncer.prepare_post(original, post.community)
+                self._lemmy.edit_post(post_id=post.lemmy_id, name=prepared.title, body=prepared.body,
+                                      url=prepared.external_link, nsfw=prepared.nsfw)
+                post.nsfw = prepared.nsfw
+            post.content_hash = content_hash
+        except HTTPError as e:
+            # The hash stays as it was, so the next check tries again
+            logger.error(f"Couldn't update {post.lemmy_link} after {post.reddit_link} changed: {str(e)}")
+        post.checked()
@@ -1,13 +1,18 @@
 import os
 import sys
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Iterator, List
 
 # Magically get the correct path.
 PROJECT_PATH = os.getcwd()
 SOURCE_PATH = os.path.join(PROJECT_PATH, "src")
 sys.path.append(SOURCE_PATH)
 
-from models.models import Community, PostDTO, CommunityDTO, CommunityStats
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, Session
+
+from models.models import Base, Community, PostDTO, CommunityDTO, CommunityStats
 
 utc_now = datetime.utcnow()
 
@@ -25,10 +30,35 @@ TEST_POSTS = [
     PostDTO(reddit_link='https://www.reddit.com/r/blabla/3', title="post 3", author='/u/user3', created=utc_now, updated=utc_now, upvotes=42, upvote_ratio=0.7),
 ]
 
-LEMMY_POST_RETURN = {'post_view': {'post': {'ap_id': 5, 'body': 'blabla'}}}
+LEMMY_POST_RETURN = {'post_view': {'post': {'id': 5, 'ap_id': 5, 'body': 'blabla'}}}
 
 
 def get_test_data(filename: str) -> str:
     file_path = os.path.join(os.path.dirname(__file__), 'data', filename)
     with open(file_path, 'r') as file:
         return file.read()
+
+
+def create_test_db() -> Session:
+    """Fresh in-memory SQLite database with all tables"""
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+@contextmanager
+def query_budget(db: Session, budget: int) -> Iterator[List[str]]:
+    """Fails when the statements executed within the block exceed the budget, to catch N+1 queries"""
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert len(statements) <= budget, \
+        f"{len(statements)} statements, over the budget of {budget}:\n" + "\n".join(statements)
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests import HTTPError
+
+from models.models import PostDTO, SORT_NEW
+from reddit.async_reader import AsyncRedditReader, BackgroundRedditReader
+from utils.rate_limit import TokenBucket
+
+LISTING = {'data': {'children': [
+    {'data': {'permalink': '/r/stub/comments/abc123/first/', 'title': 'First', 'created_utc': 1690000000,
+              'author': 'someone', 'url': 'https://example.com/1', 'over_18': False, 'ups': 10, 'upvote_ratio': 0.9}},
+    {'data': {'permalink': '/r/stub/comments/def456/second/', 'title': 'Second', 'created_utc': 1690000100,
+              'author': 'someone_else', 'url': 'https://example.com/2', 'over_18': True, 'ups': 3,
+              'upvote_ratio': 0.6}},
+]}}
+
+POST_PAGE = """<html><body>
+<div data-timestamp="1690000000" data-nsfw="false" data-url="https://example.com/1">
+<div class="expando"><form><div class="md"><p>Hello <a href="/r/stub">stub</a></p></div></form></div>
+</div></body></html>"""
+
+
+class StubRedditHandler(BaseHTTPRequestHandler):
+    """Serves a listing and post pages, keeping track of the amount of simultaneous requests"""
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    paths = []
+    delay = 0.2
+    throttle_next = False
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            cls.paths.append(self.path)
+        try:
+            time.sleep(cls.delay)
+            if cls.throttle_next:
+                cls.throttle_next = False
+                self._respond(429, 'text/plain', 'slow down', {'Retry-After': '0.3'})
+            elif self.path.startswith('/r/stub/new/.json'):
+                self._respond(200, 'application/json', json.dumps(LISTING))
+            elif self.path.startswith('/r/stub/comments/'):
+                self._respond(200, 'text/html; charset=utf-8', POST_PAGE)
+            elif self.path.startswith('/r/adult/') and 'over18=1' not in self.headers.get('Cookie', ''):
+                self._respond(302, 'text/plain', '', {'Location': '/over18?dest=/r/adult/'})
+            elif self.path.startswith('/r/adult/') or self.path.startswith('/over18'):
+                self._respond(200, 'text/html; charset=utf-8', '<html></html>')
+            else:
+                self._respond(404, 'text/plain', 'not found')
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        # Accepting the over18 prompt
+        self._respond(200, 'text/html; charset=utf-8', '<html></html>', {'Set-Cookie': 'over18=1; Path=/'})
+
+    def _respond(self, status: int, content_type: str, body: str, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncRedditReaderTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubRedditHandler)
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubRedditHandler.max_in_flight = 0
+        StubRedditHandler.paths = []
+
+    def _post(self, ident: str) -> PostDTO:
+        return PostDTO(reddit_link=f'{self.base_url}/r/stub/comments/{ident}/', title=ident, author='/u/someone',
+                       created=datetime.utcnow(), updated=datetime.utcnow())
+
+    def _run(self, reader: AsyncRedditReader, coroutine):
+        async def run():
+            try:
+                return await coroutine
+            finally:
+                await reader.close()
+        return asyncio.run(run())
+
+    def test_get_subreddit_topics_json(self):
+        reader = AsyncRedditReader(bucket=TokenBucket(rate=100, capacity=10), base_url=self.base_url)
+
+        posts = self._run(reader, reader.get_subreddit_topics_json('stub', mode=SORT_NEW))
+
+        self.assertEqual(['First', 'Second'], [post.title for post in posts])
+        self.assertEqual('https://old.reddit.com/r/stub/comments/abc123/first/', posts[0].reddit_link)
+        self.assertEqual('/u/someone_else', posts[1].author)
+
+    def test_get_posts_details_keeps_requests_in_flight(self):
+        reader = AsyncRedditReader(bucket=TokenBucket(rate=100, capacity=10), max_in_flight=5,
+                                   base_url=self.base_url)
+        posts = [self._post(f'post{i}') for i in range(5)]
+
+        start = time.monotonic()
+        results = self._run(reader, reader.get_posts_details(posts))
+        duration = time.monotonic() - start
+
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(post.body.strip() == 'Hello [stub](https://old.reddit.com/r/stub)' for post in results))
+        self.assertGreater(StubRedditHandler.max_in_flight, 1)
+        self.assertLess(duration, 5 * StubRedditHandler.delay)
+
+    def test_token_bucket_limits_throughput(self):
+        reader = AsyncRedditReader(bucket=TokenBucket(rate=10, capacity=1), max_in_flight=5, base_url=self.base_url)
+        posts = [self._post(f'post{i}') for i in range(4)]
+
+        start = time.monotonic()
+        self._run(reader, reader.get_posts_details(posts))
+
+        # First one is free, the other three wait for a token each
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+    def test_get_posts_details_returns_errors(self):
+        reader = AsyncRedditReader(bucket=TokenBucket(rate=100, capacity=10), base_url=self.base_url)
+        missing = PostDTO(reddit_link=f'{self.base_url}/r/missing/', title='gone', author='/u/someone',
+                          created=datetime.utcnow(), updated=datetime.utcnow())
+
+        results = self._run(reader, reader.get_posts_details([self._post('exists'), missing]))
+
+        self.assertIsInstance(results[0], PostDTO)
+        self.assertIsInstance(results[1], HTTPError)
+        self.assertEqual(404, results[1].response.status_code)
+
+    def test_too_many_requests_is_retried_after_waiting(self):
+        StubRedditHandler.throttle_next = True
+        reader = AsyncRedditReader(bucket=TokenBucket(rate=100, capacity=10), base_url=self.base_url)
+
+        start = time.monotonic()
+        posts = self._run(reader, reader.get_subreddit_topics_json('stub', mode=SORT_NEW))
+
+        self.assertEqual(2, len(posts))
+        self.assertEqual(2, len(StubRedditHandler.paths))
+        self.assertGreaterEqual(time.monotonic() - start, 0.3 + 2 * StubRedditHandler.delay)
+
+    def test_nsfw_check_ignores_over18_consent(self):
+        # A hostname rather than an IP address, or the cookie jar would refuse the cookie anyway
+        base_url = self.base_url.replace('127.0.0.1', 'localhost')
+        reader = AsyncRedditReader(bucket=TokenBucket(rate=100, capacity=10), base_url=base_url)
+
+        async def consent_then_check():
+            before = await reader.is_sub_nsfw('adult')
+            # What _request does when it runs into the prompt, say for get_subreddit_info
+            await reader._request('POST', f'{base_url}/over18', {'over18': 'yes'})
+            consented = await reader._request('GET', f'{base_url}/r/adult/')
+            return before, consented, await reader.is_sub_nsfw('adult')
+
+        before, consented, after = self._run(reader, consent_then_check())
+
+        self.assertTrue(before)
+        self.assertNotIn('over18', consented.url)
+        self.assertTrue(after)
+
+    def test_background_reader_blocking_surface(self):
+        reader = BackgroundRedditReader(AsyncRedditReader(bucket=TokenBucket(rate=100, capacity=10),
+                                                          base_url=self.base_url))
+        try:
+            posts = reader.get_subreddit_topics_json('stub', mode=SORT_NEW)
+            post = reader.get_post_details(self._post('single'))
+        finally:
+            reader.close()
+
+        self.assertEqual(2, len(posts))
+        self.assertFalse(post.nsfw)
+        self.assertEqual('https://example.com/1', post.external_link)
+
+
+if __name__ == '__main__':
+    unittest.main()
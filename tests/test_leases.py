@@ -0,0 +1,54 @@
+import unittest
+from datetime import datetime, timedelta
+
+from models.models import Community, CommunityStats
+from tests import create_test_db
+from utils.leases import CommunityLeases
+
+
+class CommunityLeasesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = create_test_db()
+        for lemmy_id, ident in enumerate(['first', 'second', 'third'], start=1):
+            community = Community(lemmy_id=lemmy_id, ident=ident, enabled=True)
+            community.stats = CommunityStats(min_interval=60)
+            self.db.add(community)
+        self.db.commit()
+        self.alice = CommunityLeases('alice')
+        self.bob = CommunityLeases('bob')
+
+    def test_workers_claim_different_communities(self):
+        alices = self.alice.claim_due(self.db, 2)
+        bobs = self.bob.claim_due(self.db, 2)
+
+        self.assertEqual(['first', 'second'], [c.ident for c in alices])
+        self.assertEqual(['third'], [c.ident for c in bobs])
+        self.assertEqual([], self.alice.claim_due(self.db, 2))
+        self.assertEqual('bob', bobs[0].claimed_by)
+
+    def test_released_communities_can_be_claimed_again(self):
+        community = self.alice.claim_due(self.db, 1)[0]
+        self.bob.release(self.db, community.id)  # Not bob's to release
+        self.assertEqual(['second', 'third'], [c.ident for c in self.bob.claim_due(self.db, 3)])
+
+        self.alice.release(self.db, community.id)
+        self.assertEqual(['first'], [c.ident for c in self.alice.claim_due(self.db, 3)])
+
+    def test_expired_lease_moves_to_another_worker(self):
+        community = self.alice.claim_due(self.db, 1)[0]
+        community.lease_until = datetime.utcnow() - timedelta(seconds=1)  # Alice died
+        self.db.commit()
+
+        self.assertIn(community, self.bob.claim_due(self.db, 3))
+        self.assertFalse(self.alice.renew(self.db, community.id))
+        self.assertTrue(self.bob.renew(self.db, community.id))
+
+    def test_release_all(self):
+        self.alice.claim_due(self.db, 3)
+        self.alice.release_all(self.db)
+
+        self.assertEqual(3, len(self.bob.claim_due(self.db, 3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
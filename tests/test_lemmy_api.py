@@ -0,0 +1,171 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlparse, parse_qs
+
+import jwt
+
+from lemmy import auth
+from lemmy.api import LemmyAPI
+
+
+class StubLemmyHandler(BaseHTTPRequestHandler):
+    """Minimal keep-alive Lemmy, remembering which connection each request came in on"""
+    protocol_version = 'HTTP/1.1'
+    connections = []
+    logins = 0
+    valid_tokens = set()
+    claims = {}  # Claims of the next token handed out
+    throttle_next = False
+
+    def do_GET(self):
+        cls = type(self)
+        cls.connections.append(self.client_address)
+        if cls.throttle_next:
+            cls.throttle_next = False
+            return self._respond(429, {'error': 'rate_limit_error'}, {'Retry-After': '0.5'})
+        url = urlparse(self.path)
+        if url.path == '/api/v3/post/list':
+            if parse_qs(url.query).get('auth', [''])[0] not in cls.valid_tokens:
+                return self._respond(401, {'error': 'not_logged_in'})
+            return self._respond(200, {'posts': []})
+        self._respond(200, {'site_view': {}})
+
+    def do_POST(self):
+        cls = type(self)
+        self.rfile.read(int(self.headers['Content-Length']))
+        cls.logins += 1
+        token = jwt.encode({'sub': 1, 'iat': int(time.time()), 'n': cls.logins, **cls.claims}, 'secret')
+        cls.valid_tokens.add(token)
+        self._respond(200, {'jwt': token})
+
+    def _respond(self, status: int, body: dict, headers: dict = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class LemmyAPITestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubLemmyHandler)
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubLemmyHandler.connections = []
+        StubLemmyHandler.logins = 0
+        StubLemmyHandler.valid_tokens = set()
+        StubLemmyHandler.claims = {}
+        StubLemmyHandler.throttle_next = False
+        self.subject = LemmyAPI(base_url=self.base_url, pool_size=2, read_rate=100, write_rate=100)
+
+    def tearDown(self):
+        self.subject.close()
+
+    def test_requests_reuse_connection(self):
+        for _ in range(3):
+            self.subject.get_info()
+
+        self.assertEqual(3, len(StubLemmyHandler.connections))
+        self.assertEqual(1, len(set(StubLemmyHandler.connections)))
+
+    def test_token_is_decoded_once(self):
+        with mock.patch.object(auth.jwt, 'decode', wraps=jwt.decode) as decode:
+            for _ in range(3):
+                self.subject.get_posts(auth_required=True)
+
+        self.assertEqual(1, StubLemmyHandler.logins)
+        decode.assert_called_once()
+
+    def test_expiry_comes_from_exp(self):
+        # Issued long ago, but still valid for a day
+        StubLemmyHandler.claims = {'iat': int(time.time()) - 7200, 'exp': int(time.time()) + 86400}
+
+        self.subject.get_posts(auth_required=True)
+        self.subject.get_posts(auth_required=True)
+
+        self.assertEqual(1, StubLemmyHandler.logins)
+
+    def test_rejected_token_is_retried_once(self):
+        self.subject.get_posts(auth_required=True)
+        StubLemmyHandler.valid_tokens.clear()
+
+        self.subject.get_posts(auth_required=True)
+
+        self.assertEqual(2, StubLemmyHandler.logins)
+
+    @mock.patch.object(auth, 'MIN_REFRESH_DELAY', 0.5)
+    def test_token_is_refreshed_before_expiry(self):
+        self.subject._auth = auth.LemmyAuth(self.subject.login, margin=0)
+        # Expires in one to two seconds, since exp is a whole second
+        StubLemmyHandler.claims = {'exp': int(time.time()) + 2}
+
+        self.subject.get_posts(auth_required=True)
+        StubLemmyHandler.claims = {'exp': int(time.time()) + 3600}
+        time.sleep(2.5)
+
+        # Refreshed by the background timer, without any request asking for it
+        self.assertEqual(2, StubLemmyHandler.logins)
+
+    def test_short_lived_token_is_reused(self):
+        login = mock.Mock(side_effect=lambda: jwt.encode({'exp': int(time.time()) + 10}, 'secret'))
+        subject = auth.LemmyAuth(login, margin=60)
+
+        # Already past its refresh time when it's received, but good for MIN_REFRESH_DELAY anyway
+        self.assertEqual(subject.token(), subject.token())
+
+        login.assert_called_once()
+        subject.close()
+
+    def test_throttled_request_waits_and_retries(self):
+        StubLemmyHandler.throttle_next = True
+
+        start = time.monotonic()
+        response = self.subject.get_info()
+
+        self.assertEqual({'site_view': {}}, response)
+        self.assertEqual(2, len(StubLemmyHandler.connections))
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+
+    def test_writes_are_paced_separately_from_reads(self):
+        subject = LemmyAPI(base_url=self.base_url, read_rate=100, write_rate=5)
+
+        start = time.monotonic()
+        for _ in range(3):
+            subject.login()
+        writes_done = time.monotonic()
+        for _ in range(3):
+            subject.get_info()
+
+        # Two writes had to wait for a token, the reads didn't have to wait behind them
+        self.assertGreaterEqual(writes_done - start, 0.4)
+        self.assertLess(time.monotonic() - writes_done, 0.2)
+        subject.close()
+
+    def test_edit_post_payload(self):
+        with mock.patch.object(self.subject, '_make_request') as make_request:
+            self.subject.edit_post(post_id=3, name='Edited', body='New body', nsfw=False)
+
+        make_request.assert_called_once_with('PUT', '/post', data={'post_id': 3, 'body': 'New body', 'name': 'Edited',
+                                                                   'nsfw': False}, auth_required=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
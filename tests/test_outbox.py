@@ -0,0 +1,120 @@
+import unittest
+from datetime import datetime, timedelta
+
+from models.models import Community, OutboxPost, Post, PostDTO, OUTBOX_FAILED, OUTBOX_PENDING, OUTBOX_PUBLISHED, \
+    OUTBOX_PUBLISHING
+from tests import create_test_db
+from utils.outbox import Outbox, ABANDONED_AFTER, MAX_ATTEMPTS, PURGE_INTERVAL, RETENTION, RETRY_DELAY
+
+
+class OutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = create_test_db()
+        self.community = Community(lemmy_id=1, ident='test', enabled=True)
+        self.db.add(self.community)
+        self.db.commit()
+        self.outbox = Outbox(self.db)
+
+    @staticmethod
+    def _post(i: int) -> PostDTO:
+        now = datetime.utcnow()
+        return PostDTO(reddit_link=f'https://old.reddit.com/r/test/comments/post{i}/', title=f'post {i}',
+                       author='/u/someone', created=now, updated=now, body='Prepared', fullname=f't3_post{i}')
+
+    def test_add_skips_queued_posts(self):
+        self.outbox.add(self.community, [self._post(1), self._post(2)])
+        self.outbox.add(self.community, [self._post(2), self._post(3)])
+
+        entries = self.outbox.due(self.community.id)
+        self.assertEqual(['post 1', 'post 2', 'post 3'], [entry.dto.title for entry in entries])
+        self.assertEqual('Prepared', entries[0].dto.body)
+        self.assertEqual(3, self.outbox.waiting(self.community.id))
+
+    def test_failed_entries_back_off(self):
+        self.outbox.add(self.community, [self._post(1)])
+        entry = self.outbox.due(self.community.id)[0]
+
+        self.outbox.start(entry)
+        self.outbox.failed(entry, 'Lemmy is down')
+        self.assertEqual([], self.outbox.due(self.community.id))
+        self.assertEqual(0, self.outbox.waiting(self.community.id))
+        first_delay = entry.next_attempt_at - datetime.utcnow()
+        self.assertAlmostEqual(RETRY_DELAY.total_seconds(), first_delay.total_seconds(), delta=5)
+
+        entry.next_attempt_at = datetime.utcnow()
+        self.assertEqual([entry], self.outbox.due(self.community.id))
+        self.outbox.start(entry)
+        self.outbox.failed(entry, 'Lemmy is still down')
+        second_delay = entry.next_attempt_at - datetime.utcnow()
+        self.assertAlmostEqual(2 * RETRY_DELAY.total_seconds(), second_delay.total_seconds(), delta=5)
+
+    def test_gives_up_after_max_attempts(self):
+        self.outbox.add(self.community, [self._post(1)])
+        entry = self.outbox.due(self.community.id)[0]
+        entry.attempts = MAX_ATTEMPTS - 1
+
+        self.outbox.start(entry)
+        self.outbox.failed(entry, 'Nope')
+
+        self.assertEqual(OUTBOX_FAILED, entry.state)
+        self.assertIsNone(entry.next_attempt_at)
+        self.assertEqual([], self.outbox.due(self.community.id))
+
+    def test_recover(self):
+        self.outbox.add(self.community, [self._post(1), self._post(2), self._post(3)])
+        first, second, third = self.outbox.due(self.community.id)
+        for entry in [first, second]:
+            self.outbox.start(entry)
+        # The first one made it to Lemmy (and the journal) before the crash, the second one didn't
+        self.db.add(Post(reddit_link=first.dto.reddit_link, reddit_id=first.reddit_id, lemmy_link='https://lemmy/1',
+                         updated=datetime.utcnow(), nsfw=False, community=self.community))
+        self.db.commit()
+
+        self.assertEqual(2, self.outbox.recover())
+
+        self.assertEqual([OUTBOX_PUBLISHED, OUTBOX_PENDING, OUTBOX_PENDING], [first.state, second.state, third.state])
+        self.assertEqual([second, third], self.outbox.due(self.community.id))
+
+    def test_shared_recover_leaves_publishing_to_the_reconciler(self):
+        self.outbox.add(self.community, [self._post(1), self._post(2)])
+        publishing, pending = self.outbox.due(self.community.id)
+        self.outbox.start(publishing)
+        self.db.commit()
+
+        self.assertEqual(2, self.outbox.recover(exclusive=False))
+
+        # Another worker might still be at it, or it made it to Lemmy after all
+        self.assertEqual(OUTBOX_PUBLISHING, publishing.state)
+        self.assertEqual([pending], self.outbox.due(self.community.id))
+        self.assertEqual([], self.outbox.settled())
+
+        publishing.next_attempt_at -= ABANDONED_AFTER
+        self.assertEqual([publishing], self.outbox.settled())
+        self.assertAlmostEqual(0, (datetime.utcnow() - ABANDONED_AFTER - Outbox.attempted_at(publishing))
+                               .total_seconds(), delta=5)
+
+    def test_purge(self):
+        self.outbox.add(self.community, [self._post(1), self._post(2), self._post(3)])
+        old, recent, unpublished = self.outbox.due(self.community.id)
+        for entry in [old, recent]:
+            self.outbox.published(entry)
+        old.created = datetime.utcnow() - RETENTION - timedelta(minutes=1)
+        unpublished.created = old.created
+        self.db.commit()
+
+        self.assertEqual(1, self.outbox.purge())
+
+        self.assertEqual(['post 2', 'post 3'], [entry.dto.title for entry in self.db.query(OutboxPost).all()])
+
+    def test_next_purge(self):
+        self.assertLessEqual(self.outbox.next_purge(), datetime.utcnow())
+
+        self.outbox.purge()
+
+        # Reloading the schedule doesn't bring it forward
+        self.assertEqual(self.outbox.purged_at + PURGE_INTERVAL, self.outbox.next_purge())
+        self.assertGreater(self.outbox.next_purge(), datetime.utcnow() + PURGE_INTERVAL - timedelta(minutes=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from lemmy.api import LemmyAPI
+from models.models import Base, Community, CommunityStats, Post, PostDTO
+from reddit.reader import RedditReader
+from tests import LEMMY_POST_RETURN
+from utils.pipeline import Pipeline
+
+
+class PipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        # A file, since every stage uses a connection of its own
+        handle, self.db_path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        engine = create_engine(f'sqlite:///{self.db_path}')
+        Base.metadata.create_all(engine)
+        self.session_factory = sessionmaker(bind=engine)
+        self.db = self.session_factory()
+        for lemmy_id, ident in enumerate(['first', 'second'], start=1):
+            community = Community(lemmy_id=lemmy_id, ident=ident, enabled=True)
+            community.stats = CommunityStats(min_interval=60)
+            self.db.add(community)
+        self.db.commit()
+
+        self.reddit_reader = MagicMock(spec=RedditReader)
+        self.reddit_reader.get_subreddit_topics_json.side_effect = self._listing
+        self.reddit_reader.get_posts_details.side_effect = lambda posts: posts
+        self.lemmy_api = MagicMock(spec=LemmyAPI, base_url='https://foo.bar')
+        self.lemmy_api.create_post.return_value = LEMMY_POST_RETURN
+        self.done = threading.Semaphore(0)
+        self.pipeline = Pipeline(session_factory=self.session_factory, db=self.db, reddit_reader=self.reddit_reader,
+                                 lemmy=self.lemmy_api, thresh_upvotes=5, thresh_ratio=0.5, listing_workers=1,
+                                 enrich_workers=1, publish_workers=1, on_done=self.done.release)
+
+    def tearDown(self):
+        self.pipeline.stop()
+        self.db.close()
+        os.remove(self.db_path)
+
+    @staticmethod
+    def _listing(ident: str, mode: str, cursor=None):
+        now = datetime.utcnow()
+        return [PostDTO(reddit_link=f'https://old.reddit.com/r/{ident}/comments/{ident}{i}/', title=f'{ident} {i}',
+                        author='/u/someone', created=now, updated=now, upvotes=10, fullname=f't3_{ident}{i}',
+                        subreddit=ident, complete=True) for i in range(2)]
+
+    def _wait_for(self, amount: int):
+        for _ in range(amount):
+            self.assertTrue(self.done.acquire(timeout=5))
+
+    def test_scrapes_and_publishes_due_communities(self):
+        self.pipeline.start()
+
+        self.assertEqual(2, self.pipeline.submit_due())
+        self._wait_for(2)
+
+        self.assertEqual(4, self.lemmy_api.create_post.call_count)
+        self.assertEqual(4, self.db.query(Post).count())
+        self.db.expire_all()
+        self.assertTrue(all(community.last_scrape for community in self.db.query(Community).all()))
+        self.assertEqual(set(), self.pipeline.in_flight)
+        self.assertGreater(self.pipeline.next_due(), datetime.utcnow())
+
+    def test_listing_goes_on_while_publishing_is_slow(self):
+        release = threading.Event()
+        self.lemmy_api.create_post.side_effect = lambda **kwargs: release.wait(5) and LEMMY_POST_RETURN
+        self.pipeline.start()
+
+        self.pipeline.submit_due()
+        deadline = time.monotonic() + 5
+        while (self.reddit_reader.get_subreddit_topics_json.call_count < 2 or not self.lemmy_api.create_post.called) \
+                and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # Both listings are done, while the first post is still being published
+        self.assertEqual(2, self.reddit_reader.get_subreddit_topics_json.call_count)
+        self.assertEqual(1, self.lemmy_api.create_post.call_count)
+        # Communities in flight are not handed out again
+        self.assertEqual(0, self.pipeline.submit_due())
+
+        release.set()
+        self._wait_for(2)
+        self.assertEqual(4, self.lemmy_api.create_post.call_count)
+
+    def test_budget_leaves_posts_for_the_next_turn(self):
+        self.pipeline = Pipeline(session_factory=self.session_factory, db=self.db, reddit_reader=self.reddit_reader,
+                                 lemmy=self.lemmy_api, thresh_upvotes=5, thresh_ratio=0.5, listing_workers=1,
+                                 enrich_workers=1, publish_workers=1, on_done=self.done.release, max_posts=1)
+        self.pipeline.start()
+
+        self.assertEqual(2, self.pipeline.submit_due())
+        self._wait_for(2)
+        self.db.expire_all()
+        self.assertTrue(all(community.pending and not community.last_scrape
+                            for community in self.db.query(Community).all()))
+
+        # Still due, and resumed without listing again
+        self.assertEqual(2, self.pipeline.submit_due())
+        self._wait_for(2)
+        self.db.expire_all()
+        self.assertEqual(2, self.reddit_reader.get_subreddit_topics_json.call_count)
+        self.assertEqual(4, self.db.query(Post).count())
+        self.assertTrue(all(community.pending is None and community.last_scrape
+                            for community in self.db.query(Community).all()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from unittest.mock import MagicMock
+
+from utils.rate_limit import TokenBucket, RateLimitController, retry_after
+
+
+def response(status_code: int = 200, **headers) -> MagicMock:
+    return MagicMock(status_code=status_code, headers={key.replace('_', '-'): value for key, value in headers.items()})
+
+
+class RateLimitControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bucket = TokenBucket(rate=1 / 3)
+        self.subject = RateLimitController(self.bucket, reserve=2)
+
+    def test_rate_follows_headers(self):
+        self.subject.update(response(**{'X-Ratelimit-Remaining': '62', 'X-Ratelimit-Used': '38',
+                                        'X-Ratelimit-Reset': '120'}))
+
+        budget = self.subject.budget()
+        self.assertAlmostEqual(0.5, self.bucket.rate)
+        self.assertEqual(62, budget.remaining)
+        self.assertAlmostEqual(120, budget.reset_in, delta=1)
+        self.assertEqual(0, budget.paused_for)
+
+    def test_exhausted_window_pauses_until_reset(self):
+        self.subject.update(response(**{'X-Ratelimit-Remaining': '1', 'X-Ratelimit-Reset': '30'}))
+
+        self.assertAlmostEqual(30, self.subject.budget().paused_for, delta=1)
+        self.assertGreater(self.subject.delay(), 29)
+
+    def test_too_many_requests_honours_retry_after(self):
+        self.subject.update(response(429, Retry_After='15'))
+
+        self.assertAlmostEqual(15, self.subject.budget().paused_for, delta=1)
+
+    def test_too_many_requests_without_retry_after_waits_for_reset(self):
+        self.subject.update(response(429, **{'X-Ratelimit-Remaining': '0', 'X-Ratelimit-Reset': '42'}))
+
+        self.assertAlmostEqual(42, self.subject.budget().paused_for, delta=1)
+
+    def test_missing_headers_keep_pacing(self):
+        self.subject.update(response())
+
+        self.assertAlmostEqual(1 / 3, self.bucket.rate)
+        self.assertIsNone(self.subject.budget().remaining)
+
+    def test_retry_after_http_date(self):
+        when = datetime.now(timezone.utc) + timedelta(seconds=90)
+
+        self.assertAlmostEqual(90, retry_after(response(Retry_After=format_datetime(when, usegmt=True)), 5), delta=2)
+        self.assertEqual(5, retry_after(response(Retry_After='soon'), 5))
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_reserve(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        self.assertAlmostEqual(0.5, bucket.reserve(), delta=0.05)
+
+    def test_set_rate(self):
+        bucket = TokenBucket(rate=1)
+        bucket.reserve()
+        bucket.set_rate(10)
+
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
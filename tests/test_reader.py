@@ -3,7 +3,7 @@ import unittest
 from unittest import mock
 from unittest.mock import MagicMock
 
-from models.models import CommunityDTO
+from models.models import CommunityDTO, SORT_NEW, ListingCursor
 from reddit.reader import RedditReader
 from tests import get_test_data
 
@@ -45,6 +45,94 @@ class RedditReaderTestCase(unittest.TestCase):
         self.subject.is_sub_nsfw.assert_called_once_with('todayilearned')
         self.subject._request.assert_called_once_with('GET', 'https://old.reddit.com/r/todayilearned/')
 
+    def test_get_multi_subreddit_topics_json(self):
+        def child(subreddit: str, title: str) -> dict:
+            return {'data': {'permalink': f'/r/{subreddit}/comments/{title}/', 'title': title, 'created_utc': 1690000000,
+                             'author': 'someone', 'subreddit': subreddit}}
+        self.subject._request.return_value = MagicMock(json=MagicMock(return_value={'data': {'children': [
+            child('Foo', 'a'), child('bar', 'b'), child('Foo', 'c')
+        ]}}))
+
+        grouped = self.subject.get_multi_subreddit_topics_json(['foo', 'bar', 'quiet'], mode=SORT_NEW)
+
+        self.assertEqual({'foo': ['a', 'c'], 'bar': ['b'], 'quiet': []},
+                         {sub: [post.title for post in posts] for sub, posts in grouped.items()})
+        self.subject._request.assert_called_once_with('GET', 'https://old.reddit.com/r/foo+bar+quiet/new/.json?sort=new',
+                                                      params={'limit': 100})
+
+    def test_get_subreddit_topics_json_with_listing_details(self):
+        self.subject.listing_details = True
+        base = {'created_utc': 1690000000, 'author': 'someone', 'subreddit': 'foo', 'over_18': False}
+        self.subject._request.return_value = MagicMock(json=MagicMock(return_value={'data': {'children': [
+            {'data': {**base, 'permalink': '/r/foo/comments/a/', 'title': 'self', 'is_self': True,
+                      'url': 'https://www.reddit.com/r/foo/comments/a/', 'selftext': 'Hi [there](/r/foo)',
+                      'selftext_html': '&lt;!-- SC_OFF --&gt;&lt;div class="md"&gt;&lt;p&gt;Hi '
+                                       '&lt;a href="/r/foo"&gt;there&lt;/a&gt;&lt;/p&gt;&lt;/div&gt;'}},
+            {'data': {**base, 'permalink': '/r/foo/comments/b/', 'title': 'link', 'is_self': False,
+                      'url': 'https://example.com/b', 'selftext': '', 'selftext_html': None, 'over_18': True}},
+            {'data': {**base, 'permalink': '/r/foo/comments/c/', 'title': 'no html', 'is_self': True,
+                      'url': 'https://www.reddit.com/r/foo/comments/c/', 'selftext': 'Hi', 'selftext_html': None}},
+        ]}}))
+
+        own, link, missing = self.subject.get_subreddit_topics_json('foo')
+
+        self.assertTrue(own.complete)
+        self.assertEqual('Hi [there](https://old.reddit.com/r/foo)', own.body.strip())
+        self.assertIsNone(own.external_link)
+        self.assertTrue(link.complete)
+        self.assertTrue(link.nsfw)
+        self.assertIsNone(link.body)
+        self.assertEqual('https://example.com/b', link.external_link)
+        # Without the html version of the body, the detail page is still needed
+        self.assertFalse(missing.complete)
+
+    def test_get_posts_by_id(self):
+        base = {'created_utc': 1690000000, 'author': 'someone', 'subreddit': 'foo', 'over_18': False, 'is_self': False,
+                'selftext': '', 'selftext_html': None}
+        self.subject._request.return_value = MagicMock(json=MagicMock(return_value={'data': {'children': [
+            {'data': {**base, 'name': 't3_a', 'permalink': '/r/foo/comments/a/', 'title': 'up',
+                      'url': 'https://example.com/a', 'author': '[deleted]'}},
+            {'data': {**base, 'name': 't3_b', 'permalink': '/r/foo/comments/b/', 'title': 'removed',
+                      'url': 'https://example.com/b', 'removed_by_category': 'moderator'}},
+            {'data': {**base, 'name': 't3_c', 'permalink': '/r/foo/comments/c/', 'title': 'deleted', 'is_self': True,
+                      'url': 'https://www.reddit.com/r/foo/comments/c/', 'selftext': '[deleted]'}},
+        ]}}))
+
+        posts = self.subject.get_posts_by_id(['t3_a', 't3_b', 't3_c', 't3_d'])
+
+        self.subject._request.assert_called_once_with('GET', 'https://old.reddit.com/by_id/t3_a,t3_b,t3_c,t3_d.json',
+                                                      params={'limit': 100})
+        self.assertEqual(['t3_a', 't3_b', 't3_c'], list(posts))
+        # A deleted account leaves the post up, and the details are parsed without listing_details
+        self.assertTrue(posts['t3_a'].complete)
+        self.assertEqual('https://example.com/a', posts['t3_a'].external_link)
+        self.assertIsNone(posts['t3_b'])
+        self.assertIsNone(posts['t3_c'])
+
+    def test_get_subreddit_topics_json_with_cursor(self):
+        cursor = ListingCursor(fullname='t3_abc', etag='"v1"', last_modified='Sat, 01 Jul 2023 10:00:00 GMT')
+        self.subject._request.return_value = MagicMock(status_code=200, headers={'ETag': '"v2"'},
+                                                       json=MagicMock(return_value={'data': {'children': []}}))
+
+        self.subject.get_subreddit_topics_json('foo', mode=SORT_NEW, cursor=cursor)
+
+        self.subject._request.assert_called_once_with(
+            'GET', 'https://old.reddit.com/r/foo/new/.json?sort=new',
+            headers={'If-None-Match': '"v1"', 'If-Modified-Since': 'Sat, 01 Jul 2023 10:00:00 GMT'},
+            params={'before': 't3_abc', 'limit': 100}
+        )
+        self.assertEqual('"v2"', cursor.etag)
+        self.assertIsNone(cursor.last_modified)
+
+    def test_get_subreddit_topics_json_not_modified(self):
+        cursor = ListingCursor(etag='"v1"')
+        self.subject._request.return_value = MagicMock(status_code=304)
+
+        posts = self.subject.get_subreddit_topics_json('foo', cursor=cursor)
+
+        self.assertEqual([], posts)
+        self.assertEqual('"v1"', cursor.etag)
+
     def test_is_sub_nsfw(self):
         self.assertTrue(self.subject.is_sub_nsfw('gonewildaudio'))
 
@@ -0,0 +1,119 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from lemmy.api import LemmyAPI
+from models.models import Community, Post, PostDTO, OUTBOX_PENDING, OUTBOX_PUBLISHED
+from tests import create_test_db
+from utils.outbox import Outbox
+from utils.reconciler import Reconciler, PAGE_SIZE, MAX_PAGES
+
+
+class ReconcilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = create_test_db()
+        self.community = Community(lemmy_id=7, ident='test', enabled=True)
+        self.db.add(self.community)
+        self.db.commit()
+        self.outbox = Outbox(self.db)
+        self.lemmy_api = MagicMock(spec=LemmyAPI)
+        self.reconciler = Reconciler(self.db, self.lemmy_api)
+
+    def _timed_out(self, *names: str) -> list:
+        """Outbox entries that timed out a while ago"""
+        now = datetime.utcnow()
+        self.outbox.add(self.community, [
+            PostDTO(reddit_link=f'https://old.reddit.com/r/test/comments/{name}/', title=f'Title of {name}',
+                    author='/u/someone', created=now, updated=now, external_link=f'https://i.imgur.com/{name}.png',
+                    fullname=f't3_{name}', body=f'Archived from https://old.reddit.com/r/test/comments/{name}/')
+            for name in names])
+        entries = self.outbox.due(self.community.id)
+        for entry in entries:
+            self.outbox.start(entry)
+            self.outbox.uncertain(entry)
+            entry.next_attempt_at = now - timedelta(seconds=1)
+        self.db.commit()
+        return entries
+
+    @staticmethod
+    def _lemmy_post(post_id: int, minutes_ago: int, name: str = 'Something else', body: str = '', url: str = None):
+        published = (datetime.utcnow() - timedelta(minutes=minutes_ago)).isoformat()
+        return {'post': {'id': post_id, 'ap_id': f'https://lemmy/post/{post_id}', 'name': name, 'body': body,
+                         'url': url, 'published': published}}
+
+    def test_found_posts_are_saved_and_missing_ones_requeued(self):
+        by_body, by_title, missing = self._timed_out('body', 'title', 'missing')
+        self.lemmy_api.get_posts.return_value = {'posts': [
+            self._lemmy_post(3, 1, body='Archived from https://old.reddit.com/r/test/comments/body/'),
+            self._lemmy_post(2, 2, name='Title of title', url='https://i.imgur.com/title.png'),
+            self._lemmy_post(1, 3, name='Title of missing', url='https://i.imgur.com/elsewhere.png'),
+        ]}
+
+        self.assertEqual(3, self.reconciler.reconcile())
+
+        self.lemmy_api.get_posts.assert_called_once_with(community_id=7, sort='New', limit=PAGE_SIZE, page=1,
+                                                         auth_required=True)
+        self.assertEqual({'t3_body': 'https://lemmy/post/3', 't3_title': 'https://lemmy/post/2'},
+                         {post.reddit_id: post.lemmy_link for post in self.db.query(Post).all()})
+        # Watched for edits, like any other published post
+        self.assertEqual({3, 2}, {post.lemmy_id for post in self.db.query(Post).all()})
+        self.assertEqual([OUTBOX_PUBLISHED, OUTBOX_PUBLISHED, OUTBOX_PENDING],
+                         [by_body.state, by_title.state, missing.state])
+        self.assertEqual([missing], self.outbox.due(self.community.id))
+
+    def test_sweeps_pages_until_older_than_the_time_out(self):
+        self._timed_out('missing')
+        recent_page = {'posts': [self._lemmy_post(i, 0) for i in range(PAGE_SIZE)]}
+        old_page = {'posts': [self._lemmy_post(i, 60) for i in range(PAGE_SIZE)]}
+        self.lemmy_api.get_posts.side_effect = [recent_page, old_page]
+
+        self.assertEqual(1, self.reconciler.reconcile())
+
+        self.assertEqual([1, 2], [call.kwargs['page'] for call in self.lemmy_api.get_posts.call_args_list])
+
+    def test_unfinished_sweep_settles_nothing_missing(self):
+        entry, = self._timed_out('missing')
+        self.lemmy_api.get_posts.return_value = {'posts': [self._lemmy_post(i, 0) for i in range(PAGE_SIZE)]}
+
+        self.assertEqual(0, self.reconciler.reconcile())
+
+        self.assertEqual(MAX_PAGES, self.lemmy_api.get_posts.call_count)
+        self.assertEqual([entry], self.outbox.settled())
+
+    def test_placeholders_are_fixed_once(self):
+        for name in ['found', 'gone']:
+            self.db.add(Post(reddit_link=f'https://www.reddit.com/r/test/comments/{name}/', reddit_id=f't3_{name}',
+                             lemmy_link='https://some.post.in/test', updated=datetime.utcnow() - timedelta(hours=1),
+                             nsfw=False, community=self.community))
+        self.db.commit()
+        self.lemmy_api.get_posts.return_value = {'posts': [
+            self._lemmy_post(1, 30, body='The original was posted on https://old.reddit.com/r/test/comments/found/')]}
+
+        self.assertEqual(2, self.reconciler.reconcile())
+        self.assertEqual(0, self.reconciler.reconcile())
+
+        self.assertEqual({'t3_found': 'https://lemmy/post/1'},
+                         {post.reddit_id: post.lemmy_link for post in self.db.query(Post).all()})
+        self.lemmy_api.get_posts.assert_called_once()
+
+    def test_nsfw_posts_are_found(self):
+        self.community.nsfw = True
+        entry, = self._timed_out('nsfw')
+        nsfw_post = self._lemmy_post(1, 1, body='Archived from https://old.reddit.com/r/test/comments/nsfw/')
+        # Like Lemmy, NSFW posts only show up for a logged in user
+        self.lemmy_api.get_posts.side_effect = \
+            lambda auth_required=False, **kwargs: {'posts': [nsfw_post] if auth_required else []}
+
+        self.assertEqual(1, self.reconciler.reconcile())
+
+        self.assertEqual(OUTBOX_PUBLISHED, entry.state)
+        self.assertEqual(['t3_nsfw'], [post.reddit_id for post in self.db.query(Post).all()])
+
+    def test_published_timestamps(self):
+        self.assertEqual(datetime(2023, 7, 1, 12), Reconciler.published({'published': '2023-07-01T12:00:00'}))
+        self.assertEqual(datetime(2023, 7, 1, 12), Reconciler.published({'published': '2023-07-01T12:00:00Z'}))
+        self.assertEqual(datetime(2023, 7, 1, 12), Reconciler.published({'published': '2023-07-01T14:00:00+02:00'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta
+
+from utils.scheduler import Job, Scheduler
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler(max_idle=timedelta(seconds=5), min_delay=timedelta(0))
+        self.runs = []
+
+    def _job(self, name: str, due: datetime, again: timedelta = None, load=None) -> Job:
+        def run():
+            self.runs.append(name)
+            if len(self.runs) >= 4:
+                self.scheduler.stop()
+            return datetime.utcnow() + again if again else None
+        return Job(name, run=run, load=load or (lambda: due))
+
+    def _run(self, timeout: float = 3):
+        thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.scheduler.stop()
+        thread.join()
+
+    def test_runs_jobs_in_order_of_due_time(self):
+        now = datetime.utcnow()
+        self.scheduler.add(self._job('later', now + timedelta(milliseconds=400)))
+        self.scheduler.add(self._job('first', now - timedelta(seconds=1)))
+        self.scheduler.add(self._job('repeat', now + timedelta(milliseconds=100), again=timedelta(milliseconds=200)))
+
+        self._run()
+
+        self.assertEqual(['first', 'repeat', 'repeat', 'later'], self.runs)
+
+    def test_sleeps_until_due(self):
+        self.scheduler.add(self._job('job', datetime.utcnow() + timedelta(milliseconds=300)))
+
+        start = time.monotonic()
+        thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        thread.start()
+        while not self.runs and time.monotonic() - start < 3:
+            time.sleep(0.01)
+        self.scheduler.stop()
+        thread.join()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        job = self.scheduler.jobs[0]
+        self.assertEqual(1, job.runs)
+        self.assertLess(job.lateness, timedelta(milliseconds=100))
+
+    def test_wake_reloads_due_times(self):
+        due = [datetime.utcnow() + timedelta(hours=1)]
+        self.scheduler.add(self._job('job', due[0], load=lambda: due[0]))
+        thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        thread.start()
+        time.sleep(0.1)
+
+        due[0] = datetime.utcnow()
+        self.scheduler.wake()
+        time.sleep(0.2)
+        self.scheduler.stop()
+        thread.join()
+
+        self.assertEqual(['job'], self.runs)
+
+    def test_reloads_every_max_idle_while_jobs_keep_it_busy(self):
+        self.scheduler = Scheduler(max_idle=timedelta(milliseconds=300), min_delay=timedelta(0))
+        loads = []
+
+        def load() -> datetime:
+            loads.append(datetime.utcnow())
+            return datetime.utcnow() + timedelta(milliseconds=50)
+
+        # Due again well within max_idle, every time
+        self.scheduler.add(Job('busy', run=lambda: datetime.utcnow() + timedelta(milliseconds=50), load=load))
+        thread = threading.Thread(target=self.scheduler.run, daemon=True)
+        thread.start()
+        time.sleep(1)
+        self.scheduler.stop()
+        thread.join()
+
+        # Once when added, and then every 300ms
+        self.assertGreaterEqual(len(loads), 3)
+
+    def test_rescheduling_replaces_the_old_entry(self):
+        self.scheduler.add(self._job('job', datetime.utcnow() + timedelta(hours=1)))
+        self.scheduler.schedule('job', datetime.utcnow() + timedelta(minutes=1))
+
+        self.assertEqual('job', self.scheduler.next_due()[1])
+        self.assertLess(self.scheduler.next_due()[0], datetime.utcnow() + timedelta(minutes=2))
+        self.scheduler.schedule('job', None)
+        self.assertIsNone(self.scheduler.next_due())
+
+    def test_started_schedulers_run_independently(self):
+        other = Scheduler(max_idle=timedelta(seconds=5), min_delay=timedelta(0))
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            time.sleep(0.5)
+            return None
+        other.add(Job('slow', run=slow, load=datetime.utcnow))
+        self.scheduler.add(self._job('fast', datetime.utcnow() + timedelta(milliseconds=50),
+                                     again=timedelta(milliseconds=50)))
+
+        threads = [other.start('other'), self.scheduler.start('main')]
+        started.wait(1)
+        time.sleep(0.3)
+        # The slow job is still running, while the fast one got through its runs
+        self.assertEqual(['fast'] * 4, self.runs)
+        other.stop()
+        self.scheduler.stop()
+        for thread in threads:
+            thread.join(2)
+            self.assertFalse(thread.is_alive())
+
+    def test_stop_before_the_thread_runs(self):
+        self.scheduler.add(self._job('job', datetime.utcnow() + timedelta(seconds=1)))
+        thread = self.scheduler.start('main')
+        self.scheduler.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([], self.runs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,14 @@
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
 import pytest
-from utils.stats import Stats, INTERVAL_BI_DAILY, INTERVAL_MEDIUM, INTERVAL_HIGHEST, INTERVAL_LOW, INTERVAL_DESERTED
+
+from models.models import Community, CommunityStats, Post
+from tests import create_test_db, query_budget
+from utils.leases import CommunityLeases
+from utils.syncer import Syncer
+from utils.stats import Stats, INTERVAL_BI_DAILY, INTERVAL_MEDIUM, INTERVAL_HIGHEST, INTERVAL_LOW, INTERVAL_DESERTED, \
+    INTERVAL_DAILY
 
 
 class TestStats:
@@ -21,3 +30,206 @@ class TestStats:
     def test_decide_interval(self, subscribers, posts_per_day, expected):
         result = Stats.decide_interval(subscribers, posts_per_day)
         assert result == expected
+
+    @pytest.mark.parametrize("subscribers, arrival_rate, expected", [
+        (1, 100, INTERVAL_DESERTED),  # Nobody's watching
+        (100, 100, INTERVAL_HIGHEST),  # Floor
+        (100, 10, 60),  # 10 posts per fetch
+        (100, 0.1, INTERVAL_BI_DAILY),  # Ceiling
+        (100, 0, INTERVAL_BI_DAILY),
+        (12, 5, INTERVAL_MEDIUM),
+        (3, 1, INTERVAL_BI_DAILY),
+        (3, 0.2, INTERVAL_DAILY),
+    ])
+    def test_predict_interval(self, subscribers, arrival_rate, expected):
+        assert Stats.predict_interval(subscribers, arrival_rate) == expected
+
+    def test_record_arrivals(self):
+        stats = CommunityStats(subscribers=100, posts_per_day=0)
+
+        assert Stats.record_arrivals(stats, 6, timedelta(hours=2))
+        assert stats.arrival_rate == 3
+        assert Stats.record_arrivals(stats, 0, timedelta(hours=1))
+        assert stats.arrival_rate == pytest.approx(2.25)
+        assert not Stats.record_arrivals(stats, 10, timedelta(minutes=1))
+        assert stats.arrival_rate == pytest.approx(2.25)
+
+    def test_choose_interval_prefers_arrivals(self):
+        # The buckets would make this a slow one, since hardly anything got cloned yet
+        stats = CommunityStats(subscribers=100, posts_per_day=1)
+        assert Stats.choose_interval(stats) == INTERVAL_BI_DAILY
+
+        stats.arrival_rate = 20
+        assert Stats.choose_interval(stats) == INTERVAL_HIGHEST
+
+
+class TestBulkUpdate:
+    @staticmethod
+    def community_view(name: str, subscribers: int) -> dict:
+        return {'community': {'name': name, 'published': '2023-07-01T12:00:00'}, 'counts': {'subscribers': subscribers}}
+
+    @pytest.fixture
+    def db(self):
+        db = create_test_db()
+        for lemmy_id, ident in enumerate(['first', 'Second', 'missing'], start=1):
+            db.add(Community(lemmy_id=lemmy_id, ident=ident, created=datetime(2023, 1, 1), enabled=True))
+        db.commit()
+        # An unknown creation date gets filled in by the update
+        db.query(Community).filter(Community.ident == 'Second').update({Community.created: None})
+        db.commit()
+        Stats(db, MagicMock()).initialize_stats()
+        return db
+
+    def test_walks_pages_until_short_page(self, db):
+        lemmy = MagicMock()
+        lemmy.community_list.side_effect = [
+            {'communities': [self.community_view('first', 12)]},
+            {'communities': [self.community_view('second', 34)]},
+            {'communities': []},
+        ]
+        lemmy.community.return_value = {'community_view': self.community_view('missing', 2)}
+
+        with patch('utils.stats.COMMUNITY_LIST_PAGE_SIZE', 1):
+            Stats(db, lemmy, bulk=True).update_community_stats()
+
+        assert [call.kwargs['page'] for call in lemmy.community_list.call_args_list] == [1, 2, 3]
+        stats = {cs.community.ident: cs for cs in db.query(CommunityStats).all()}
+        assert stats['first'].subscribers == 12
+        assert stats['Second'].subscribers == 34
+        assert stats['Second'].community.created == datetime(2023, 7, 1, 12)
+        # Only the community that isn't listed is looked up separately
+        lemmy.community.assert_called_once_with(name='missing')
+        assert stats['missing'].subscribers == 2
+
+    def test_nothing_due(self, db):
+        lemmy = MagicMock()
+        lemmy.community_list.return_value = {'communities': []}
+        lemmy.community.return_value = {'community_view': self.community_view('x', 1)}
+        stats = Stats(db, lemmy, bulk=True)
+        stats.update_community_stats()
+        lemmy.reset_mock()
+
+        stats.update_community_stats()
+
+        lemmy.community_list.assert_not_called()
+        lemmy.community.assert_not_called()
+
+    def test_stats_are_not_initialized_on_update(self, db):
+        db.add(Community(lemmy_id=4, ident='statless', created=datetime(2023, 1, 1), enabled=True))
+        db.commit()
+        lemmy = MagicMock()
+        lemmy.community.return_value = {'community_view': self.community_view('x', 7)}
+
+        Stats(db, lemmy).update_community_stats()
+
+        assert db.query(CommunityStats).count() == 3
+        Stats(db, lemmy).initialize_stats()
+        assert db.query(CommunityStats).count() == 4
+
+    def test_per_community_without_bulk(self, db):
+        lemmy = MagicMock()
+        lemmy.community.return_value = {'community_view': self.community_view('x', 7)}
+
+        Stats(db, lemmy).update_community_stats()
+
+        lemmy.community_list.assert_not_called()
+        assert lemmy.community.call_count == 3
+
+    def test_posts_per_day_batch(self, db):
+        first, second, _ = db.query(Community).order_by(Community.id).all()
+        for community, age in [(first, 1), (first, 5), (first, 30), (second, 2)]:
+            db.add(Post(reddit_link='https://old.reddit.com/r/x/', lemmy_link='https://lemmy/post/1', nsfw=False,
+                        updated=datetime.utcnow() - timedelta(hours=age), community=community))
+        db.commit()
+        stats = Stats(db, MagicMock())
+
+        assert stats.get_posts_per_day_batch() == {first.id: 2, second.id: 1}
+        assert stats.get_posts_per_day_batch([first.id]) == {first.id: 2}
+        assert stats.get_posts_per_day(first.id) == 2
+        assert stats.get_posts_per_day(first.id + 2) == 0
+
+
+class TestRecalculateStats:
+    @pytest.fixture
+    def db(self):
+        return create_test_db()
+
+    def _add(self, db, ident: str, subscribers: int, posts_per_day: int, **kwargs) -> CommunityStats:
+        community = Community(lemmy_id=1, ident=ident, created=datetime(2023, 1, 1))
+        community.stats = CommunityStats(subscribers=subscribers, posts_per_day=posts_per_day,
+                                         **{'min_interval': 15, **kwargs})
+        db.add(community)
+        return community.stats
+
+    def test_sql_agrees_with_decide_interval(self, db):
+        values = [0, 1, 2, 4, 5, 9, 10, 14, 15, 24, 25, 49, 50, 51, 200]
+        for subscribers in values:
+            for posts_per_day in values:
+                self._add(db, f'{subscribers}_{posts_per_day}', subscribers, posts_per_day)
+        db.commit()
+
+        Stats(db, MagicMock()).recalculate_stats()
+
+        for cs in db.query(CommunityStats).all():
+            assert cs.min_interval == Stats.decide_interval(cs.subscribers, cs.posts_per_day), cs.community.ident
+
+    def test_reports_changes_and_moves_next_scrape(self, db):
+        scraped = self._add(db, 'scraped', 100, 100)
+        scraped.community.last_scrape = datetime(2023, 7, 1, 12)
+        self._add(db, 'unchanged', 1, 1, min_interval=INTERVAL_DESERTED)
+        observed = self._add(db, 'observed', 1, 1, arrival_rate=3.0)
+        new = self._add(db, 'new', 1, 1)
+        new.community.created = datetime.utcnow()
+        db.commit()
+
+        assert Stats(db, MagicMock()).recalculate_stats() == 1
+
+        assert scraped.min_interval == INTERVAL_HIGHEST
+        assert scraped.community.next_scrape_at == datetime(2023, 7, 1, 12, 30)
+        assert observed.min_interval == 15
+        assert new.min_interval == 15
+
+
+class TestQueryBudget:
+    @pytest.fixture
+    def db(self):
+        db = create_test_db()
+        for lemmy_id in range(5):
+            community = Community(lemmy_id=lemmy_id, ident=f'community{lemmy_id}', created=datetime(2023, 1, 1))
+            community.stats = CommunityStats(subscribers=10, posts_per_day=10)
+            db.add(community)
+        db.commit()
+        db.expire_all()
+        return db
+
+    def test_update_batch_loads_communities(self, db):
+        with query_budget(db, 1):
+            batch = Stats(db, MagicMock()).get_update_batch(10)
+            assert len({cs.community.ident for cs in batch}) == 5
+
+    def test_bulk_update(self, db):
+        lemmy = MagicMock()
+        lemmy.community_list.return_value = {'communities': [
+            {'community': {'name': f'community{i}', 'published': '2023-01-01T00:00:00'}, 'counts': {'subscribers': i}}
+            for i in range(5)
+        ]}
+        stats = Stats(db, lemmy, bulk=True)
+        due = stats.get_update_batch(10)
+
+        # Stats and communities, posts per day, and the update itself
+        with query_budget(db, 4):
+            stats.bulk_update_community_stats(due)
+
+    def test_next_scrape_communities_loads_stats(self, db):
+        syncer = Syncer(db=db, reddit_reader=MagicMock(), lemmy=MagicMock(base_url='https://foo.bar'),
+                        thresh_upvotes=5, thresh_ratio=0.5)
+
+        with query_budget(db, 1):
+            communities = syncer.next_scrape_communities(10)
+            assert sum(community.stats.min_interval for community in communities) == 5 * 15
+
+    def test_leases_load_stats(self, db):
+        # Selecting, claiming each of them, committing, and loading communities and stats
+        with query_budget(db, 1 + 5 + 1 + 2):
+            communities = CommunityLeases('worker').claim_due(db, 10)
+            assert sum(community.stats.min_interval for community in communities) == 5 * 15
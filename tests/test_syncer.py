@@ -1,16 +1,24 @@
 import logging
+import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from dataclasses import replace
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, call, ANY, patch
 
-from requests import HTTPError, Response
+from requests import HTTPError, Response, ReadTimeout, ConnectionError as RequestsConnectionError
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session
+from urllib3.exceptions import MaxRetryError, NewConnectionError
 
 from lemmy.api import LemmyAPI
 from reddit.reader import RedditReader
-from models.models import SORT_NEW
-from tests import TEST_COMMUNITY, TEST_POSTS, LEMMY_POST_RETURN, TEST_COMMUNITY_DTO
-from utils.syncer import Syncer
-from utils.exceptions import SubredditRequestException
+from models.models import SORT_HOT, SORT_NEW, Community, CommunityStats, ListingCursor, Post, PostDTO, EPOCH, \
+    OutboxPost, OUTBOX_FAILED, OUTBOX_PENDING, OUTBOX_PUBLISHED, OUTBOX_PUBLISHING, OUTBOX_UNCERTAIN, CHECK_AFTER
+from tests import TEST_COMMUNITY, TEST_POSTS, LEMMY_POST_RETURN, TEST_COMMUNITY_DTO, create_test_db
+from utils.syncer import Syncer, CURSOR_GRACE
+from utils.exceptions import SubredditRequestException, PublishTimeoutException
+from utils.unit_of_work import PublishJournal, UnitOfWork
 
 
 class SyncerTestCase(unittest.TestCase):
@@ -24,6 +32,21 @@ class SyncerTestCase(unittest.TestCase):
         self.syncer = Syncer(db=self.db_session, reddit_reader=self.reddit_reader, lemmy=self.lemmy_api,
                              thresh_ratio=0.5, thresh_upvotes=5)
         self.syncer._logger = MagicMock(spec=logging.Logger)
+        # Posts a previous test couldn't get to would be resumed instead of listing
+        TEST_COMMUNITY.pending = None
+
+    def _use_test_db(self) -> Community:
+        """Publishing goes through the outbox, which needs an actual database"""
+        db = create_test_db()
+        self.syncer = Syncer(db=db, reddit_reader=self.reddit_reader, lemmy=self.lemmy_api, thresh_ratio=0.5,
+                             thresh_upvotes=5)
+        self.syncer._logger = MagicMock(spec=logging.Logger)
+        self.lemmy_api.create_post.return_value = LEMMY_POST_RETURN
+        community = Community(ident=TEST_COMMUNITY.ident, lemmy_id=TEST_COMMUNITY.lemmy_id, sorting=SORT_NEW,
+                              enabled=True, stats=CommunityStats(min_interval=15))
+        db.add(community)
+        db.commit()
+        return community
 
     def test_scrape_new_posts(self):
         """Happy path"""
@@ -31,18 +54,18 @@ class SyncerTestCase(unittest.TestCase):
         self.reddit_reader.get_subreddit_topics.return_value = TEST_POSTS
         self.reddit_reader.get_subreddit_topics_json.return_value = TEST_POSTS
 
-        # get_post_details just returns its input
-        self.reddit_reader.get_post_details.side_effect = lambda x: x
+        # get_posts_details just returns its input
+        self.reddit_reader.get_posts_details.side_effect = lambda x: x
 
         # Mock the return value of self.next_scrape_community
-        self.syncer.next_scrape_community = MagicMock(return_value=TEST_COMMUNITY)
+        self.syncer.next_scrape_community = MagicMock(return_value=self._use_test_db())
 
         # Call the method being tested
         self.syncer.scrape_new_posts()
 
         # Assert that the appropriate methods were called with the expected arguments
         # self.reddit_reader.get_subreddit_topics.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
-        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW, cursor=ANY)
         self.lemmy_api.create_post.assert_called()
 
         # Assert that the expected number of posts were created
@@ -63,7 +86,7 @@ class SyncerTestCase(unittest.TestCase):
 
         # Assert that the appropriate methods were called with the expected arguments
         # self.reddit_reader.get_subreddit_topics.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
-        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW, cursor=ANY)
         self.lemmy_api.create_post.assert_not_called()
         self.syncer._logger.error.assert_called_once()
 
@@ -82,7 +105,7 @@ class SyncerTestCase(unittest.TestCase):
         self.syncer.scrape_new_posts()
 
         # Assert that the appropriate methods were called with the expected arguments
-        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW, cursor=ANY)
         self.lemmy_api.create_post.assert_not_called()
         self.syncer._logger.error.assert_called()
 
@@ -90,7 +113,7 @@ class SyncerTestCase(unittest.TestCase):
         # Mock the necessary objects
         self.reddit_reader.get_subreddit_topics.return_value = TEST_POSTS
         self.reddit_reader.get_subreddit_topics_json.return_value = TEST_POSTS
-        self.reddit_reader.get_post_details.side_effect = HTTPError("Error")
+        self.reddit_reader.get_posts_details.side_effect = lambda x: [HTTPError("Error")]
 
         # Mock the return value of self.next_scrape_community
         self.syncer.next_scrape_community = MagicMock(return_value=TEST_COMMUNITY)
@@ -100,12 +123,126 @@ class SyncerTestCase(unittest.TestCase):
 
         # Assert that the appropriate methods were called with the expected arguments
         # self.reddit_reader.get_subreddit_topics.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
-        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW)
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW, cursor=ANY)
         self.syncer._logger.error.assert_called_once()
 
         # Assert nothing else is done
         self.lemmy_api.create_post.assert_not_called()
 
+    def test_scrape_new_posts_skips_details_of_complete_posts(self):
+        complete_post = replace(TEST_POSTS[0], complete=True)
+        self.reddit_reader.get_subreddit_topics_json.return_value = [complete_post, TEST_POSTS[1]]
+        self.reddit_reader.get_posts_details.side_effect = lambda x: x
+        self.syncer.next_scrape_community = MagicMock(return_value=self._use_test_db())
+
+        self.syncer.scrape_new_posts()
+
+        self.reddit_reader.get_posts_details.assert_called_once()
+        # Pending posts are copies, and publishing prefixes their body, so compare links
+        self.assertEqual([TEST_POSTS[1].reddit_link],
+                         [post.reddit_link for post in self.reddit_reader.get_posts_details.call_args.args[0]])
+        self.assertEqual(2, self.lemmy_api.create_post.call_count)
+
+    def test_scrape_new_posts_batched_splits_combined_listing(self):
+        self.syncer.batch_size = 5
+        other_community = Community(id=2, ident="Other_Subreddit", lemmy_id=666, nsfw=False, sorting='new',
+                                    enabled=True, stats=CommunityStats(community_id=2))
+        self.syncer.next_scrape_communities = MagicMock(return_value=[TEST_COMMUNITY, other_community])
+        self.reddit_reader.get_multi_subreddit_topics_json.return_value = {
+            'test_subreddit': TEST_POSTS[:2],
+            'other_subreddit': TEST_POSTS[2:],
+        }
+        self.syncer.process_posts = MagicMock()
+
+        self.syncer.scrape_new_posts()
+
+        self.reddit_reader.get_multi_subreddit_topics_json.assert_called_once_with(
+            ['test_subreddit', 'Other_Subreddit'], mode=SORT_NEW)
+        self.reddit_reader.get_subreddit_topics_json.assert_not_called()
+        self.syncer.process_posts.assert_has_calls([call(TEST_COMMUNITY, TEST_POSTS[:2]),
+                                                    call(other_community, TEST_POSTS[2:])])
+
+    def _saturated_listing(self, sorting: str) -> tuple:
+        """Three subs in a full combined listing, taken up by the busy one. It reaches back 2 hours."""
+        self.syncer.batch_size = 5
+        now = datetime.utcnow()
+        communities = [
+            Community(id=i, ident=ident, lemmy_id=i, sorting=sorting, enabled=True,
+                      last_scrape=now - timedelta(hours=hours), stats=CommunityStats(community_id=i))
+            for i, (ident, hours) in enumerate([('busy', 1), ('covered', 1), ('crowded_out', 3)], start=1)]
+        self.syncer.next_scrape_communities = MagicMock(return_value=communities)
+        listed = [replace(TEST_POSTS[0], subreddit='busy', created=now - timedelta(minutes=i)) for i in range(100)]
+        listed[-1].created = now - timedelta(hours=2)
+        self.reddit_reader.get_multi_subreddit_topics_json.return_value = {
+            'busy': listed, 'covered': [], 'crowded_out': []}
+        self.reddit_reader.get_subreddit_topics_json.return_value = TEST_POSTS[:1]
+        self.syncer.process_posts = MagicMock()
+        return communities, listed
+
+    def test_scrape_new_posts_batched_saturated_new_listing(self):
+        (busy, covered, crowded_out), listed = self._saturated_listing(SORT_NEW)
+
+        self.syncer.scrape_new_posts()
+
+        # The full listing reaches back to before the last scrape of one quiet sub, but not the other
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with('crowded_out', mode=SORT_NEW, cursor=ANY)
+        self.syncer.process_posts.assert_has_calls([call(busy, listed), call(covered, []),
+                                                    call(crowded_out, TEST_POSTS[:1], ANY)])
+
+    def test_scrape_new_posts_batched_saturated_hot_listing(self):
+        communities, listed = self._saturated_listing(SORT_HOT)
+
+        self.syncer.scrape_new_posts()
+
+        # Old popular posts can outrank fresh ones, so however far back it reaches, every sub needs its own listing
+        self.assertEqual(['busy', 'covered', 'crowded_out'],
+                         [c.args[0] for c in self.reddit_reader.get_subreddit_topics_json.call_args_list])
+        self.syncer.process_posts.assert_has_calls([call(community, TEST_POSTS[:1], ANY) for community in communities])
+
+    def test_scrape_new_posts_batched_falls_back_to_single(self):
+        self.syncer.batch_size = 5
+        self.syncer.next_scrape_communities = MagicMock(return_value=[TEST_COMMUNITY])
+        self.reddit_reader.get_multi_subreddit_topics_json.side_effect = HTTPError("Error")
+        self.reddit_reader.get_subreddit_topics_json.return_value = []
+        self.reddit_reader.get_posts_details.side_effect = lambda x: x
+
+        self.syncer.scrape_new_posts()
+
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once_with(TEST_COMMUNITY.ident, mode=SORT_NEW, cursor=ANY)
+
+    def test_advance_cursor_skips_past_handled_posts(self):
+        now = datetime.now()
+        listed = [replace(TEST_POSTS[0], fullname='t3_new', created=now),
+                  replace(TEST_POSTS[1], fullname='t3_old', created=now - timedelta(minutes=5))]
+
+        cursor = self.syncer.advance_cursor(ListingCursor(fullname='t3_older'), listed, {'t3_new', 't3_old'})
+
+        self.assertEqual('t3_new', cursor.fullname)
+        self.assertIsNotNone(cursor.moved)
+
+    def test_advance_cursor_stays_behind_posts_below_threshold(self):
+        now = datetime.now()
+        listed = [replace(TEST_POSTS[0], fullname='t3_newest', created=now),
+                  replace(TEST_POSTS[1], fullname='t3_pending', created=now - timedelta(minutes=5)),
+                  replace(TEST_POSTS[2], fullname='t3_oldest', created=now - timedelta(minutes=10))]
+
+        cursor = self.syncer.advance_cursor(ListingCursor(), listed, {'t3_newest', 't3_oldest'})
+        self.assertEqual('t3_oldest', cursor.fullname)
+
+        # Once the pending post is old enough to be given up on, the cursor moves past it
+        listed[1].created = now - CURSOR_GRACE - timedelta(minutes=1)
+        cursor = self.syncer.advance_cursor(cursor, listed, {'t3_newest', 't3_oldest'})
+        self.assertEqual('t3_newest', cursor.fullname)
+
+    def test_prepare_cursor_drops_stale_anchor(self):
+        community = Community(ident='stale', cursor_fullname='t3_gone', cursor_etag='"v1"',
+                              cursor_moved=datetime.utcnow() - timedelta(days=2))
+
+        cursor = self.syncer.prepare_cursor(community)
+
+        self.assertIsNone(cursor.fullname)
+        self.assertEqual('"v1"', cursor.etag)
+
     def test_clone_to_lemmy_success(self):
         # Mock the necessary objects
         post = TEST_POSTS[0]
@@ -161,7 +298,7 @@ class SyncerTestCase(unittest.TestCase):
         self.db_session.add.assert_not_called()
         self.db_session.commit.assert_not_called()
 
-    def test_clone_to_lemmy_timeout_is_ignored(self):
+    def test_clone_to_lemmy_timeout_is_uncertain(self):
         # Mock the necessary objects
         post = TEST_POSTS[1]
         community = TEST_COMMUNITY
@@ -179,12 +316,12 @@ class SyncerTestCase(unittest.TestCase):
         )
 
         # Call the method being tested
-        self.syncer.clone_to_lemmy(post, community)
+        with self.assertRaises(PublishTimeoutException):
+            self.syncer.clone_to_lemmy(post, community)
 
-        # Ensure logs and write to Database
+        # Nothing is saved until the reconciler found out whether it made it
         self.syncer._logger.warning.assert_called_once()
-        self.db_session.add.assert_called()
-        self.db_session.commit.assert_called()
+        self.db_session.add.assert_not_called()
 
     # New Subreddit requests
     def test_check_new_subs_no_new_requests(self):
@@ -316,6 +453,289 @@ class SyncerTestCase(unittest.TestCase):
         self.assertEqual('https://i.redd.it/jhy4fy4jgp9b1.jpg', prepared_post.external_link)
 
 
+class FilterPostedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = create_test_db()
+        self.syncer = Syncer(db=self.db, reddit_reader=MagicMock(spec=RedditReader), lemmy=MagicMock(spec=LemmyAPI, base_url='https://foo.bar'),
+                             thresh_upvotes=5, thresh_ratio=0.5)
+        community = Community(lemmy_id=1, ident='test')
+        self.db.add(Post(reddit_link='https://www.reddit.com/r/test/comments/abc123/posted/', reddit_id='t3_abc123',
+                         lemmy_link='https://lemmy/post/1', updated=datetime.utcnow(), nsfw=False, community=community))
+        self.db.commit()
+
+    def test_filter_posted_by_reddit_id(self):
+        posted = replace(TEST_POSTS[0], reddit_link='https://old.reddit.com/r/test/comments/abc123/posted/')
+        listed = replace(TEST_POSTS[1], reddit_link='https://old.reddit.com/r/test/comments/def456/new/',
+                         fullname='t3_def456')
+
+        self.assertEqual([listed], self.syncer.filter_posted([posted, listed]))
+
+    def test_reddit_id_prefers_fullname(self):
+        self.assertEqual('t3_abc123', replace(TEST_POSTS[0], reddit_link='https://redd.it/x', fullname='t3_abc123').reddit_id)
+        self.assertEqual('t3_14su2qc', replace(TEST_POSTS[0], reddit_link='https://www.reddit.com/r/CombatFootage/comments/14su2qc/blabla/').reddit_id)
+        self.assertEqual('t3_14su2qc', replace(TEST_POSTS[0], reddit_link='https://redd.it/14su2qc').reddit_id)
+        self.assertIsNone(TEST_POSTS[0].reddit_id)
+
+
+class NextScrapeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = create_test_db()
+        self.syncer = Syncer(db=self.db, reddit_reader=MagicMock(spec=RedditReader),
+                             lemmy=MagicMock(spec=LemmyAPI, base_url='https://foo.bar'),
+                             thresh_upvotes=5, thresh_ratio=0.5)
+
+    def _community(self, ident: str, min_interval: int, enabled: bool = True) -> Community:
+        community = Community(lemmy_id=1, ident=ident, enabled=enabled)
+        community.stats = CommunityStats(min_interval=min_interval)
+        self.db.add(community)
+        self.db.commit()
+        return community
+
+    def test_next_scrape_at_follows_last_scrape_and_interval(self):
+        community = self._community('test', 60)
+        self.assertEqual(EPOCH, community.next_scrape_at)
+
+        community.last_scrape = datetime(2023, 7, 1, 12)
+        self.assertEqual(datetime(2023, 7, 1, 13), community.next_scrape_at)
+
+        community.stats.min_interval = 240
+        self.assertEqual(datetime(2023, 7, 1, 16), community.next_scrape_at)
+
+    def test_next_scrape_communities_most_overdue_first(self):
+        recent = self._community('recent', 30)
+        recent.last_scrape = datetime.utcnow() - timedelta(minutes=40)
+        not_due = self._community('not_due', 60)
+        not_due.last_scrape = datetime.utcnow() - timedelta(minutes=40)
+        self._community('disabled', 30, enabled=False)
+        never = self._community('never', 30)
+        self.db.commit()
+
+        self.assertEqual([never, recent], self.syncer.next_scrape_communities(5))
+
+    def test_queue_posts_observes_arrivals(self):
+        community = self._community('test', 720)
+        community.stats.subscribers = 100
+        community.last_scrape = datetime.utcnow() - timedelta(hours=1)
+        listed = [replace(TEST_POSTS[0], created=datetime.now() - timedelta(minutes=minutes)) for minutes in
+                  range(5, 600, 25)]
+
+        self.syncer.queue_posts(community, listed)
+
+        # 3 of them arrived in the last hour
+        self.assertAlmostEqual(3, community.stats.arrival_rate, places=3)
+        self.assertEqual(200, community.stats.min_interval)
+        self.assertEqual(community.last_scrape + timedelta(minutes=200), community.next_scrape_at)
+
+    def test_create_community_creates_stats(self):
+        self.syncer._lemmy.create_community.return_value = {'community_view': {'community': {'id': 42}}}
+
+        self.syncer.create_community(TEST_COMMUNITY_DTO)
+
+        community = self.db.query(Community).filter(Community.lemmy_id == 42).one()
+        self.assertEqual(0, community.stats.subscribers)
+        self.assertEqual(datetime.fromtimestamp(0), community.stats.last_update)
+
+
+class BudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = create_test_db()
+        self.reddit_reader = MagicMock(spec=RedditReader)
+        self.reddit_reader.get_posts_details.side_effect = lambda posts: posts
+        self.lemmy_api = MagicMock(spec=LemmyAPI, base_url='https://foo.bar')
+        self.lemmy_api.create_post.return_value = LEMMY_POST_RETURN
+        self.syncer = Syncer(db=self.db, reddit_reader=self.reddit_reader, lemmy=self.lemmy_api, thresh_upvotes=5,
+                             thresh_ratio=0.5, max_posts=2)
+        self.community = Community(lemmy_id=1, ident='busy', enabled=True, stats=CommunityStats(min_interval=60))
+        self.db.add(self.community)
+        self.db.commit()
+        now = datetime.now()
+        self.reddit_reader.get_subreddit_topics_json.return_value = [
+            PostDTO(reddit_link=f'https://old.reddit.com/r/busy/comments/busy{i}/', title=f'busy {i}',
+                    author='/u/someone', created=now, updated=now + timedelta(seconds=i), upvotes=10,
+                    fullname=f't3_busy{i}', complete=True) for i in range(5)]
+
+    def test_resumes_pending_posts(self):
+        self.syncer.scrape_community(self.community)
+
+        self.assertEqual(2, self.lemmy_api.create_post.call_count)
+        self.assertEqual(['busy 2', 'busy 3', 'busy 4'], [post.title for post in self.community.pending.posts])
+        # Not done yet, but behind the communities that were already due
+        self.assertIsNone(self.community.last_scrape)
+        self.assertGreater(self.community.next_scrape_at, EPOCH)
+        listed_at = self.community.pending.listed_at
+
+        self.syncer.scrape_community(self.community)
+        self.syncer.scrape_community(self.community)
+
+        # The remaining posts came from the pending ones, not another listing
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once()
+        self.assertEqual(5, self.db.query(Post).count())
+        self.assertIsNone(self.community.pending)
+        self.assertEqual(listed_at, self.community.last_scrape)
+
+    def test_time_budget(self):
+        self.syncer.max_posts = None
+        self.syncer.time_budget = timedelta(0)
+
+        self.syncer.scrape_community(self.community)
+
+        # Always at least one, to make progress. The others are staged, and waiting for the next turn.
+        self.assertEqual(1, self.lemmy_api.create_post.call_count)
+        self.assertEqual([], self.community.pending.posts)
+        self.assertEqual(4, self.syncer.outbox.waiting(self.community.id))
+
+        self.syncer.scrape_community(self.community)
+
+        self.reddit_reader.get_subreddit_topics_json.assert_called_once()
+        self.assertEqual(2, self.lemmy_api.create_post.call_count)
+
+    @patch('utils.syncer.ENRICH_CHUNK', 2)
+    def test_time_budget_stops_enrichment(self):
+        self.reddit_reader.get_subreddit_topics_json.return_value = [
+            replace(post, complete=False) for post in self.reddit_reader.get_subreddit_topics_json.return_value]
+        self.syncer.max_posts = None
+        self.syncer.time_budget = timedelta(0)
+
+        self.syncer.scrape_community(self.community)
+
+        # Only the first chunk had its details fetched, the rest waits for the next turn
+        self.reddit_reader.get_posts_details.assert_called_once()
+        self.assertEqual(['busy 0', 'busy 1'],
+                         [post.title for post in self.reddit_reader.get_posts_details.call_args.args[0]])
+        self.assertEqual(['busy 2', 'busy 3', 'busy 4'], [post.title for post in self.community.pending.posts])
+
+    def test_enrichment_failure_keeps_the_rest_pending(self):
+        self.reddit_reader.get_subreddit_topics_json.return_value = [
+            replace(post, complete=False) for post in self.reddit_reader.get_subreddit_topics_json.return_value]
+        self.reddit_reader.get_posts_details.side_effect = lambda posts: [posts[0], HTTPError('Error')]
+
+        self.syncer.scrape_community(self.community)
+
+        self.assertEqual(1, self.lemmy_api.create_post.call_count)
+        self.assertEqual(['busy 1', 'busy 2', 'busy 3', 'busy 4'],
+                         [post.title for post in self.community.pending.posts])
+
+    def test_failed_publish_is_retried_from_the_outbox(self):
+        self.syncer.max_posts = None
+        self.lemmy_api.create_post.side_effect = [HTTPError('Error', response=Response())] + [LEMMY_POST_RETURN] * 5
+
+        self.syncer.scrape_community(self.community)
+
+        # The failure waits for its retry, it doesn't hold up the scrape
+        self.assertEqual(4, self.db.query(Post).count())
+        self.assertIsNone(self.community.pending)
+        self.assertIsNotNone(self.community.last_scrape)
+        entry = self.db.query(OutboxPost).filter(OutboxPost.state == OUTBOX_FAILED).one()
+        self.assertEqual('t3_busy0', entry.reddit_id)
+
+        entry.next_attempt_at = datetime.utcnow()
+        self.reddit_reader.get_subreddit_topics_json.return_value = []
+        self.syncer.scrape_community(self.community)
+
+        # Published from the outbox, without fetching anything again
+        self.assertEqual(5, self.db.query(Post).count())
+        self.reddit_reader.get_posts_details.assert_not_called()
+
+    def test_timed_out_publish_is_left_to_the_reconciler(self):
+        response = MagicMock(status_code=504, text='504 Gateway Time-out')
+        self.lemmy_api.create_post.side_effect = [HTTPError('504', response=response)] + [LEMMY_POST_RETURN] * 4
+        self.syncer.max_posts = None
+
+        self.syncer.scrape_community(self.community)
+
+        self.assertEqual(4, self.db.query(Post).count())
+        entry = self.db.query(OutboxPost).filter(OutboxPost.state == OUTBOX_UNCERTAIN).one()
+        self.assertEqual('t3_busy0', entry.reddit_id)
+        self.assertIsNone(self.community.pending)
+
+    def test_unanswered_publish_is_left_to_the_reconciler(self):
+        not_connected = RequestsConnectionError(MaxRetryError(None, '/api/v3/post', NewConnectionError(None, 'refused')))
+        self.lemmy_api.create_post.side_effect = [ReadTimeout('read timed out'), not_connected] + [LEMMY_POST_RETURN] * 3
+        self.syncer.max_posts = None
+
+        self.syncer.scrape_community(self.community)
+
+        # The read time-out may have made it, the refused connection certainly didn't
+        self.assertEqual({'t3_busy0': OUTBOX_UNCERTAIN, 't3_busy1': OUTBOX_FAILED},
+                         {entry.reddit_id: entry.state for entry in self.db.query(OutboxPost)
+                          .filter(OutboxPost.state != OUTBOX_PUBLISHED)})
+
+    def test_published_pending_posts_are_skipped(self):
+        self.syncer.scrape_community(self.community)
+        # Say, recovered from the publish journal
+        self.db.add(Post(reddit_link='https://old.reddit.com/r/busy/comments/busy2/', reddit_id='t3_busy2',
+                         lemmy_link='https://lemmy/post/2', updated=datetime.utcnow(), nsfw=False,
+                         community=self.community))
+        self.db.commit()
+        self.lemmy_api.create_post.reset_mock()
+
+        self.syncer.scrape_community(self.community)
+
+        self.assertEqual(['busy 3', 'busy 4'], [call.kwargs['name'] for call in self.lemmy_api.create_post.call_args_list])
+        self.assertIsNone(self.community.pending)
+
+    def test_published_posts_are_watched(self):
+        original_hash = self.reddit_reader.get_subreddit_topics_json.return_value[0].content_hash()
+
+        self.syncer.scrape_community(self.community)
+
+        post = self.db.query(Post).filter_by(reddit_id='t3_busy0').one()
+        self.assertEqual(5, post.lemmy_id)
+        # The original, not the prepared version that was published
+        self.assertEqual(original_hash, post.content_hash)
+        self.assertEqual(0, post.check_stage)
+        self.assertEqual(post.updated + CHECK_AFTER[0], post.next_check_at)
+
+    def test_failed_commit_does_not_publish_twice(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        journal = PublishJournal(os.path.join(directory.name, 'publish.journal'))
+        self.syncer = Syncer(db=self.db, reddit_reader=self.reddit_reader, lemmy=self.lemmy_api, thresh_upvotes=5,
+                             thresh_ratio=0.5, unit_of_work=UnitOfWork(self.db, journal))
+        commit = self.db.commit
+        failures = []
+
+        def flaky_commit():
+            # The first commit after publishing fails
+            if self.lemmy_api.create_post.called and not failures:
+                failures.append(True)
+                raise OperationalError('COMMIT', {}, Exception('database is locked'))
+            commit()
+
+        with patch.object(self.db, 'commit', side_effect=flaky_commit):
+            with self.assertRaises(OperationalError):
+                self.syncer.scrape_community(self.community)
+            self.assertEqual(5, len(journal.entries()))
+
+            self.syncer.scrape_community(self.community)
+
+        self.assertEqual(5, self.lemmy_api.create_post.call_count)
+        self.assertEqual(5, self.db.query(Post).count())
+        self.assertEqual(0, self.syncer.outbox.waiting(self.community.id))
+        self.assertEqual([], journal.entries())
+        self.assertEqual(0, PublishJournal.recover(self.db, journal.path))
+
+    def test_shared_publish_is_committed_before_it_starts(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        journal = PublishJournal(os.path.join(directory.name, 'publish.journal'))
+        self.syncer = Syncer(db=self.db, reddit_reader=self.reddit_reader, lemmy=self.lemmy_api, thresh_upvotes=5,
+                             thresh_ratio=0.5, unit_of_work=UnitOfWork(self.db, journal, shared=True))
+        self.lemmy_api.create_post.side_effect = [LEMMY_POST_RETURN, SystemExit('Killed')]
+
+        with self.assertRaises(SystemExit):
+            self.syncer.scrape_community(self.community)
+        # Whatever the crashed worker didn't commit is gone, its journal is on another host
+        self.db.rollback()
+
+        # The post before it made it anyway, and the next worker to claim the community leaves the one that was
+        # publishing to the reconciler, instead of publishing it again
+        self.assertEqual(['t3_busy0'], [post.reddit_id for post in self.db.query(Post)])
+        self.assertEqual({'t3_busy0': OUTBOX_PUBLISHED, 't3_busy1': OUTBOX_PUBLISHING}, {
+            entry.reddit_id: entry.state for entry in self.db.query(OutboxPost) if entry.state != OUTBOX_PENDING})
+        self.assertEqual(['t3_busy2', 't3_busy3', 't3_busy4'],
+                         [entry.reddit_id for entry in self.syncer.outbox.due(self.community.id)])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from sqlalchemy.orm import Session
+
+from models.models import Community, Post, CHECK_AFTER
+from tests import create_test_db
+from utils.unit_of_work import PublishJournal, UnitOfWork
+
+
+class UnitOfWorkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'publish.journal')
+        self.db = create_test_db()
+        self.community = Community(lemmy_id=1, ident='test')
+        self.db.add(self.community)
+        self.db.commit()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _post(self, ident: str) -> Post:
+        return Post(reddit_link=f'https://old.reddit.com/r/test/comments/{ident}/', reddit_id=f't3_{ident}',
+                    lemmy_link=f'https://lemmy/post/{ident}', updated=datetime.utcnow(), nsfw=False,
+                    community=self.community)
+
+    def test_commits_once_per_batch(self):
+        db = MagicMock(spec=Session)
+        unit_of_work = UnitOfWork(db, PublishJournal(self.path), max_pending=3)
+
+        for ident in ['a', 'b']:
+            unit_of_work.add_post(self._post(ident))
+        db.commit.assert_not_called()
+        self.assertEqual(2, len(PublishJournal(self.path).entries()))
+
+        unit_of_work.add_post(self._post('c'))
+        db.commit.assert_called_once()
+        self.assertEqual([], PublishJournal(self.path).entries())
+
+    def test_commits_every_post_without_journal(self):
+        db = MagicMock(spec=Session)
+        unit_of_work = UnitOfWork(db)
+
+        unit_of_work.add_post(self._post('a'))
+        unit_of_work.add_post(self._post('b'))
+
+        self.assertEqual(2, db.commit.call_count)
+
+    def test_recover_saves_what_never_got_committed(self):
+        saved = self._post('saved')
+        self.db.add(saved)
+        self.db.commit()
+        journal = PublishJournal(self.path)
+        thread_journal = PublishJournal(f'{self.path}.publish-0')
+        journal.append(saved)
+        lost = self._post('lost')
+        lost.watch(7, 'abc')
+        journal.append(lost)
+        thread_journal.append(self._post('lost_too'))
+        self.db.expunge_all()
+
+        self.assertEqual(2, PublishJournal.recover(self.db, self.path))
+
+        self.assertEqual({'t3_saved', 't3_lost', 't3_lost_too'}, {row[0] for row in self.db.query(Post.reddit_id)})
+        recovered = self.db.query(Post).filter_by(reddit_id='t3_lost').one()
+        self.assertEqual((7, 'abc', 0), (recovered.lemmy_id, recovered.content_hash, recovered.check_stage))
+        self.assertEqual(recovered.updated + CHECK_AFTER[0], recovered.next_check_at)
+        self.assertEqual([], journal.entries())
+        self.assertEqual([], thread_journal.entries())
+        self.assertEqual(0, PublishJournal.recover(self.db, self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
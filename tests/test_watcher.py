@@ -0,0 +1,124 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+from requests import HTTPError
+
+from lemmy.api import LemmyAPI
+from models.models import Community, Post, PostDTO, CHECK_AFTER
+from reddit.reader import RedditReader
+from tests import create_test_db
+from utils.rate_limit import RateLimitBudget
+from utils.watcher import Watcher, RESERVE, REMOVE_REASON
+
+
+class WatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = create_test_db()
+        self.community = Community(lemmy_id=1, ident='test', enabled=True)
+        self.db.add(self.community)
+        self.db.commit()
+        self.reddit_reader = MagicMock(spec=RedditReader)
+        self.reddit_reader.rate_limit = MagicMock()
+        self.reddit_reader.rate_limit.budget.return_value = RateLimitBudget(remaining=None, reset_in=None, rate=1,
+                                                                            paused_for=0)
+        self.lemmy_api = MagicMock(spec=LemmyAPI)
+        self.watcher = Watcher(self.db, self.reddit_reader, self.lemmy_api)
+
+    @staticmethod
+    def _original(name: str, body: str = 'Original body') -> PostDTO:
+        return PostDTO(reddit_link=f'https://old.reddit.com/r/test/comments/{name}/', title=f'Title of {name}',
+                       author='/u/someone', created=datetime(2023, 7, 1), updated=datetime(2023, 7, 1), body=body,
+                       fullname=f't3_{name}', complete=True)
+
+    def _published(self, *names: str, hours_ago: float = 2) -> list:
+        """Posts that were published a while ago, and are due for their first check"""
+        posts = []
+        for lemmy_id, name in enumerate(names, start=1):
+            post = Post(reddit_link=f'https://old.reddit.com/r/test/comments/{name}/', reddit_id=f't3_{name}',
+                        lemmy_link=f'https://lemmy/post/{lemmy_id}', nsfw=False, community=self.community,
+                        updated=datetime.utcnow() - timedelta(hours=hours_ago))
+            post.watch(lemmy_id, self._original(name).content_hash())
+            posts.append(post)
+        self.db.add_all(posts)
+        self.db.commit()
+        return posts
+
+    def test_only_changed_posts_are_updated(self):
+        unchanged, edited, removed = self._published('unchanged', 'edited', 'removed')
+        self.reddit_reader.get_posts_by_id.return_value = {
+            't3_unchanged': self._original('unchanged'),
+            't3_edited': self._original('edited', body='Edited body'),
+            't3_removed': None,
+        }
+
+        self.assertEqual(3, self.watcher.check_due())
+
+        self.reddit_reader.get_posts_by_id.assert_called_once_with(['t3_unchanged', 't3_edited', 't3_removed'])
+        self.lemmy_api.edit_post.assert_called_once()
+        edit = self.lemmy_api.edit_post.call_args.kwargs
+        self.assertEqual(2, edit['post_id'])
+        self.assertEqual('Title of edited', edit['name'])
+        # Prepared like a new post would be
+        self.assertIn('The original was posted on [/r/test]', edit['body'])
+        self.assertTrue(edit['body'].endswith('Edited body'))
+        self.assertEqual(self._original('edited', body='Edited body').content_hash(), edited.content_hash)
+        self.lemmy_api.remove_post.assert_called_once_with(post_id=3, removed=True, reason=REMOVE_REASON)
+
+        self.assertEqual([1, 1], [unchanged.check_stage, edited.check_stage])
+        self.assertEqual(unchanged.updated + CHECK_AFTER[1], unchanged.next_check_at)
+        self.assertIsNone(removed.next_check_at)
+        self.assertEqual([], self.watcher.due(100))
+
+    def test_first_check_without_hash_takes_note(self):
+        post, = self._published('noted')
+        post.content_hash = None
+        self.reddit_reader.get_posts_by_id.return_value = {'t3_noted': self._original('noted', body='Edited')}
+
+        self.watcher.check_due()
+
+        self.lemmy_api.edit_post.assert_not_called()
+        self.assertEqual(self._original('noted', body='Edited').content_hash(), post.content_hash)
+
+    def test_failed_edit_is_tried_again_on_the_next_check(self):
+        post, = self._published('edited')
+        original_hash = post.content_hash
+        self.reddit_reader.get_posts_by_id.return_value = {'t3_edited': self._original('edited', body='Edited')}
+        self.lemmy_api.edit_post.side_effect = HTTPError('Lemmy is down')
+
+        self.watcher.check_due()
+
+        self.assertEqual(original_hash, post.content_hash)
+        self.assertEqual(1, post.check_stage)
+
+    def test_batches_and_caps_requests(self):
+        self._published(*[f'post{i}' for i in range(250)])
+        self.reddit_reader.get_posts_by_id.side_effect = lambda fullnames: {}
+        self.watcher.max_requests = 2
+
+        self.assertEqual(200, self.watcher.check_due())
+
+        self.assertEqual([100, 100], [len(call.args[0]) for call in self.reddit_reader.get_posts_by_id.call_args_list])
+        self.assertEqual(50, len(self.watcher.due(100)))
+
+    def test_waits_while_scraping_needs_the_requests(self):
+        self._published('post')
+        for budget in [RateLimitBudget(remaining=RESERVE - 1, reset_in=60, rate=1, paused_for=0),
+                       RateLimitBudget(remaining=None, reset_in=None, rate=1, paused_for=30)]:
+            self.reddit_reader.rate_limit.budget.return_value = budget
+            self.assertEqual(0, self.watcher.check_due())
+
+        self.reddit_reader.get_posts_by_id.assert_not_called()
+
+    def test_stops_after_the_last_check(self):
+        post, = self._published('old', hours_ago=24 * 31)
+        post.check_stage = len(CHECK_AFTER) - 1
+        self.reddit_reader.get_posts_by_id.return_value = {'t3_old': self._original('old')}
+
+        self.watcher.check_due()
+
+        self.assertIsNone(post.next_check_at)
+
+
+if __name__ == '__main__':
+    unittest.main()